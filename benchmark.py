@@ -0,0 +1,454 @@
+"""
+对比默认事件循环和 uvloop 跑机器人的性能，或者对比消息解析的性能
+
+用 ReplayClient 尽快回放录制的 WebSocket 消息，交给机器人的消息处理器渲染、写日志，再发到本地的 Telegram 替身服务器，
+统计从开始回放到所有消息发送完的耗时。每种事件循环每轮都在新的子进程里跑，互不影响
+
+--parse 模式只测 WebSocketClientBase._parse_ws_message：拆包、解压、JSON 解码的速度和内存分配峰值，以及单条 DANMU_MSG、
+SEND_GIFT 在各个 JSON 后端的解码耗时。用 --blivedm 可以测另一份代码，比如改动前的提交，方便对比
+
+用法：
+    # 回放 CAPTURE_FILE 录下来的消息
+    python benchmark.py --capture capture.bin
+    # 没有录制文件时，生成固定种子的合成消息
+    python benchmark.py --synthetic 2000
+    # 对比改动前后的解析性能
+    git worktree add /tmp/blivedm-base <commit>
+    python benchmark.py --parse --synthetic 200 --blivedm /tmp/blivedm-base --blivedm .
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import pickle
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+import zlib
+
+import aiohttp
+import brotli
+from aiohttp import web
+
+# --parse 模式的子进程从 --blivedm 指定的目录导入 blivedm
+if os.environ.get('BENCHMARK_BLIVEDM_PATH'):
+    sys.path.insert(0, os.environ['BENCHMARK_BLIVEDM_PATH'])
+import blivedm  # noqa: E402
+
+HEADER_STRUCT = blivedm.clients.ws_base.HEADER_STRUCT
+
+
+# ================= 合成消息 =================
+def make_packet(body: bytes, operation=5, ver=0) -> bytes:
+    return HEADER_STRUCT.pack(HEADER_STRUCT.size + len(body), HEADER_STRUCT.size, ver, operation, 0) + body
+
+
+def make_danmaku(rnd: random.Random, i: int) -> dict:
+    uid = rnd.randrange(1, 100000)
+    extra = json.dumps({'id_str': f'bench{i}', 'content': f'弹幕{i}'})
+    return {
+        'cmd': 'DANMU_MSG',
+        'info': [
+            [0, 1, 25, 16777215, 1700000000000 + i, rnd.randrange(1 << 31), 0, 'abcd1234', 0, 0, 0, '', 0, '{}',
+             '{}', {'mode': 0, 'show_player_type': 0, 'extra': extra}, {'activity_identity': '', 'activity_source': 0,
+                                                                       'not_show': 0}, 0],
+            f'测试弹幕 {i} ' + '哈' * rnd.randrange(1, 30),
+            [uid, f'用户{uid}', 0, 0, 0, 10000, 1, ''],
+            [21, '牌子', '主播', 1, 9272486, '', 0, 9272486, 9272486, 9272486, 0, 1, 1],
+            [10, 0, 9868950, '>50000', 0],
+            ['', ''],
+            0, 0, None, {'ts': 1700000000, 'ct': 'ABCDEF'}, 0, 0, None, None, 0, 105, [0], None,
+        ],
+    }
+
+
+def make_gift(rnd: random.Random, i: int) -> dict:
+    uid = rnd.randrange(1, 100000)
+    num = rnd.randrange(1, 10)
+    return {
+        'cmd': 'SEND_GIFT',
+        'data': {
+            'action': '投喂', 'coin_type': 'gold', 'face': '', 'giftId': 1, 'giftName': '小花花', 'giftType': 0,
+            'guard_level': 0, 'medal_info': {'anchor_roomid': 0, 'anchor_uname': '', 'guard_level': 0,
+                                             'medal_color': 0, 'medal_level': 0, 'medal_name': '', 'target_id': 0},
+            'num': num, 'price': 100, 'rnd': str(i), 'tid': f'bench{i}', 'timestamp': 1700000000,
+            'total_coin': 100 * num, 'uid': uid, 'uname': f'用户{uid}', 'gift_info': {'img_basic': '', 'webp': ''},
+            'receiver_uinfo': {'uid': 2, 'base': {'name': '主播'}}, 'blind_gift': None,
+            'sender_uinfo': {'base': {'face': ''}},
+        },
+    }
+
+
+NOISE = {'cmd': 'ONLINE_RANK_COUNT', 'data': {'count': 1234, 'count_text': '1234', 'online_count': 1234}}
+
+
+def write_synthetic_capture(path: str, frame_count: int, room_count=4, commands_per_frame=10, seed=1):
+    """生成固定种子的合成录制文件，每个 WebSocket 消息是 brotli 压缩的一批业务消息"""
+    rnd = random.Random(seed)
+    recorder = blivedm.FrameRecorder(path)
+    try:
+        i = 0
+        for _ in range(frame_count):
+            body = b''
+            for _ in range(commands_per_frame):
+                x = rnd.random()
+                command = make_danmaku(rnd, i) if x < 0.5 else make_gift(rnd, i) if x < 0.65 else NOISE
+                body += make_packet(json.dumps(command, ensure_ascii=False).encode('utf-8'))
+                i += 1
+            recorder.write(rnd.randrange(room_count) + 1, make_packet(brotli.compress(body), ver=3))
+    finally:
+        recorder.close()
+
+
+# ================= 单次测量（在子进程里跑） =================
+def make_bench_handler(session):
+    """
+    和机器人一样每个房间按顺序发送，但是自己记下发送的协程，方便等全部发送完
+
+    机器人依赖当前版本的 blivedm，所以用到时才导入，--parse 模式测旧版本时不用导入
+    """
+    import blivedm_tg_bot as bot
+
+    class BenchHandler(bot.BotHandler):
+        def __init__(self):
+            super().__init__(session)
+            self.last_tasks = {}
+
+        def handle_batch(self, client, commands):
+            res = super().handle_batch(client, commands)
+            if res is not None:
+                self.last_tasks[client] = asyncio.ensure_future(self._send_after(self.last_tasks.get(client), res))
+
+        def on_client_stopped(self, client, exception):
+            # 回放结束不用发通知
+            pass
+
+        @staticmethod
+        async def _send_after(prev_task, coro):
+            if prev_task is not None:
+                await prev_task
+            await coro
+
+    return BenchHandler()
+
+
+async def start_telegram_stand_in(latency: float):
+    """本地的 Telegram 替身，只数收到了多少条消息"""
+    counter = {'posts': 0}
+
+    async def send_message(request):
+        await request.read()
+        if latency > 0:
+            await asyncio.sleep(latency)
+        counter['posts'] += 1
+        return web.json_response({'ok': True})
+
+    app = web.Application()
+    app.router.add_post('/{bot}/sendMessage', send_message)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]  # noqa
+    return runner, f'http://127.0.0.1:{port}', counter
+
+
+async def run_once(capture: str, latency: float) -> dict:
+    import blivedm_tg_bot as bot
+
+    runner, base_url, counter = await start_telegram_stand_in(latency)
+    bot.TELEGRAM_API_BASES = [base_url]
+    bot.TELEGRAM_BOT_TOKEN = bot.ALT_TELEGRAM_BOT_TOKEN = 'bench'
+    bot.TELEGRAM_CHAT_ID = '1'
+
+    room_ids = sorted({frame.room_id for frame in blivedm.read_frames(capture)})
+    async with aiohttp.ClientSession() as session:
+        handler = make_bench_handler(session)
+        clients = []
+        for room_id in room_ids:
+            client = blivedm.ReplayClient(capture, speed=None, room_id=room_id, session=session)
+            client.set_handler(handler)
+            clients.append(client)
+
+        start_time = time.perf_counter()
+        start_cpu_time = time.process_time()
+        for client in clients:
+            client.start()
+        await asyncio.gather(*(client.join() for client in clients))
+        replay_time = time.perf_counter() - start_time
+        await asyncio.gather(*handler.last_tasks.values())
+        total_time = time.perf_counter() - start_time
+        cpu_time = time.process_time() - start_cpu_time
+
+        for client in clients:
+            await client.close()
+    await runner.cleanup()
+    return {
+        'frames': sum(client.replayed_frame_count for client in clients),
+        'commands': handler.command_count,
+        'posts': counter['posts'],
+        'replay_time': replay_time,
+        'total_time': total_time,
+        'cpu_time': cpu_time,
+    }
+
+
+def worker_main(args):
+    import blivedm_tg_bot as bot
+
+    logging.getLogger('blivedm').setLevel(logging.WARNING)
+    event_loop = bot.install_event_loop(args.loop)
+    if event_loop != args.loop:
+        print(json.dumps({'error': f'{args.loop} is not available'}))
+        return
+    with tempfile.TemporaryDirectory() as log_dir:
+        # 机器人会写日志文件、print 每条消息，不要污染当前目录和输出
+        os.makedirs(os.path.join(log_dir, 'logs'))
+        cwd = os.getcwd()
+        os.chdir(log_dir)
+        try:
+            with open(os.devnull, 'w', encoding='utf-8') as devnull, contextlib.redirect_stdout(devnull):
+                res = asyncio.run(run_once(os.path.join(cwd, args.capture), args.tg_latency / 1000))
+        finally:
+            os.chdir(cwd)
+    print(json.dumps({'loop': event_loop, **res}))
+
+
+# ================= 解析性能（在子进程里跑） =================
+class CountingHandler(blivedm.HandlerInterface):
+    """只数收到的业务消息，不做其他处理"""
+
+    def __init__(self):
+        self.command_count = 0
+
+    def handle(self, client, command):
+        self.command_count += 1
+
+
+class ParseClient(blivedm.clients.ws_base.WebSocketClientBase):
+    """不连接，只用来调用 _parse_ws_message"""
+
+
+def get_json_backend(name: str):
+    if name == 'stdlib':
+        return blivedm.utils.stdlib_json_loads, blivedm.utils.stdlib_json_dumps
+    import orjson
+    return orjson.loads, orjson.dumps
+
+
+def decompress_frame(frame: bytes) -> bytes:
+    """解压后的业务消息包，用来单独测拆包和 JSON 解码，不受解压和线程切换影响"""
+    _, header_size, ver, _, _ = HEADER_STRUCT.unpack_from(frame)
+    if ver == 3:
+        return brotli.decompress(frame[header_size:])
+    if ver == 2:
+        return zlib.decompress(frame[header_size:])
+    return frame
+
+
+PARSE_PASSES = 5
+"""每个子进程解析几遍，取平均"""
+
+
+async def run_parse_once(frames_path: str, json_backend: str) -> dict:
+    with open(frames_path, 'rb') as f:
+        frames = pickle.load(f)
+    inner_frames = [decompress_frame(frame) for frame in frames]
+
+    async with aiohttp.ClientSession() as session:
+        client = ParseClient(session)
+        client._room_id = 1  # noqa
+        if json_backend != 'default':
+            client.set_json_backend(*get_json_backend(json_backend))
+        handler = CountingHandler()
+        client.set_handler(handler)
+
+        async def parse_all(frames_):
+            for frame in frames_:
+                await client._parse_ws_message(frame)  # noqa
+
+        # 预热
+        await parse_all(inner_frames[:10])
+        handler.command_count = 0
+
+        start_time = time.perf_counter()
+        for _ in range(PARSE_PASSES):
+            await parse_all(inner_frames)
+        inner_time = (time.perf_counter() - start_time) / PARSE_PASSES
+        command_count = handler.command_count // PARSE_PASSES
+
+        tracemalloc.start()
+        await parse_all(inner_frames)
+        _, peak_alloc = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        start_time = time.perf_counter()
+        for _ in range(PARSE_PASSES):
+            await parse_all(frames)
+        compressed_time = (time.perf_counter() - start_time) / PARSE_PASSES
+
+        await client.close()
+    return {
+        'frames': len(frames),
+        'commands': command_count,
+        'inner_time': inner_time,
+        'compressed_time': compressed_time,
+        'peak_alloc': peak_alloc,
+    }
+
+
+def parse_worker_main(args):
+    logging.getLogger('blivedm').setLevel(logging.WARNING)
+    if args.json != 'default' and not hasattr(ParseClient, 'set_json_backend'):
+        print(json.dumps({'error': 'set_json_backend() is not available'}))
+        return
+    res = asyncio.run(run_parse_once(args.capture, args.json))
+    print(json.dumps(res))
+
+
+def run_parse_worker(frames_path: str, blivedm_path: str, json_backend: str) -> dict:
+    env = {**os.environ, 'BENCHMARK_BLIVEDM_PATH': os.path.abspath(blivedm_path)}
+    output = subprocess.run(
+        [sys.executable, __file__, '--parse-worker', '--capture', frames_path, '--json', json_backend],
+        check=True, stdout=subprocess.PIPE, text=True, env=env,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def bench_payload_decode():
+    """单条消息的 JSON 解码耗时（微秒），json+decode 是原来 json.loads(body.decode('utf-8')) 的写法"""
+    rnd = random.Random(1)
+    payloads = {
+        'DANMU_MSG': json.dumps(make_danmaku(rnd, 0), ensure_ascii=False).encode('utf-8'),
+        'SEND_GIFT': json.dumps(make_gift(rnd, 1), ensure_ascii=False).encode('utf-8'),
+    }
+    decoders = {
+        'json+decode': lambda body: json.loads(bytes(body).decode('utf-8')),
+        'stdlib': blivedm.utils.stdlib_json_loads,
+    }
+    try:
+        import orjson
+        decoders['orjson'] = orjson.loads
+    except ImportError:
+        pass
+
+    for cmd, payload in payloads.items():
+        body = memoryview(payload)
+        times = []
+        for name, loads in decoders.items():
+            timer = timeit.Timer(lambda: loads(body))
+            number, _ = timer.autorange()
+            best = min(timer.repeat(5, number)) / number
+            times.append(f'{name}={best * 1e6:.1f}us')
+        print(f'{cmd:9} {len(payload)}B ' + ' '.join(times))
+
+
+def parse_main(args, capture: str):
+    frames = [bytes(frame.data) for frame in blivedm.read_frames(capture)]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        frames_path = os.path.join(tmp_dir, 'frames.pickle')
+        with open(frames_path, 'wb') as f:
+            pickle.dump(frames, f)
+
+        bench_payload_decode()
+        for blivedm_path in args.blivedm or ['.']:
+            for json_backend in ('default', 'stdlib', 'orjson'):
+                results = []
+                for _ in range(args.repeat):
+                    res = run_parse_worker(frames_path, blivedm_path, json_backend)
+                    if 'error' in res:
+                        break
+                    results.append(res)
+                if not results:
+                    # 旧版本不能换JSON后端
+                    continue
+                inner_time = statistics.median(res['inner_time'] for res in results)
+                compressed_time = statistics.median(res['compressed_time'] for res in results)
+                peak_alloc = statistics.median(res['peak_alloc'] for res in results)
+                res = results[0]
+                print(
+                    f'{blivedm_path} json={json_backend:7} frames={res["frames"]} commands={res["commands"]} '
+                    f'inner frames/s={res["frames"] / inner_time:.0f} '
+                    f'compressed frames/s={res["frames"] / compressed_time:.0f} '
+                    f'peak alloc={peak_alloc / 1024:.0f}KiB'
+                )
+
+
+# ================= 汇总 =================
+def run_worker(capture: str, loop: str, tg_latency: float) -> dict:
+    output = subprocess.run(
+        [sys.executable, __file__, '--worker', '--loop', loop, '--capture', capture, '--tg-latency', str(tg_latency)],
+        check=True, stdout=subprocess.PIPE, text=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='对比默认事件循环和 uvloop 跑机器人的性能，或者对比消息解析的性能')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--capture', help='CAPTURE_FILE 录制的文件')
+    source.add_argument('--synthetic', type=int, metavar='FRAMES', help='生成这么多个 WebSocket 消息的合成录制文件')
+    parser.add_argument('--commands-per-frame', type=int, default=10, help='合成的每个 WebSocket 消息里有几条业务消息')
+    parser.add_argument('--loop', choices=('both', 'asyncio', 'uvloop'), default='both')
+    parser.add_argument('--repeat', type=int, default=3, help='每种事件循环跑几轮，取中位数')
+    parser.add_argument('--tg-latency', type=float, default=0, help='Telegram 替身每个请求的延迟（毫秒）')
+    parser.add_argument('--parse', action='store_true', help='只测消息解析的性能')
+    parser.add_argument('--blivedm', action='append', metavar='PATH',
+                        help='--parse 模式测这个目录里的 blivedm，可以指定多次，默认当前目录')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--parse-worker', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--json', choices=('default', 'stdlib', 'orjson'), default='default', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        worker_main(args)
+        return
+    if args.parse_worker:
+        parse_worker_main(args)
+        return
+
+    capture = args.capture
+    tmp_dir = None
+    if capture is None:
+        tmp_dir = tempfile.TemporaryDirectory()
+        capture = os.path.join(tmp_dir.name, 'synthetic.bin')
+        write_synthetic_capture(capture, args.synthetic, commands_per_frame=args.commands_per_frame)
+
+    try:
+        if args.parse:
+            parse_main(args, capture)
+            return
+        loops = ('asyncio', 'uvloop') if args.loop == 'both' else (args.loop,)
+        for loop in loops:
+            results = []
+            for _ in range(args.repeat):
+                res = run_worker(capture, loop, args.tg_latency)
+                if 'error' in res:
+                    print(f'{loop}: {res["error"]}')
+                    break
+                results.append(res)
+            if not results:
+                continue
+            total_time = statistics.median(res['total_time'] for res in results)
+            replay_time = statistics.median(res['replay_time'] for res in results)
+            cpu_time = statistics.median(res['cpu_time'] for res in results)
+            res = results[0]
+            print(
+                f'{loop:8} frames={res["frames"]} commands={res["commands"]} posts={res["posts"]} '
+                f'replay={replay_time:.3f}s total={total_time:.3f}s cpu={cpu_time:.3f}s '
+                f'frames/s={res["frames"] / replay_time:.0f} posts/s={res["posts"] / total_time:.0f}'
+            )
+    finally:
+        if tmp_dir is not None:
+            tmp_dir.cleanup()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,8 @@
 # -*- coding: utf-8 -*-
 from .web import *
 from .open_live import *
+from .pool import *
+from .replay import *
+from .event_queue import *
+from .room_info_cache import *
+from .request_governor import *
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import concurrent.futures
+import dataclasses
+import threading
+import time
+import zlib
+from typing import *
+
+import brotli
+
+__all__ = (
+    'DecompressStats',
+    'DecompressScheduler',
+)
+
+# 和ws_base.ProtoVer一致，ws_base依赖本模块所以不能反过来导入
+BROTLI = 3
+DEFLATE = 2
+_DECOMPRESS_FUNCS = {
+    BROTLI: brotli.decompress,
+    DEFLATE: zlib.decompress,
+}
+
+
+@dataclasses.dataclass
+class DecompressStats:
+    """
+    解压统计
+    """
+
+    inline_count: int = 0
+    """在事件循环线程直接解压的次数"""
+    pool_count: int = 0
+    """放到线程池解压的次数"""
+    overflow_count: int = 0
+    """因为线程池排队太多而改成直接解压的次数"""
+    inline_total_time: float = 0.
+    """直接解压的总耗时（秒）"""
+    pool_total_time: float = 0.
+    """线程池解压的总耗时，包括排队和线程切换（秒）"""
+    pool_max_time: float = 0.
+    """线程池解压的最大耗时（秒）"""
+    queue_depth: int = 0
+    """当前线程池里排队和正在解压的任务数"""
+    inline_threshold: int = 0
+    """当前使用的直接解压阈值（压缩后字节数）"""
+
+
+class DecompressScheduler:
+    """
+    解压调度器，小的包体直接在事件循环线程解压，大的包体放到专用的有界线程池
+
+    对很小的包体来说，切换线程的开销比解压本身还大，所以不全放到线程池
+
+    :param inline_threshold: 压缩后小于这个字节数的包体直接解压，None表示根据测得的解压速度和线程切换开销自动调整
+    :param max_workers: 专用线程池的线程数
+    :param max_queue_size: 线程池里最多排队的任务数，超过后直接解压，相当于给网络协程施加背压
+    """
+
+    DEFAULT_INLINE_THRESHOLD = 4096
+    """自动调整时的初始阈值"""
+    MIN_INLINE_THRESHOLD = 256
+    MAX_INLINE_THRESHOLD = 256 * 1024
+    _EWMA_ALPHA = 0.05
+
+    def __init__(
+        self,
+        inline_threshold: Optional[int] = None,
+        max_workers: int = 2,
+        max_queue_size: int = 64,
+    ):
+        self._auto_threshold = inline_threshold is None
+        self._inline_threshold = self.DEFAULT_INLINE_THRESHOLD if inline_threshold is None else inline_threshold
+        self._max_workers = max_workers
+        self._max_queue_size = max_queue_size
+
+        self._executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+        """专用线程池，第一次用到时才创建"""
+        self._executor_lock = threading.Lock()
+        self._queue_depth = 0
+        self._stats = DecompressStats()
+
+        # 用于自动调整阈值
+        self._cost_per_byte: Optional[float] = None
+        """解压每个压缩后字节的耗时EWMA（秒）"""
+        self._handoff_overhead = 100e-6
+        """放到线程池的额外耗时EWMA（秒），初始值是个经验值"""
+
+    @property
+    def inline_threshold(self) -> int:
+        """
+        当前使用的直接解压阈值（压缩后字节数）
+        """
+        return self._inline_threshold
+
+    @property
+    def queue_depth(self) -> int:
+        """
+        当前线程池里排队和正在解压的任务数
+        """
+        return self._queue_depth
+
+    @property
+    def stats(self) -> DecompressStats:
+        """
+        解压统计的快照
+        """
+        return dataclasses.replace(self._stats, queue_depth=self._queue_depth, inline_threshold=self._inline_threshold)
+
+    async def decompress(self, ver: int, data: Union[bytes, memoryview]) -> bytes:
+        """
+        解压包体
+
+        :param ver: 协议版本，见ws_base.ProtoVer
+        :param data: 压缩后的包体
+        :return: 解压后的数据
+        """
+        func = _DECOMPRESS_FUNCS[ver]
+        size = len(data)
+
+        if size < self._inline_threshold:
+            start_time = time.perf_counter()
+            res = func(data)
+            cost = time.perf_counter() - start_time
+            self._stats.inline_count += 1
+            self._stats.inline_total_time += cost
+            self._update_cost_per_byte(cost, size)
+            return res
+
+        if self._queue_depth >= self._max_queue_size:
+            # 线程池忙不过来了，排队只会更慢
+            self._stats.overflow_count += 1
+            return func(data)
+
+        self._queue_depth += 1
+        start_time = time.perf_counter()
+        try:
+            res, work_cost = await asyncio.get_running_loop().run_in_executor(
+                self._get_executor(), self._run_and_measure, func, data
+            )
+        finally:
+            self._queue_depth -= 1
+        cost = time.perf_counter() - start_time
+
+        self._stats.pool_count += 1
+        self._stats.pool_total_time += cost
+        self._stats.pool_max_time = max(self._stats.pool_max_time, cost)
+        self._update_cost_per_byte(work_cost, size)
+        self._update_handoff_overhead(cost - work_cost)
+        return res
+
+    def shutdown(self):
+        """
+        关闭专用线程池，之后再用到时会重新创建
+        """
+        with self._executor_lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    def _get_executor(self) -> concurrent.futures.ThreadPoolExecutor:
+        if self._executor is None:
+            with self._executor_lock:
+                if self._executor is None:
+                    self._executor = concurrent.futures.ThreadPoolExecutor(
+                        self._max_workers, thread_name_prefix='blivedm-decompress'
+                    )
+        return self._executor
+
+    @staticmethod
+    def _run_and_measure(func, data):
+        start_time = time.perf_counter()
+        res = func(data)
+        return res, time.perf_counter() - start_time
+
+    def _update_cost_per_byte(self, cost: float, size: int):
+        if not self._auto_threshold or size == 0:
+            return
+        cost_per_byte = cost / size
+        if self._cost_per_byte is None:
+            self._cost_per_byte = cost_per_byte
+        else:
+            self._cost_per_byte += (cost_per_byte - self._cost_per_byte) * self._EWMA_ALPHA
+        self._update_inline_threshold()
+
+    def _update_handoff_overhead(self, overhead: float):
+        if not self._auto_threshold:
+            return
+        self._handoff_overhead += (max(overhead, 0.) - self._handoff_overhead) * self._EWMA_ALPHA
+        self._update_inline_threshold()
+
+    def _update_inline_threshold(self):
+        if self._cost_per_byte is None or self._cost_per_byte <= 0:
+            return
+        # 解压耗时和线程切换开销相当的包体大小，小于它的直接解压更划算
+        threshold = int(self._handoff_overhead / self._cost_per_byte)
+        self._inline_threshold = min(max(threshold, self.MIN_INLINE_THRESHOLD), self.MAX_INLINE_THRESHOLD)
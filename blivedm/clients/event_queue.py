@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import collections
+import dataclasses
+import enum
+import itertools
+from typing import *
+
+from .. import utils
+
+__all__ = (
+    'Priority',
+    'DropPolicy',
+    'EventQueueStats',
+    'EventQueue',
+)
+
+
+class Priority(enum.IntEnum):
+    """
+    消息优先级，数值越小越重要
+    """
+
+    HIGH = 0
+    """醒目留言、上舰、礼物"""
+    NORMAL = 1
+    """弹幕"""
+    LOW = 2
+    """进入房间、关注、点赞等互动消息"""
+
+
+class DropPolicy(enum.Enum):
+    DROP_OLDEST = 'drop_oldest'
+    """队列满时丢弃最早的消息"""
+    DROP_LOWEST_PRIORITY = 'drop_lowest_priority'
+    """队列满时丢弃优先级最低的类别里最早的消息，如果新消息的优先级更低则丢弃新消息"""
+    BLOCK = 'block'
+    """队列满时不丢消息，网络协程等待队列有空位再接收下一个WebSocket消息"""
+
+
+DEFAULT_CMD_PRIORITY: Dict[str, Priority] = {
+    'SUPER_CHAT_MESSAGE': Priority.HIGH,
+    'SUPER_CHAT_MESSAGE_DELETE': Priority.HIGH,
+    'GUARD_BUY': Priority.HIGH,
+    'USER_TOAST_MSG_V2': Priority.HIGH,
+    'SEND_GIFT': Priority.HIGH,
+    'LIVE_OPEN_PLATFORM_SUPER_CHAT': Priority.HIGH,
+    'LIVE_OPEN_PLATFORM_SUPER_CHAT_DEL': Priority.HIGH,
+    'LIVE_OPEN_PLATFORM_GUARD': Priority.HIGH,
+    'LIVE_OPEN_PLATFORM_SEND_GIFT': Priority.HIGH,
+
+    'DANMU_MSG': Priority.NORMAL,
+    'DANMU_MSG_MIRROR': Priority.NORMAL,
+    'LIVE_OPEN_PLATFORM_DM': Priority.NORMAL,
+    'LIVE_OPEN_PLATFORM_DM_MIRROR': Priority.NORMAL,
+
+    'INTERACT_WORD': Priority.LOW,
+    'INTERACT_WORD_V2': Priority.LOW,
+    'ENTRY_EFFECT': Priority.LOW,
+    'LIKE_INFO_V3_CLICK': Priority.LOW,
+    'LIKE_INFO_V3_UPDATE': Priority.LOW,
+    'ONLINE_RANK_COUNT': Priority.LOW,
+    'WATCHED_CHANGE': Priority.LOW,
+    'LIVE_OPEN_PLATFORM_LIKE': Priority.LOW,
+    'LIVE_OPEN_PLATFORM_LIVE_ROOM_ENTER': Priority.LOW,
+}
+"""默认的cmd -> 优先级，没列出的cmd用NORMAL"""
+
+
+@dataclasses.dataclass
+class EventQueueStats:
+    """
+    消息队列统计
+    """
+
+    put_count: int = 0
+    """放进队列的消息数"""
+    drop_count: int = 0
+    """丢弃的消息总数"""
+    drop_counts: Dict[str, int] = dataclasses.field(default_factory=dict)
+    """cmd -> 丢弃的消息数"""
+    size: int = 0
+    """当前队列里的消息数"""
+    max_size_reached: int = 0
+    """队列里消息数的最大值"""
+
+
+class EventQueue:
+    """
+    网络协程和消息处理器之间的有界消息队列
+
+    网络协程只负责把消息放进队列，由客户端的消费协程调用消息处理器。消息处理器处理不过来时按丢弃策略丢消息，内存占用不会无限增长。
+    消费者按收到的顺序取消息，优先级只决定队列满时先丢谁
+
+    一个队列只能给一个客户端用
+
+    :param max_size: 队列最多容纳的消息数
+    :param drop_policy: 队列满时的丢弃策略
+    :param cmd_priority: cmd -> 优先级，会覆盖DEFAULT_CMD_PRIORITY里的同名项
+    :param max_batch_size: 消费者一次最多取的消息数
+    """
+
+    def __init__(
+        self,
+        max_size: int = 1000,
+        drop_policy: DropPolicy = DropPolicy.DROP_LOWEST_PRIORITY,
+        cmd_priority: Optional[Dict[str, Priority]] = None,
+        max_batch_size: int = 100,
+    ):
+        if max_size <= 0:
+            raise ValueError('max_size must be positive')
+        self._max_size = max_size
+        self._drop_policy = drop_policy
+        self._cmd_priority = dict(DEFAULT_CMD_PRIORITY)
+        if cmd_priority is not None:
+            self._cmd_priority.update(cmd_priority)
+        self._max_batch_size = max_batch_size
+
+        self._queues: List[Deque[Tuple[int, str, dict]]] = [collections.deque() for _ in Priority]
+        """每个优先级一个(序号, cmd, 消息)的队列"""
+        self._seq = itertools.count()
+        self._size = 0
+        self._stats = EventQueueStats()
+
+        self._not_empty_event: Optional[asyncio.Event] = None
+        self._not_full_event: Optional[asyncio.Event] = None
+
+    @property
+    def size(self) -> int:
+        """
+        当前队列里的消息数
+        """
+        return self._size
+
+    @property
+    def max_size(self) -> int:
+        return self._max_size
+
+    @property
+    def drop_policy(self) -> DropPolicy:
+        return self._drop_policy
+
+    @property
+    def stats(self) -> EventQueueStats:
+        """
+        消息队列统计的快照
+        """
+        return dataclasses.replace(self._stats, drop_counts=dict(self._stats.drop_counts), size=self._size)
+
+    def get_priority(self, cmd: str) -> Priority:
+        """
+        返回cmd的优先级
+        """
+        return self._cmd_priority.get(utils.strip_cmd(cmd), Priority.NORMAL)
+
+    def put_batch(self, commands: List[dict]):
+        """
+        放进一批消息，队列满时按丢弃策略丢消息。BLOCK策略下不会丢，可能暂时超过max_size，调用者应该再调用wait_not_full
+
+        :param commands: 业务消息，按收到的顺序
+        """
+        for command in commands:
+            self._put(command)
+        self._stats.max_size_reached = max(self._stats.max_size_reached, self._size)
+        if self._size > 0 and self._not_empty_event is not None:
+            self._not_empty_event.set()
+
+    def _put(self, command: dict):
+        cmd = utils.strip_cmd(command.get('cmd', ''))
+        priority = self._cmd_priority.get(cmd, Priority.NORMAL)
+        self._stats.put_count += 1
+
+        if self._size >= self._max_size:
+            if self._drop_policy == DropPolicy.DROP_OLDEST:
+                self._drop_oldest(min(
+                    (queue for queue in self._queues if queue),
+                    key=lambda queue: queue[0][0]
+                ))
+            elif self._drop_policy == DropPolicy.DROP_LOWEST_PRIORITY:
+                lowest_priority = max(priority_ for priority_, queue in enumerate(self._queues) if queue)
+                if priority > lowest_priority:
+                    # 新消息比队列里的都不重要
+                    self._on_dropped(cmd)
+                    return
+                self._drop_oldest(self._queues[lowest_priority])
+
+        self._queues[priority].append((next(self._seq), cmd, command))
+        self._size += 1
+
+    def _drop_oldest(self, queue: Deque[Tuple[int, str, dict]]):
+        _, cmd, _ = queue.popleft()
+        self._size -= 1
+        self._on_dropped(cmd)
+
+    def _on_dropped(self, cmd: str):
+        self._stats.drop_count += 1
+        self._stats.drop_counts[cmd] = self._stats.drop_counts.get(cmd, 0) + 1
+
+    async def wait_not_full(self):
+        """
+        BLOCK策略下，等待队列有空位，其他策略马上返回
+        """
+        if self._drop_policy != DropPolicy.BLOCK:
+            return
+        while self._size >= self._max_size:
+            if self._not_full_event is None:
+                self._not_full_event = asyncio.Event()
+            self._not_full_event.clear()
+            await self._not_full_event.wait()
+
+    async def get_batch(self) -> List[dict]:
+        """
+        等待并取出一批消息，按收到的顺序
+        """
+        while self._size == 0:
+            if self._not_empty_event is None:
+                self._not_empty_event = asyncio.Event()
+            self._not_empty_event.clear()
+            await self._not_empty_event.wait()
+
+        res = []
+        while self._size > 0 and len(res) < self._max_batch_size:
+            # 取序号最小的，也就是最早收到的
+            queue = min(
+                (queue for queue in self._queues if queue),
+                key=lambda queue: queue[0][0]
+            )
+            _, _, command = queue.popleft()
+            self._size -= 1
+            res.append(command)
+
+        if self._not_full_event is not None and self._size < self._max_size:
+            self._not_full_event.set()
+        return res
+
+    def clear(self):
+        """
+        丢弃队列里所有消息，不计入丢弃统计
+        """
+        for queue in self._queues:
+            queue.clear()
+        self._size = 0
+        if self._not_full_event is not None:
+            self._not_full_event.set()
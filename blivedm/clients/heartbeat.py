@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+import weakref
+from typing import *
+
+__all__ = (
+    'HeartbeatHandle',
+    'HeartbeatScheduler',
+    'get_heartbeat_scheduler',
+)
+
+logger = logging.getLogger('blivedm')
+
+_loop_to_heartbeat_scheduler = weakref.WeakKeyDictionary()
+
+
+def get_heartbeat_scheduler() -> 'HeartbeatScheduler':
+    """
+    返回当前事件循环共用的心跳调度器
+    """
+    loop = asyncio.get_running_loop()
+    scheduler = _loop_to_heartbeat_scheduler.get(loop, None)
+    if scheduler is None:
+        scheduler = _loop_to_heartbeat_scheduler[loop] = HeartbeatScheduler(loop)
+    return scheduler
+
+
+class HeartbeatHandle:
+    """
+    注册到心跳调度器的定时任务，用法和asyncio.TimerHandle一样，不需要时调用cancel
+    """
+
+    __slots__ = ('_scheduler', '_interval', '_callback', '_due_time', '_cancelled')
+
+    def __init__(self, scheduler: 'HeartbeatScheduler', interval: float, callback: Callable[[], Optional[Awaitable]]):
+        self._scheduler = scheduler
+        self._interval = interval
+        self._callback = callback
+        self._due_time = 0.
+        self._cancelled = False
+
+    @property
+    def interval(self) -> float:
+        return self._interval
+
+    def cancelled(self) -> bool:
+        return self._cancelled
+
+    def cancel(self):
+        if not self._cancelled:
+            self._cancelled = True
+            self._scheduler._on_handle_cancelled()  # noqa
+
+
+class HeartbeatScheduler:
+    """
+    心跳调度器，一个事件循环里所有客户端的心跳共用一个定时器
+
+    每个任务第一次触发的时间是随机的，之后按固定间隔触发，这样大量房间的心跳不会挤在同一时刻。时间相差不到resolution的任务
+    合并成一批触发，一批只创建一个协程
+
+    一般用get_heartbeat_scheduler获取当前事件循环共用的实例
+
+    :param loop: 事件循环
+    :param resolution: 合并触发的时间精度（秒）
+    :param jitter: 第一次触发时间的随机范围，占间隔的比例。第一次在[interval * (1 - jitter), interval]之间触发
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, resolution: float = 1., jitter: float = 0.5):
+        self._loop = loop
+        self._resolution = resolution
+        self._jitter = jitter
+
+        self._heap: List[Tuple[float, int, HeartbeatHandle]] = []
+        """(触发时间, 序号, handle)的小顶堆，取消的handle延迟删除"""
+        self._seq = itertools.count()
+        self._active_count = 0
+        """没被取消的任务数"""
+        self._timer_handle: Optional[asyncio.TimerHandle] = None
+        self._timer_due_time = 0.
+        self._running_tasks: Set[asyncio.Task] = set()
+        """防止批量发送的协程被垃圾回收"""
+
+    @property
+    def active_count(self) -> int:
+        """
+        注册了还没取消的任务数
+        """
+        return self._active_count
+
+    def register(
+        self,
+        interval: float,
+        callback: Callable[[], Optional[Awaitable]],
+    ) -> HeartbeatHandle:
+        """
+        注册一个定时任务
+
+        :param interval: 触发间隔（秒）
+        :param callback: 到时间时在事件循环线程调用，可以返回一个awaitable，同一批的awaitable会在同一个协程里并发等待
+        :return: 用来取消的handle
+        """
+        handle = HeartbeatHandle(self, interval, callback)
+        handle._due_time = self._loop.time() + interval * (1 - self._jitter * random.random())  # noqa
+        heapq.heappush(self._heap, (handle._due_time, next(self._seq), handle))  # noqa
+        self._active_count += 1
+        self._schedule_timer()
+        return handle
+
+    def _on_handle_cancelled(self):
+        self._active_count -= 1
+        if self._active_count == 0:
+            # 没有任务了，不用再定时
+            self._heap.clear()
+            if self._timer_handle is not None:
+                self._timer_handle.cancel()
+                self._timer_handle = None
+
+    def _schedule_timer(self):
+        if not self._heap:
+            return
+        due_time = self._heap[0][0]
+        if self._timer_handle is not None:
+            if self._timer_due_time <= due_time + self._resolution:
+                # 现有的定时器不会晚太多
+                return
+            self._timer_handle.cancel()
+        self._timer_due_time = due_time
+        self._timer_handle = self._loop.call_at(due_time, self._on_timer)
+
+    def _on_timer(self):
+        self._timer_handle = None
+        now = self._loop.time()
+        deadline = now + self._resolution
+
+        awaitables = []
+        while self._heap and self._heap[0][0] <= deadline:
+            due_time, _, handle = heapq.heappop(self._heap)
+            if handle.cancelled():
+                continue
+
+            next_due_time = due_time + handle.interval
+            if next_due_time < now:
+                # 事件循环卡住太久了，从现在开始算，不要连续补发
+                next_due_time = now + handle.interval
+            handle._due_time = next_due_time  # noqa
+            heapq.heappush(self._heap, (handle._due_time, next(self._seq), handle))  # noqa
+
+            try:
+                res = handle._callback()  # noqa
+            except Exception:  # noqa
+                logger.exception('HeartbeatScheduler callback error:')
+                continue
+            if res is not None:
+                awaitables.append(res)
+
+        if awaitables:
+            task = self._loop.create_task(self._wait_awaitables(awaitables))
+            self._running_tasks.add(task)
+            task.add_done_callback(self._running_tasks.discard)
+
+        self._schedule_timer()
+
+    @staticmethod
+    async def _wait_awaitables(awaitables: List[Awaitable]):
+        results = await asyncio.gather(*awaitables, return_exceptions=True)
+        for res in results:
+            if isinstance(res, Exception):
+                logger.error('HeartbeatScheduler awaitable error:', exc_info=res)
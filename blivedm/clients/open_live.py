@@ -5,14 +5,17 @@ import hashlib
 import hmac
 import json
 import logging
+import time
 import uuid
 from typing import *
 
 import aiohttp
 
-from . import ws_base
+from . import heartbeat, ws_base
+from .. import utils
 
 __all__ = (
+    'GameHeartbeatBatcher',
     'OpenLiveClient',
 )
 
@@ -21,6 +24,199 @@ logger = logging.getLogger('blivedm')
 START_URL = 'https://live-open.biliapi.com/v2/app/start'
 HEARTBEAT_URL = 'https://live-open.biliapi.com/v2/app/heartbeat'
 END_URL = 'https://live-open.biliapi.com/v2/app/end'
+BATCH_HEARTBEAT_URL = 'https://live-open.biliapi.com/v2/app/batchHeartbeat'
+BATCH_HEARTBEAT_MAX_SIZE = 200
+"""一个批量心跳请求最多带的项目场次数"""
+GAME_STATE_FILE_VERSION = 1
+GAME_HEARTBEAT_TIMEOUT = 60
+"""项目超过这么久（秒）没有心跳会被服务器关闭，保存的项目场次超过这个时间就不用尝试恢复了"""
+
+
+def _request_open_live(
+    session: aiohttp.ClientSession, access_key_id: str, access_key_secret: str, url: str, body: dict
+):
+    """
+    发送签名的开放平台请求
+
+    :return: session.post返回的上下文管理器
+    """
+    body_bytes = json.dumps(body).encode('utf-8')
+    headers = {
+        'x-bili-accesskeyid': access_key_id,
+        'x-bili-content-md5': hashlib.md5(body_bytes).hexdigest(),
+        'x-bili-signature-method': 'HMAC-SHA256',
+        'x-bili-signature-nonce': uuid.uuid4().hex,
+        'x-bili-signature-version': '1.0',
+        'x-bili-timestamp': str(int(datetime.datetime.now().timestamp())),
+    }
+
+    str_to_sign = '\n'.join(
+        f'{key}:{value}'
+        for key, value in headers.items()
+    )
+    signature = hmac.new(
+        access_key_secret.encode('utf-8'), str_to_sign.encode('utf-8'), hashlib.sha256
+    ).hexdigest()
+    headers['Authorization'] = signature
+
+    headers['Content-Type'] = 'application/json'
+    headers['Accept'] = 'application/json'
+    return session.post(url, headers=headers, data=body_bytes)
+
+
+def _get_game_state_key(app_id: int, room_owner_auth_code: str) -> str:
+    # 不在文件里保存明文的身份码
+    return hashlib.sha256(f'{app_id}:{room_owner_auth_code}'.encode('utf-8')).hexdigest()
+
+
+def _load_game_states(path: str) -> Dict[str, dict]:
+    """
+    从文件加载保存的项目场次
+
+    :return: 身份码的key -> 项目场次
+    """
+    try:
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logger.warning('failed to load game states from %s: %r', path, e)
+        return {}
+
+    if not isinstance(data, dict) or data.get('version', None) != GAME_STATE_FILE_VERSION:
+        logger.warning('unknown game state file version, path=%s', path)
+        return {}
+    games = data.get('games', None)
+    if not isinstance(games, dict):
+        logger.warning('failed to parse game states from %s', path)
+        return {}
+    return games
+
+
+def _update_game_state(path: str, key: str, state: Optional[dict]):
+    """
+    更新一个项目场次并保存，其他项目场次保持文件里的内容，所以多个客户端、进程可以共用一个文件
+
+    :param state: 项目场次，None表示删除
+    """
+    games = _load_game_states(path)
+    if state is not None:
+        games[key] = state
+    elif games.pop(key, None) is None:
+        return
+    try:
+        utils.write_json_file_atomically(path, {'version': GAME_STATE_FILE_VERSION, 'games': games})
+    except OSError as e:
+        logger.warning('failed to save game states to %s: %r', path, e)
+
+
+class GameHeartbeatBatcher:
+    """
+    把多个开放平台客户端的项目心跳合并成批量心跳请求，一个周期只发几个请求而不是每个客户端一个
+
+    同一个session、同一个access_key_id的客户端合并到一个请求里，心跳失败的项目场次交给对应的客户端重新开启项目。
+    一般一个事件循环里的客户端共用一个
+
+    :param interval: 发送批量心跳的间隔时间（秒）
+    :param max_batch_size: 一个请求最多带的项目场次数
+    """
+
+    def __init__(self, interval=20, max_batch_size=BATCH_HEARTBEAT_MAX_SIZE):
+        self._interval = interval
+        self._max_batch_size = max_batch_size
+
+        self._clients: Dict['OpenLiveClient', None] = {}
+        """要发心跳的客户端，用dict当有序集合"""
+        self._heartbeat_timer_handle: Optional[heartbeat.HeartbeatHandle] = None
+        """在心跳调度器注册的定时任务，有客户端时才注册"""
+
+    @property
+    def client_count(self) -> int:
+        return len(self._clients)
+
+    def add_client(self, client: 'OpenLiveClient'):
+        self._clients[client] = None
+        if self._heartbeat_timer_handle is None:
+            self._heartbeat_timer_handle = heartbeat.get_heartbeat_scheduler().register(
+                self._interval, self._on_send_heartbeat
+            )
+
+    def remove_client(self, client: 'OpenLiveClient'):
+        self._clients.pop(client, None)
+        if not self._clients and self._heartbeat_timer_handle is not None:
+            self._heartbeat_timer_handle.cancel()
+            self._heartbeat_timer_handle = None
+
+    def _on_send_heartbeat(self) -> Optional[Awaitable]:
+        """
+        定时发送批量心跳的回调，由心跳调度器调用
+        """
+        # (session, access_key_id, access_key_secret) -> game_id -> 客户端
+        groups: Dict[Tuple[aiohttp.ClientSession, str, str], Dict[str, OpenLiveClient]] = {}
+        for client in self._clients:
+            game_id = client.game_id
+            if game_id in (None, ''):
+                continue
+            key = (client._session, client._access_key_id, client._access_key_secret)  # noqa
+            groups.setdefault(key, {})[game_id] = client
+        if not groups:
+            return None
+
+        coros = []
+        for key, game_id_to_client in groups.items():
+            game_ids = list(game_id_to_client)
+            for i in range(0, len(game_ids), self._max_batch_size):
+                batch = {
+                    game_id: game_id_to_client[game_id]
+                    for game_id in game_ids[i:i + self._max_batch_size]
+                }
+                coros.append(self._send_heartbeat(*key, batch))
+        return asyncio.gather(*coros)
+
+    @staticmethod
+    async def _send_heartbeat(
+        session: aiohttp.ClientSession, access_key_id: str, access_key_secret: str,
+        game_id_to_client: Dict[str, 'OpenLiveClient']
+    ):
+        """
+        发送一个批量心跳请求
+        """
+        try:
+            async with _request_open_live(
+                session, access_key_id, access_key_secret,
+                BATCH_HEARTBEAT_URL,
+                {'game_ids': list(game_id_to_client)}
+            ) as res:
+                if res.status != 200:
+                    logger.warning('GameHeartbeatBatcher failed, status=%d, reason=%s', res.status, res.reason)
+                    return
+                data = await res.json()
+                if data['code'] != 0:
+                    logger.warning('GameHeartbeatBatcher failed, code=%d, message=%s, request_id=%s',
+                                   data['code'], data['message'], data['request_id'])
+                    return
+                failed_game_ids = (data.get('data', None) or {}).get('failed_game_ids', None) or []
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            logger.exception('GameHeartbeatBatcher failed:')
+            return
+
+        failed_game_ids = {str(game_id) for game_id in failed_game_ids}
+        now = time.time()
+        for game_id, client in game_id_to_client.items():
+            if game_id not in failed_game_ids and client.game_id == game_id:
+                client._game_alive_time = now  # noqa
+
+        coros = []
+        for game_id in failed_game_ids:
+            client = game_id_to_client.get(game_id, None)
+            if client is None:
+                continue
+            logger.warning('room=%s game heartbeat failed, game_id=%s', client.room_id, game_id)
+            # 传失败的场次ID，发请求期间客户端可能已经重新开启了项目
+            coros.append(client._on_game_ended(game_id))  # noqa
+        if coros:
+            await asyncio.gather(*coros)
 
 
 class OpenLiveClient(ws_base.WebSocketClientBase):
@@ -36,8 +232,13 @@ class OpenLiveClient(ws_base.WebSocketClientBase):
     :param session: cookie、连接池
     :param heartbeat_interval: 发送连接心跳包的间隔时间（秒）
     :param game_heartbeat_interval: 发送项目心跳包的间隔时间（秒）
+    :param game_state_file: 保存项目场次的文件。开启项目后保存，下次init_room时先用心跳检查上次的项目还在不在，在的话直接恢复，不用
+                            重新开启。设置后close不会关闭项目，但是也不再发项目心跳，所以只有在GAME_HEARTBEAT_TIMEOUT内重启才能
+                            恢复，否则服务器会关闭项目，下次重新开启。多个客户端可以共用一个文件
     """
 
+    _BUILTIN_CMDS = frozenset({'LIVE_OPEN_PLATFORM_INTERACTION_END'})
+
     def __init__(
         self,
         access_key_id: str,
@@ -48,6 +249,7 @@ class OpenLiveClient(ws_base.WebSocketClientBase):
         session: Optional[aiohttp.ClientSession] = None,
         heartbeat_interval=30,
         game_heartbeat_interval=20,
+        game_state_file: Optional[str] = None,
     ):
         super().__init__(session, heartbeat_interval)
 
@@ -56,6 +258,7 @@ class OpenLiveClient(ws_base.WebSocketClientBase):
         self._app_id = app_id
         self._room_owner_auth_code = room_owner_auth_code
         self._game_heartbeat_interval = game_heartbeat_interval
+        self._game_state_file = game_state_file
 
         # 在调用init_room后初始化的字段
         self._room_owner_uid: Optional[int] = None
@@ -68,10 +271,17 @@ class OpenLiveClient(ws_base.WebSocketClientBase):
         """连接弹幕服务器用的认证包内容"""
         self._game_id: Optional[str] = None
         """项目场次ID"""
+        self._game_alive_time: Optional[float] = None
+        """上次确认项目还在的时间戳（time.time），开启项目、项目心跳成功时更新"""
+
+        self._game_heartbeat_batcher: Optional[GameHeartbeatBatcher] = None
+        """批量发送项目心跳的聚合器，None表示单独发送"""
 
         # 在运行时初始化的字段
-        self._game_heartbeat_timer_handle: Optional[asyncio.TimerHandle] = None
-        """发项目心跳包定时器的handle"""
+        self._game_heartbeat_timer_handle: Optional[heartbeat.HeartbeatHandle] = None
+        """在心跳调度器注册的发项目心跳包定时任务"""
+        self._is_game_heartbeat_started = False
+        """是否已经开始发项目心跳，单独发送或者交给聚合器"""
 
     @property
     def room_owner_uid(self) -> Optional[int]:
@@ -108,6 +318,18 @@ class OpenLiveClient(ws_base.WebSocketClientBase):
         """
         return self._game_id
 
+    def set_game_heartbeat_batcher(self, batcher: Optional[GameHeartbeatBatcher]):
+        """
+        设置批量发送项目心跳的聚合器，设置后本客户端不再单独发项目心跳
+
+        :param batcher: 聚合器，多个客户端共用一个才有效果，None表示单独发送
+        """
+        is_game_heartbeat_started = self._is_game_heartbeat_started
+        self._stop_game_heartbeat()
+        self._game_heartbeat_batcher = batcher
+        if is_game_heartbeat_started:
+            self._start_game_heartbeat()
+
     async def close(self):
         """
         释放本客户端的资源，调用后本客户端将不可用
@@ -115,51 +337,48 @@ class OpenLiveClient(ws_base.WebSocketClientBase):
         if self.is_running:
             logger.warning('room=%s is calling close(), but client is running', self.room_id)
 
-        if self._game_heartbeat_timer_handle is not None:
-            self._game_heartbeat_timer_handle.cancel()
-            self._game_heartbeat_timer_handle = None
-        await self._end_game()
+        self._stop_game_heartbeat()
+        if self._game_state_file is None:
+            await self._end_game()
+        else:
+            # 保留项目，在服务器心跳超时之前重启的话可以恢复
+            self._save_game_alive_time()
+            logger.info('room=%s keeping game for resuming, game_id=%s', self.room_id, self._game_id)
 
         await super().close()
 
     def _request_open_live(self, url, body: dict):
-        body_bytes = json.dumps(body).encode('utf-8')
-        headers = {
-            'x-bili-accesskeyid': self._access_key_id,
-            'x-bili-content-md5': hashlib.md5(body_bytes).hexdigest(),
-            'x-bili-signature-method': 'HMAC-SHA256',
-            'x-bili-signature-nonce': uuid.uuid4().hex,
-            'x-bili-signature-version': '1.0',
-            'x-bili-timestamp': str(int(datetime.datetime.now().timestamp())),
-        }
-
-        str_to_sign = '\n'.join(
-            f'{key}:{value}'
-            for key, value in headers.items()
-        )
-        signature = hmac.new(
-            self._access_key_secret.encode('utf-8'), str_to_sign.encode('utf-8'), hashlib.sha256
-        ).hexdigest()
-        headers['Authorization'] = signature
-
-        headers['Content-Type'] = 'application/json'
-        headers['Accept'] = 'application/json'
-        return self._session.post(url, headers=headers, data=body_bytes)
+        return _request_open_live(self._session, self._access_key_id, self._access_key_secret, url, body)
 
     async def init_room(self):
         """
-        开启项目，并初始化连接房间需要的字段
+        开启项目，并初始化连接房间需要的字段。设置了game_state_file时先尝试恢复上次的项目
 
         :return: 是否成功
         """
-        if not await self._start_game():
+        if not await self._resume_game() and not await self._start_game():
             return False
 
-        if self._game_id != '' and self._game_heartbeat_timer_handle is None:
-            self._game_heartbeat_timer_handle = asyncio.get_running_loop().call_later(
+        if self._game_id != '':
+            self._start_game_heartbeat()
+        return True
+
+    def _start_game_heartbeat(self):
+        self._is_game_heartbeat_started = True
+        if self._game_heartbeat_batcher is not None:
+            self._game_heartbeat_batcher.add_client(self)
+        elif self._game_heartbeat_timer_handle is None:
+            self._game_heartbeat_timer_handle = heartbeat.get_heartbeat_scheduler().register(
                 self._game_heartbeat_interval, self._on_send_game_heartbeat
             )
-        return True
+
+    def _stop_game_heartbeat(self):
+        self._is_game_heartbeat_started = False
+        if self._game_heartbeat_batcher is not None:
+            self._game_heartbeat_batcher.remove_client(self)
+        if self._game_heartbeat_timer_handle is not None:
+            self._game_heartbeat_timer_handle.cancel()
+            self._game_heartbeat_timer_handle = None
 
     async def _start_game(self):
         try:
@@ -180,8 +399,94 @@ class OpenLiveClient(ws_base.WebSocketClientBase):
         except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
             logger.exception('_start_game() failed:')
             return False
+
+        self._game_alive_time = time.time()
+        if self._game_state_file is not None:
+            _update_game_state(self._game_state_file, self._game_state_key, {
+                'data': data['data'],
+                'alive_time': self._game_alive_time,
+            })
+        return True
+
+    @property
+    def _game_state_key(self):
+        return _get_game_state_key(self._app_id, self._room_owner_auth_code)
+
+    async def _resume_game(self):
+        """
+        从game_state_file恢复上次的项目，用心跳检查项目还在不在
+
+        :return: 是否恢复成功
+        """
+        if self._game_state_file is None:
+            return False
+        state = _load_game_states(self._game_state_file).get(self._game_state_key, None)
+        if state is None:
+            return False
+
+        try:
+            alive_time = float(state['alive_time'])
+            if self._game_alive_time is not None and state['data']['game_info']['game_id'] == self._game_id:
+                # 同一个进程里重新init_room，文件里的时间只在开启项目和close时写，内存里的是最新的
+                alive_time = max(alive_time, self._game_alive_time)
+            # 停止发心跳太久了，服务器已经关闭项目了
+            res = time.time() - alive_time < GAME_HEARTBEAT_TIMEOUT
+            if res:
+                res = self._parse_start_game(state['data'])
+        except (KeyError, TypeError, ValueError):
+            res = False
+        if res:
+            res = await self._check_game_alive()
+        if not res:
+            logger.info('room=%s failed to resume game, starting a new one', self.room_id)
+            self._forget_game_state()
+            return False
+
+        self._game_alive_time = time.time()
+        logger.info('room=%d resumed game, game_id=%s', self._room_id, self._game_id)
         return True
 
+    async def _check_game_alive(self):
+        """
+        发一次项目心跳，检查项目还在不在
+        """
+        try:
+            async with self._request_open_live(
+                HEARTBEAT_URL,
+                {'game_id': self._game_id}
+            ) as res:
+                if res.status != 200:
+                    logger.warning('room=%d _check_game_alive() failed, status=%d, reason=%s',
+                                   self._room_id, res.status, res.reason)
+                    return False
+                data = await res.json()
+                return data['code'] == 0
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            logger.exception('room=%d _check_game_alive() failed:', self._room_id)
+            return False
+
+    def _save_game_alive_time(self):
+        """
+        保存上次确认项目还在的时间，下次恢复前用来判断项目有没有心跳超时
+        """
+        if self._game_id in (None, '') or self._game_alive_time is None:
+            return
+        state = _load_game_states(self._game_state_file).get(self._game_state_key, None)
+        try:
+            if state is None or state['data']['game_info']['game_id'] != self._game_id:
+                return
+        except (KeyError, TypeError):
+            return
+        state['alive_time'] = self._game_alive_time
+        _update_game_state(self._game_state_file, self._game_state_key, state)
+
+    def _forget_game_state(self):
+        """
+        项目已经关闭了，下次不用再恢复
+        """
+        if self._game_state_file is not None:
+            _update_game_state(self._game_state_file, self._game_state_key, None)
+
     def _parse_start_game(self, data):
         self._game_id = data['game_info']['game_id']
         websocket_info = data['websocket_info']
@@ -195,7 +500,7 @@ class OpenLiveClient(ws_base.WebSocketClientBase):
 
     async def _end_game(self):
         """
-        关闭项目。建议关闭客户端时保证调用到这个函数（close会调用），否则可能短时间内无法重复连接同一个房间
+        关闭项目。建议关闭客户端时保证调用到这个函数（没设置game_state_file时close会调用），否则可能短时间内无法重复连接同一个房间
         """
         if self._game_id in (None, ''):
             return True
@@ -212,26 +517,23 @@ class OpenLiveClient(ws_base.WebSocketClientBase):
                 data = await res.json()
                 code = data['code']
                 if code != 0:
-                    if code in (7000, 7003):
-                        # 项目已经关闭了也算成功
-                        return True
-
-                    logger.warning('room=%d _end_game() failed, code=%d, message=%s, request_id=%s',
-                                   self._room_id, code, data['message'], data['request_id'])
-                    return False
+                    if code not in (7000, 7003):
+                        logger.warning('room=%d _end_game() failed, code=%d, message=%s, request_id=%s',
+                                       self._room_id, code, data['message'], data['request_id'])
+                        return False
+                    # 项目已经关闭了也算成功
         except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
             logger.exception('room=%d _end_game() failed:', self._room_id)
             return False
+
+        self._forget_game_state()
         return True
 
-    def _on_send_game_heartbeat(self):
+    def _on_send_game_heartbeat(self) -> Awaitable:
         """
-        定时发送项目心跳包的回调
+        定时发送项目心跳包的回调，由心跳调度器调用
         """
-        self._game_heartbeat_timer_handle = asyncio.get_running_loop().call_later(
-            self._game_heartbeat_interval, self._on_send_game_heartbeat
-        )
-        asyncio.create_task(self._send_game_heartbeat())
+        return self._send_game_heartbeat()
 
     async def _send_game_heartbeat(self):
         """
@@ -258,18 +560,30 @@ class OpenLiveClient(ws_base.WebSocketClientBase):
                     logger.warning('room=%d _send_game_heartbeat() failed, code=%d, message=%s, request_id=%s',
                                    self._room_id, code, data['message'], data['request_id'])
 
-                    if code == 7003 and self._game_id == game_id:
-                        # 项目异常关闭，可能是心跳超时，需要重新开启项目
-                        self._need_init_room = True
-                        if self._websocket is not None and not self._websocket.closed:
-                            await self._websocket.close()
-
+                    if code == 7003:
+                        await self._on_game_ended(game_id)
                     return False
         except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
             logger.exception('room=%d _send_game_heartbeat() failed:', self._room_id)
             return False
+        if self._game_id == game_id:
+            self._game_alive_time = time.time()
         return True
 
+    async def _on_game_ended(self, game_id: str):
+        """
+        项目异常关闭，可能是心跳超时，需要重新开启项目
+
+        :param game_id: 心跳失败的项目场次ID
+        """
+        if self._game_id != game_id:
+            # 已经重新开启了
+            return
+        self._forget_game_state()
+        self._need_init_room = True
+        if self._websocket is not None and not self._websocket.closed:
+            await self._websocket.close()
+
     async def _on_before_ws_connect(self, retry_count):
         """
         在每次建立连接之前调用，可以用来初始化房间
@@ -292,16 +606,21 @@ class OpenLiveClient(ws_base.WebSocketClientBase):
         """
         await self._websocket.send_bytes(self._make_packet(self._auth_body, ws_base.Operation.AUTH))
 
-    def _handle_command(self, command: dict):
-        cmd = command.get('cmd', '')
-        if cmd == 'LIVE_OPEN_PLATFORM_INTERACTION_END':
-            if command['data']['game_id'] == self._game_id:
-                # 服务器主动停止推送，可能是心跳超时，需要重新开启项目
-                logger.warning('room=%d game end by server, game_id=%s', self._room_id, self._game_id)
-
-                self._need_init_room = True
-                if self._websocket is not None and not self._websocket.closed:
-                    asyncio.create_task(self._websocket.close())
-            return
-
-        super()._handle_command(command)
+    def _handle_commands(self, commands: List[dict]):
+        remaining_commands = []
+        for command in commands:
+            cmd = command.get('cmd', '')
+            if cmd == 'LIVE_OPEN_PLATFORM_INTERACTION_END':
+                if command['data']['game_id'] == self._game_id:
+                    # 服务器主动停止推送，可能是心跳超时，需要重新开启项目
+                    logger.warning('room=%d game end by server, game_id=%s', self._room_id, self._game_id)
+
+                    self._forget_game_state()
+                    self._need_init_room = True
+                    if self._websocket is not None and not self._websocket.closed:
+                        asyncio.create_task(self._websocket.close())
+                continue
+            remaining_commands.append(command)
+
+        if remaining_commands:
+            super()._handle_commands(remaining_commands)
@@ -0,0 +1,488 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import dataclasses
+import enum
+import heapq
+import logging
+from typing import *
+
+import aiohttp
+
+from . import web, ws_base
+from .. import handlers, utils
+
+__all__ = (
+    'RoomStatus',
+    'RoomState',
+    'BLiveClientPool',
+)
+
+logger = logging.getLogger('blivedm')
+
+
+_get_jitter_interval = utils.make_exponential_jitter_retry_policy(1, 60)
+
+
+def _default_restart_policy(restart_count: int, _exception: Optional[Exception]) -> Optional[float]:
+    return _get_jitter_interval(restart_count, restart_count)
+
+
+DEFAULT_RESTART_POLICY = _default_restart_policy
+
+SHARED_INIT_MAX_RETRY_COUNT = 3
+"""共享初始化抛异常时最多重试几次，之后用uid=0启动房间"""
+
+
+class RoomStatus(enum.Enum):
+    PENDING = 'pending'
+    """等待共享初始化完成、按启动速率排队启动"""
+    RUNNING = 'running'
+    """客户端正在运行"""
+    BACKOFF = 'backoff'
+    """客户端异常停止了，等待重启"""
+    STOPPED = 'stopped'
+    """客户端停止了，不会再重启"""
+
+
+@dataclasses.dataclass
+class RoomState:
+    """
+    房间状态的快照
+    """
+
+    tmp_room_id: int
+    """添加房间时用的房间ID，可以是短ID"""
+    room_id: Optional[int]
+    """真实房间ID，客户端init_room后初始化"""
+    status: RoomStatus
+    restart_count: int
+    """连续重启次数，启动后收到消息（包括心跳回复）时清零"""
+    last_exception: Optional[Exception]
+    """上次异常停止的原因"""
+    next_restart_time: Optional[float]
+    """下次重启的事件循环时间，不在BACKOFF状态时为None"""
+    priority: int
+    """启动优先级，数值越小越先启动"""
+    start_delay: Optional[float]
+    """从开始排队到第一次启动的时间（秒），还没启动时为None"""
+    time_to_first_message: Optional[float]
+    """从开始排队到收到第一条业务消息的时间（秒），还没收到时为None"""
+
+
+class _Room:
+    def __init__(self, client: web.BLiveClient, priority: int):
+        self.client = client
+        self.priority = priority
+        self.status = RoomStatus.PENDING
+        self.restart_count = 0
+        self.last_exception: Optional[Exception] = None
+        self.next_restart_time: Optional[float] = None
+
+        self.queue_time: Optional[float] = None
+        """开始排队启动的事件循环时间"""
+        self.start_time: Optional[float] = None
+        """第一次启动的事件循环时间"""
+        self.first_message_time: Optional[float] = None
+        """收到第一条业务消息的事件循环时间"""
+
+
+class _PoolHandler:
+    """
+    包装用户的消息处理器，用来得知客户端停止，实现了handlers.HandlerInterface
+
+    handlers依赖clients，所以这里不能在导入时继承HandlerInterface
+    """
+
+    def __init__(self, pool: 'BLiveClientPool', handler: Optional['handlers.HandlerInterface']):
+        self._pool = pool
+        self._handler = handler
+
+    def handle(self, client: ws_base.WebSocketClientBase, command: dict):
+        if self._handler is not None:
+            self._handler.handle(client, command)
+
+    def handle_batch(self, client: ws_base.WebSocketClientBase, commands: List[dict]):
+        if client in self._pool._rooms_waiting_first_message:  # noqa
+            self._pool._on_first_message(client, commands)  # noqa
+        if self._handler is not None:
+            # 可能返回awaitable，要交给客户端等待
+            return self._handler.handle_batch(client, commands)
+        return None
+
+    def get_handled_cmds(self) -> Optional[AbstractSet[str]]:
+        if self._handler is None:
+            return set()
+        return self._handler.get_handled_cmds()
+
+    def on_client_stopped(self, client: ws_base.WebSocketClientBase, exception: Optional[Exception]):
+        self._pool._on_client_stopped(client, exception)  # noqa
+        if self._handler is not None:
+            self._handler.on_client_stopped(client, exception)
+
+
+class BLiveClientPool:
+    """
+    管理多个房间的web端客户端，所有房间共用一个session
+
+    - uid、buvid、wbi口令只初始化一次，所有客户端共享
+    - 客户端异常停止后，由一个监督协程统一按重启策略安排重启，不需要每个房间一个守护协程
+    - 房间按优先级、启动速率错开启动，房间很多时不会同一时刻发出大量初始化请求和WebSocket握手
+    - 可以在运行时添加、删除房间，查询每个房间的状态
+
+    :param session: cookie、连接池
+    :param restart_policy: 一个可调用对象，输入 (restart_count, exception)，返回重启前等待的时间（秒），返回None表示不再重启
+    :param retry_budget: 重启房间前要从这个重试预算取令牌，默认和客户端重连共用ws_base.DEFAULT_RETRY_BUDGET，None表示不限制
+    :param startup_rate: 每秒最多启动几个房间，None表示不限制
+    """
+
+    def __init__(
+        self,
+        *,
+        session: Optional[aiohttp.ClientSession] = None,
+        restart_policy: Callable[[int, Optional[Exception]], Optional[float]] = DEFAULT_RESTART_POLICY,
+        retry_budget: Optional[utils.RetryBudget] = ws_base.DEFAULT_RETRY_BUDGET,
+        startup_rate: Optional[float] = None,
+    ):
+        if session is None:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10))
+            self._own_session = True
+        else:
+            self._session = session
+            self._own_session = False
+        self._restart_policy = restart_policy
+        self._retry_budget = retry_budget
+        self._startup_rate = startup_rate
+
+        self._handler: Optional['handlers.HandlerInterface'] = None
+        self._pool_handler = _PoolHandler(self, None)
+        self._rooms: Dict[int, _Room] = {}
+        """tmp_room_id -> 房间"""
+        self._uid: Optional[int] = None
+        """共享初始化得到的用户ID"""
+        self._shared_init_done = False
+        self._rooms_waiting_first_message: Dict[ws_base.WebSocketClientBase, _Room] = {}
+        """已经（重新）启动、还没收到消息的房间，收到消息后清零连续重启次数，第一次启动时还用来统计收到第一条消息的时间"""
+
+        # 在运行时初始化的字段
+        self._supervisor_future: Optional[asyncio.Future] = None
+        """监督协程的future"""
+        self._restart_heap: List[Tuple[float, int]] = []
+        """(重启时间, tmp_room_id)的小顶堆"""
+        self._startup_heap: List[Tuple[int, int, int]] = []
+        """(优先级, 序号, tmp_room_id)的小顶堆，等待启动的房间"""
+        self._startup_seq = 0
+        """同一优先级的房间按添加顺序启动"""
+        self._next_startup_time = 0.
+        """按启动速率，下一个房间最早可以启动的事件循环时间"""
+        self._wakeup_event: Optional[asyncio.Event] = None
+        """有新的重启安排时唤醒监督协程"""
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        return self._session
+
+    @property
+    def is_running(self) -> bool:
+        """
+        监督协程正在运行
+        """
+        return self._supervisor_future is not None
+
+    @property
+    def clients(self) -> List[web.BLiveClient]:
+        return [room.client for room in self._rooms.values()]
+
+    def get_client(self, room_id: int) -> Optional[web.BLiveClient]:
+        """
+        :param room_id: 添加房间时用的房间ID
+        """
+        room = self._rooms.get(room_id, None)
+        return room.client if room is not None else None
+
+    def get_room_state(self, room_id: int) -> Optional[RoomState]:
+        """
+        :param room_id: 添加房间时用的房间ID
+        """
+        room = self._rooms.get(room_id, None)
+        if room is None:
+            return None
+        return RoomState(
+            tmp_room_id=room_id,
+            room_id=room.client.room_id,
+            status=room.status,
+            restart_count=room.restart_count,
+            last_exception=room.last_exception,
+            next_restart_time=room.next_restart_time,
+            priority=room.priority,
+            start_delay=(
+                room.start_time - room.queue_time
+                if room.start_time is not None and room.queue_time is not None else None
+            ),
+            time_to_first_message=(
+                room.first_message_time - room.queue_time
+                if room.first_message_time is not None and room.queue_time is not None else None
+            ),
+        )
+
+    def get_room_states(self) -> List[RoomState]:
+        return [self.get_room_state(room_id) for room_id in self._rooms]
+
+    def set_handler(self, handler: Optional['handlers.HandlerInterface']):
+        """
+        设置所有房间共用的消息处理器
+        """
+        self._handler = handler
+        self._pool_handler = _PoolHandler(self, handler)
+        for room in self._rooms.values():
+            room.client.set_handler(self._pool_handler)
+
+    def add_room(self, room_id: int, *, priority: int = 0, **client_kwargs) -> web.BLiveClient:
+        """
+        添加房间，如果池正在运行则排队启动
+
+        :param room_id: URL中的房间ID，可以用短ID
+        :param priority: 启动优先级，数值越小越先启动
+        :param client_kwargs: 传给BLiveClient构造函数的其他参数
+        :return: 房间的客户端，可以在启动前做其他设置
+        """
+        if room_id in self._rooms:
+            return self._rooms[room_id].client
+
+        if self._shared_init_done and 'uid' not in client_kwargs:
+            client_kwargs['uid'] = self._uid
+        client = web.BLiveClient(room_id, session=self._session, **client_kwargs)
+        client.set_handler(self._pool_handler)
+        room = self._rooms[room_id] = _Room(client, priority)
+
+        if self.is_running and self._shared_init_done:
+            self._queue_startup(room_id, room)
+            self._wakeup_event.set()
+        return client
+
+    async def remove_room(self, room_id: int):
+        """
+        停止并删除房间
+
+        :param room_id: 添加房间时用的房间ID
+        """
+        room = self._rooms.pop(room_id, None)
+        if room is None:
+            return
+        room.status = RoomStatus.STOPPED
+        self._rooms_waiting_first_message.pop(room.client, None)
+        await room.client.stop_and_close()
+
+    def start(self):
+        """
+        启动所有房间
+        """
+        if self.is_running:
+            logger.warning('BLiveClientPool is running, cannot start() again')
+            return
+
+        self._wakeup_event = asyncio.Event()
+        self._supervisor_future = asyncio.create_task(self._supervisor_coroutine_wrapper())
+
+    def stop(self):
+        """
+        停止监督协程和所有房间，之后可以再次start
+        """
+        if not self.is_running:
+            logger.warning('BLiveClientPool is stopped, cannot stop() again')
+            return
+
+        self._supervisor_future.cancel()
+
+    async def join(self):
+        """
+        等待池停止
+        """
+        if not self.is_running:
+            logger.warning('BLiveClientPool is stopped, cannot join()')
+            return
+
+        await asyncio.shield(self._supervisor_future)
+
+    async def stop_and_close(self):
+        """
+        便利函数，停止并释放所有房间的资源，调用后本池将不可用
+        """
+        if self.is_running:
+            self.stop()
+            await self.join()
+
+        rooms = list(self._rooms.values())
+        self._rooms.clear()
+        self._rooms_waiting_first_message.clear()
+        for room in rooms:
+            room.status = RoomStatus.STOPPED
+        await asyncio.gather(*(room.client.stop_and_close() for room in rooms))
+
+        if self._own_session:
+            await self._session.close()
+
+    async def _supervisor_coroutine_wrapper(self):
+        try:
+            await self._supervisor_coroutine()
+        except asyncio.CancelledError:
+            # 正常停止
+            pass
+        except Exception:  # noqa
+            logger.exception('BLiveClientPool _supervisor_coroutine() finished with exception:')
+        finally:
+            self._supervisor_future = None
+            # 再次start时重新启动
+            self._restart_heap.clear()
+            self._startup_heap.clear()
+            for room in self._rooms.values():
+                room.status = RoomStatus.PENDING
+                room.next_restart_time = None
+                if room.client.is_running:
+                    room.client.stop()
+
+    async def _supervisor_coroutine(self):
+        """
+        监督协程，负责共享初始化、按优先级和启动速率启动房间、按重启策略统一重启房间
+        """
+        if not self._shared_init_done:
+            await self._init_shared_with_retry()
+            self._shared_init_done = True
+            for room in self._rooms.values():
+                if room.client.uid is None:
+                    room.client._uid = self._uid  # noqa
+
+        for room_id, room in self._rooms.items():
+            if room.status == RoomStatus.PENDING:
+                self._queue_startup(room_id, room)
+
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            while self._startup_heap and self._next_startup_time <= now:
+                _, _, room_id = heapq.heappop(self._startup_heap)
+                room = self._rooms.get(room_id, None)
+                if room is None or room.status != RoomStatus.PENDING:
+                    # 排队的时候被删除了
+                    continue
+                self._start_room(room)
+                if self._startup_rate is not None:
+                    self._next_startup_time = now + 1 / self._startup_rate
+
+            while self._restart_heap and self._restart_heap[0][0] <= now:
+                _, room_id = heapq.heappop(self._restart_heap)
+                room = self._rooms.get(room_id, None)
+                if room is None or room.status != RoomStatus.BACKOFF:
+                    continue
+                if self._retry_budget is not None:
+                    await self._retry_budget.acquire()
+                    if room.status != RoomStatus.BACKOFF:
+                        # 等待的时候被删除了
+                        continue
+                self._start_room(room)
+
+            wakeup_times = []
+            if self._restart_heap:
+                wakeup_times.append(self._restart_heap[0][0])
+            if self._startup_heap:
+                wakeup_times.append(self._next_startup_time)
+            timeout = max(min(wakeup_times) - now, 0.) if wakeup_times else None
+            self._wakeup_event.clear()
+            try:
+                await asyncio.wait_for(self._wakeup_event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _init_shared_with_retry(self):
+        """
+        共享初始化抛异常时（比如风控返回了HTML页面）按重启策略重试，重试次数用完或者策略返回None时用uid=0启动房间，
+        不能因为一个请求失败所有房间都不启动
+        """
+        retry_count = 0
+        while True:
+            try:
+                await self._init_shared()
+                return
+            except Exception as e:  # noqa
+                retry_count += 1
+                interval = (
+                    self._restart_policy(retry_count, e) if retry_count <= SHARED_INIT_MAX_RETRY_COUNT else None
+                )
+                if interval is None:
+                    logger.exception('BLiveClientPool _init_shared() failed, retry_count=%d, starting rooms with'
+                                     ' uid=0:', retry_count)
+                    if self._uid is None:
+                        self._uid = 0
+                    return
+                logger.exception('BLiveClientPool _init_shared() failed, retry_count=%d, retrying in %.1fs:',
+                                 retry_count, interval)
+            await asyncio.sleep(interval)
+
+    async def _init_shared(self):
+        """
+        所有客户端共用的初始化，只请求一次
+        """
+        identity = web._get_session_identity(self._session)  # noqa
+        self._uid = await identity.get_uid()
+        if self._uid is None:
+            logger.warning('BLiveClientPool _get_uid() failed')
+            self._uid = 0
+
+        if not await identity.init_buvid():
+            logger.warning('BLiveClientPool _init_buvid() failed')
+
+        wbi_signer = web._get_wbi_signer(self._session)  # noqa
+        wbi_signer.start_auto_refresh()
+        if wbi_signer.need_refresh_wbi_key:
+            await wbi_signer.refresh_wbi_key()
+
+    def _queue_startup(self, room_id: int, room: _Room):
+        if room.queue_time is None:
+            room.queue_time = asyncio.get_running_loop().time()
+        heapq.heappush(self._startup_heap, (room.priority, self._startup_seq, room_id))
+        self._startup_seq += 1
+
+    def _start_room(self, room: _Room):
+        room.status = RoomStatus.RUNNING
+        room.next_restart_time = None
+        if room.start_time is None:
+            room.start_time = asyncio.get_running_loop().time()
+        self._rooms_waiting_first_message[room.client] = room
+        room.client.start()
+
+    def _on_first_message(self, client: ws_base.WebSocketClientBase, commands: List[dict]):
+        room = self._rooms_waiting_first_message.get(client, None)
+        if room is None:
+            return
+        # 收到消息说明连接、认证成功了
+        room.restart_count = 0
+        if room.first_message_time is None:
+            if all(command.get('cmd', None) == '_HEARTBEAT' for command in commands):
+                # 心跳回复是blivedm自造的消息，不算业务消息，继续等第一条业务消息
+                return
+            room.first_message_time = asyncio.get_running_loop().time()
+            logger.info(
+                'room=%d first message after %.1fs (queued %.1fs)', client.tmp_room_id,
+                room.first_message_time - room.queue_time, room.start_time - room.queue_time
+            )
+        del self._rooms_waiting_first_message[client]
+
+    def _on_client_stopped(self, client: ws_base.WebSocketClientBase, exception: Optional[Exception]):
+        room = self._rooms.get(client.tmp_room_id, None)
+        if room is None or room.client is not client or room.status != RoomStatus.RUNNING:
+            # 已经删除了或者是主动停止的
+            return
+        room.last_exception = exception
+        room.restart_count += 1
+        interval = self._restart_policy(room.restart_count, exception)
+        if interval is None:
+            logger.warning('room=%d stopped, restart_count=%d, not restarting', client.tmp_room_id,
+                           room.restart_count)
+            room.status = RoomStatus.STOPPED
+            return
+
+        logger.warning('room=%d stopped, restart_count=%d, restarting in %.1fs', client.tmp_room_id,
+                       room.restart_count, interval)
+        room.status = RoomStatus.BACKOFF
+        room.next_restart_time = asyncio.get_running_loop().time() + interval
+        heapq.heappush(self._restart_heap, (room.next_restart_time, client.tmp_room_id))
+        self._wakeup_event.set()
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import logging
+import struct
+import time
+from typing import *
+
+import aiohttp
+
+from . import ws_base
+
+__all__ = (
+    'CapturedFrame',
+    'FrameRecorder',
+    'read_frames',
+    'ReplayClient',
+)
+
+logger = logging.getLogger('blivedm')
+
+FILE_MAGIC = b'BLDMCAP1'
+"""录制文件的文件头"""
+RECORD_HEADER_STRUCT = struct.Struct('>dQI')
+"""每条记录的头：单调时钟时间戳（秒）、房间ID、数据长度"""
+
+
+class CapturedFrame(NamedTuple):
+    timestamp: float
+    """收到时的单调时钟时间戳（秒）"""
+    room_id: int
+    """房间ID，未初始化时为0"""
+    data: bytes
+    """WebSocket二进制消息的原始数据"""
+
+
+class FrameRecorder:
+    """
+    把客户端收到的WebSocket二进制消息追加到文件，可以用ReplayClient回放
+
+    多个客户端可以共用一个FrameRecorder
+
+    :param path: 录制文件路径，已存在的文件会在末尾追加
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+        self._file = open(path, 'ab')
+        if self._file.tell() == 0:
+            self._file.write(FILE_MAGIC)
+        self._frame_count = 0
+
+    @property
+    def path(self) -> str:
+        """
+        录制文件路径
+        """
+        return self._path
+
+    @property
+    def frame_count(self) -> int:
+        """
+        本次已录制的消息数
+        """
+        return self._frame_count
+
+    def write(self, room_id: Optional[int], data: Union[bytes, memoryview]):
+        """
+        追加一条消息
+
+        :param room_id: 房间ID
+        :param data: WebSocket二进制消息的原始数据
+        """
+        self._file.write(RECORD_HEADER_STRUCT.pack(time.monotonic(), room_id or 0, len(data)))
+        self._file.write(data)
+        self._frame_count += 1
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def read_frames(path: str) -> Iterator[CapturedFrame]:
+    """
+    读取录制文件
+
+    :param path: 录制文件路径
+    """
+    with open(path, 'rb') as f:
+        magic = f.read(len(FILE_MAGIC))
+        if magic != FILE_MAGIC:
+            raise ValueError(f'{path} is not a blivedm capture file')
+
+        while True:
+            record_header = f.read(RECORD_HEADER_STRUCT.size)
+            if len(record_header) < RECORD_HEADER_STRUCT.size:
+                # 录制时被中断的话最后一条可能不完整
+                return
+            timestamp, room_id, size = RECORD_HEADER_STRUCT.unpack(record_header)
+            data = f.read(size)
+            if len(data) < size:
+                return
+            yield CapturedFrame(timestamp, room_id, data)
+
+
+class ReplayClient(ws_base.WebSocketClientBase):
+    """
+    回放录制文件的客户端，不连接网络，把录制的消息按原来的时间间隔送进解析流程和消息处理器
+
+    用来离线复现线上负载，测试解析和消息处理的性能。回放结束后客户端会自动停止
+
+    :param path: 录制文件路径
+    :param speed: 回放速度倍数，1表示按原速，None或0表示不等待、尽快回放
+    :param room_id: 只回放这个房间的消息，None表示回放所有房间
+    :param session: cookie、连接池，回放不会用到网络，一般不用传
+    """
+
+    def __init__(
+        self,
+        path: str,
+        *,
+        speed: Optional[float] = 1,
+        room_id: Optional[int] = None,
+        session: Optional[aiohttp.ClientSession] = None,
+    ):
+        super().__init__(session)
+        self._path = path
+        self._speed = speed
+        self._filter_room_id = room_id
+
+        self._replayed_frame_count = 0
+        self._replay_duration = 0.
+
+    @property
+    def replayed_frame_count(self) -> int:
+        """
+        已回放的消息数
+        """
+        return self._replayed_frame_count
+
+    @property
+    def replay_duration(self) -> float:
+        """
+        上次回放用了多长时间（秒）
+        """
+        return self._replay_duration
+
+    async def init_room(self):
+        return True
+
+    async def _network_coroutine(self):
+        """
+        回放协程，代替网络协程
+        """
+        self._replayed_frame_count = 0
+        start_time = time.perf_counter()
+        first_frame_timestamp: Optional[float] = None
+        try:
+            for frame in read_frames(self._path):
+                if self._filter_room_id is not None and frame.room_id != self._filter_room_id:
+                    continue
+
+                if first_frame_timestamp is None:
+                    first_frame_timestamp = frame.timestamp
+                if self._speed:
+                    # 按原来的时间间隔等待
+                    delay = (
+                        (frame.timestamp - first_frame_timestamp) / self._speed
+                        - (time.perf_counter() - start_time)
+                    )
+                    await asyncio.sleep(max(delay, 0))
+                else:
+                    # 让出事件循环，让消息处理器创建的协程也能运行
+                    await asyncio.sleep(0)
+
+                self._room_id = frame.room_id
+                try:
+                    await self._parse_ws_message(frame.data)
+                except Exception:  # noqa
+                    logger.exception('room=%d _parse_ws_message() error:', self.room_id)
+                self._replayed_frame_count += 1
+        finally:
+            self._replay_duration = time.perf_counter() - start_time
+            logger.info('replay finished, path=%s, frames=%d, duration=%.3fs', self._path,
+                        self._replayed_frame_count, self._replay_duration)
+
+    def _get_ws_url(self, retry_count) -> str:
+        raise NotImplementedError('ReplayClient does not connect to the network')
+
+    async def _send_auth(self):
+        pass
@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import contextlib
+import dataclasses
+import logging
+from typing import *
+
+__all__ = (
+    'EndpointStats',
+    'RequestTicket',
+    'RequestGovernor',
+)
+
+logger = logging.getLogger('blivedm')
+
+THROTTLE_CODES = (-352, -412)
+"""B站风控返回的错误码"""
+
+
+@dataclasses.dataclass
+class EndpointStats:
+    """
+    一个接口的调速状态快照
+    """
+
+    rate: float
+    """当前允许的请求速率（次/秒）"""
+    is_throttled: bool
+    """是否正在风控冷却或者试探恢复"""
+    cooldown_remaining: float
+    """剩余的冷却时间（秒），冷却结束后先放少量试探请求"""
+    request_count: int
+    throttle_count: int
+    """被风控的次数"""
+
+
+class _EndpointState:
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.next_request_time = 0.
+        """下一个请求最早可以发出的事件循环时间"""
+        self.is_throttled = False
+        """风控冷却或者试探恢复中，冷却结束后只放canary_count个请求试探"""
+        self.cooldown = 0.
+        """上次的冷却时间，连续被风控时翻倍"""
+        self.cooldown_end_time = 0.
+        self.last_throttle_time = -1.
+        self.canary_in_flight = 0
+        """正在试探的请求数"""
+        self.state_changed_event: Optional[asyncio.Event] = None
+        """恢复、重新冷却、试探请求结束时唤醒等待的请求"""
+
+        self.request_count = 0
+        self.throttle_count = 0
+
+    def notify_state_changed(self):
+        if self.state_changed_event is not None:
+            self.state_changed_event.set()
+            self.state_changed_event = None
+
+
+class RequestTicket:
+    """
+    一次请求的许可，收到响应后调用check_response报告结果，网络错误等其他情况不用报告
+    """
+
+    def __init__(self, governor: 'RequestGovernor', endpoint: str, start_time: float, is_canary: bool):
+        self._governor = governor
+        self._endpoint = endpoint
+        self.start_time = start_time
+        self.is_canary = is_canary
+        """是否是风控冷却后的试探请求"""
+
+    def on_success(self):
+        self._governor._on_request_success(self)  # noqa
+
+    def on_throttled(self):
+        self._governor._on_request_throttled(self)  # noqa
+
+    def check_response(self, status: int, code: Optional[int] = None) -> bool:
+        """
+        根据HTTP状态码和接口返回的code报告结果
+
+        :return: 是否被风控
+        """
+        if status == 412 or code in THROTTLE_CODES:
+            self.on_throttled()
+            return True
+        if status == 200:
+            # 其他错误码也说明服务器正常响应了
+            self.on_success()
+        return False
+
+
+class RequestGovernor:
+    """
+    B站HTTP请求的AIMD调速器，同一个账号（session）的所有客户端共用一个，每个接口单独调速
+
+    - 平时按rate给请求排队，每次成功rate加上additive_increase
+    - 遇到-352、-412风控时rate乘以multiplicative_decrease，并暂停这个接口cooldown秒，连续被风控时冷却时间翻倍
+    - 冷却结束后只放canary_count个请求试探，试探成功才恢复放行其他请求
+
+    :param initial_rate: 每个接口初始的请求速率（次/秒）
+    :param min_rate: 最小请求速率
+    :param max_rate: 最大请求速率
+    :param additive_increase: 每次请求成功增加的速率
+    :param multiplicative_decrease: 被风控时速率乘以这个数
+    :param base_cooldown: 第一次被风控时暂停的时间（秒）
+    :param max_cooldown: 最长的暂停时间（秒）
+    :param canary_count: 冷却结束后同时试探的请求数
+    """
+
+    def __init__(
+        self,
+        *,
+        initial_rate: float = 5.,
+        min_rate: float = 0.2,
+        max_rate: float = 20.,
+        additive_increase: float = 0.2,
+        multiplicative_decrease: float = 0.5,
+        base_cooldown: float = 60.,
+        max_cooldown: float = 30 * 60.,
+        canary_count: int = 2,
+    ):
+        self._initial_rate = initial_rate
+        self._min_rate = min_rate
+        self._max_rate = max_rate
+        self._additive_increase = additive_increase
+        self._multiplicative_decrease = multiplicative_decrease
+        self._base_cooldown = base_cooldown
+        self._max_cooldown = max_cooldown
+        self._canary_count = canary_count
+
+        self._endpoints: Dict[str, _EndpointState] = {}
+
+    def get_stats(self) -> Dict[str, EndpointStats]:
+        """
+        接口名 -> 调速状态快照
+        """
+        now = asyncio.get_running_loop().time()
+        return {
+            endpoint: EndpointStats(
+                rate=state.rate,
+                is_throttled=state.is_throttled,
+                cooldown_remaining=max(state.cooldown_end_time - now, 0.),
+                request_count=state.request_count,
+                throttle_count=state.throttle_count,
+            )
+            for endpoint, state in self._endpoints.items()
+        }
+
+    def _get_state(self, endpoint: str) -> _EndpointState:
+        state = self._endpoints.get(endpoint, None)
+        if state is None:
+            state = self._endpoints[endpoint] = _EndpointState(self._initial_rate)
+        return state
+
+    @contextlib.asynccontextmanager
+    async def request(self, endpoint: str) -> AsyncIterator[RequestTicket]:
+        """
+        等待可以发请求，在with块里发请求并用返回的许可报告结果
+
+        :param endpoint: 接口名
+        """
+        ticket = await self._acquire(endpoint)
+        try:
+            yield ticket
+        finally:
+            self._release(ticket)
+
+    async def _acquire(self, endpoint: str) -> RequestTicket:
+        state = self._get_state(endpoint)
+        while True:
+            is_canary = await self._wait_not_throttled(state)
+            try:
+                if await self._wait_request_time(state, is_canary):
+                    break
+            except asyncio.CancelledError:
+                if is_canary:
+                    self._release_canary(state)
+                raise
+            # 排队的时候被风控了，重新等待
+            if is_canary:
+                self._release_canary(state)
+
+        state.request_count += 1
+        return RequestTicket(self, endpoint, asyncio.get_running_loop().time(), is_canary)
+
+    @staticmethod
+    async def _wait_request_time(state: _EndpointState, is_canary: bool) -> bool:
+        """
+        按速率排队。到时间时才占用下一个时间片，这样速率变化时马上生效
+
+        :return: 是否可以发请求，排队的时候被风控了则返回False
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            if state.cooldown_end_time > now or (state.is_throttled and not is_canary):
+                return False
+            if now >= state.next_request_time:
+                state.next_request_time = now + 1 / state.rate
+                return True
+            await asyncio.sleep(state.next_request_time - now)
+
+    async def _wait_not_throttled(self, state: _EndpointState) -> bool:
+        """
+        等待冷却结束，如果正在试探则等待试探名额
+
+        :return: 是否是试探请求
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            if state.cooldown_end_time > now:
+                await asyncio.sleep(state.cooldown_end_time - now)
+                continue
+            if not state.is_throttled:
+                return False
+            if state.canary_in_flight < self._canary_count:
+                state.canary_in_flight += 1
+                return True
+            # 等试探结果
+            if state.state_changed_event is None:
+                state.state_changed_event = asyncio.Event()
+            await state.state_changed_event.wait()
+
+    def _release(self, ticket: RequestTicket):
+        # 释放试探请求的名额
+        if ticket.is_canary:
+            ticket.is_canary = False
+            self._release_canary(self._get_state(ticket._endpoint))  # noqa
+
+    @staticmethod
+    def _release_canary(state: _EndpointState):
+        state.canary_in_flight -= 1
+        # 这个试探没有结果，让其他请求继续试探
+        state.notify_state_changed()
+
+    def _on_request_success(self, ticket: RequestTicket):
+        state = self._get_state(ticket._endpoint)  # noqa
+        state.rate = min(state.rate + self._additive_increase, self._max_rate)
+        if state.is_throttled and ticket.is_canary:
+            state.is_throttled = False
+            state.cooldown = 0.
+            logger.info('RequestGovernor endpoint=%s recovered, rate=%.2f', ticket._endpoint, state.rate)  # noqa
+            self._on_recovered(ticket._endpoint)  # noqa
+            state.notify_state_changed()
+
+    def _on_request_throttled(self, ticket: RequestTicket):
+        state = self._get_state(ticket._endpoint)  # noqa
+        state.throttle_count += 1
+        if ticket.start_time <= state.last_throttle_time:
+            # 这个请求是在上次降速之前发的，不用重复降速
+            return
+
+        loop = asyncio.get_running_loop()
+        state.rate = max(state.rate * self._multiplicative_decrease, self._min_rate)
+        if state.is_throttled:
+            state.cooldown = min(max(state.cooldown * 2, self._base_cooldown), self._max_cooldown)
+        else:
+            state.cooldown = self._base_cooldown
+        state.is_throttled = True
+        state.last_throttle_time = loop.time()
+        state.cooldown_end_time = state.last_throttle_time + state.cooldown
+        logger.warning('RequestGovernor endpoint=%s throttled, rate=%.2f, cooling down for %.0fs',
+                       ticket._endpoint, state.rate, state.cooldown)  # noqa
+        self._on_throttled(ticket._endpoint, state.cooldown)  # noqa
+        state.notify_state_changed()
+
+    def _on_throttled(self, endpoint: str, cooldown: float):
+        """
+        接口被风控时调用，可以重载用来发通知
+
+        :param endpoint: 接口名
+        :param cooldown: 这次暂停的时间（秒）
+        """
+
+    def _on_recovered(self, endpoint: str):
+        """
+        接口试探成功、恢复请求时调用，可以重载用来发通知
+
+        :param endpoint: 接口名
+        """
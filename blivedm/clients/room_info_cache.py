@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import json
+import logging
+import time
+from typing import *
+
+from .. import utils
+
+__all__ = (
+    'RoomInfo',
+    'RoomInfoCache',
+)
+
+logger = logging.getLogger('blivedm')
+
+FILE_VERSION = 1
+
+
+class RoomInfo(NamedTuple):
+    room_id: int
+    """真实房间ID"""
+    owner_uid: int
+    """主播用户ID"""
+    fetch_time: float
+    """从服务器获取的时间戳（time.time）"""
+
+
+class RoomInfoCache:
+    """
+    房间元数据的磁盘缓存，把URL中的房间ID（可以是短ID）映射到真实房间ID和主播用户ID
+
+    这些数据基本不会变，缓存后重启、重新init_room时不用再请求，可以减少启动时间和触发风控的请求量。超过revalidate_after的缓存
+    还会直接用，同时在后台重新请求更新
+
+    多个进程可以共用一个缓存文件，保存时会先合并文件里其他进程写的内容
+
+    :param path: 缓存文件路径，None表示只缓存在内存里
+    :param ttl: 缓存的有效期（秒），过期了必须重新请求
+    :param revalidate_after: 缓存超过这个时间（秒）后在后台重新请求
+    """
+
+    def __init__(self, path: Optional[str] = None, ttl: float = 7 * 24 * 3600, revalidate_after: float = 24 * 3600):
+        self._path = path
+        self._ttl = ttl
+        self._revalidate_after = revalidate_after
+
+        self._rooms: Dict[int, RoomInfo] = {}
+        """URL中的房间ID -> 房间元数据"""
+        self._revalidating_room_ids: Set[int] = set()
+        """正在后台更新的房间ID，避免重复请求"""
+        self._revalidate_tasks: Set[asyncio.Task] = set()
+        """防止后台更新的协程被垃圾回收"""
+
+        if self._path is not None:
+            self._rooms.update(self._load())
+
+    @property
+    def path(self) -> Optional[str]:
+        return self._path
+
+    def get(self, tmp_room_id: int) -> Optional[RoomInfo]:
+        """
+        返回没过期的房间元数据
+
+        :param tmp_room_id: URL中的房间ID，可以是短ID
+        """
+        room_info = self._rooms.get(tmp_room_id, None)
+        if room_info is None or time.time() - room_info.fetch_time >= self._ttl:
+            return None
+        return room_info
+
+    def put(self, tmp_room_id: int, room_id: int, owner_uid: int):
+        """
+        更新房间元数据并保存到磁盘
+
+        :param tmp_room_id: URL中的房间ID，可以是短ID
+        :param room_id: 真实房间ID
+        :param owner_uid: 主播用户ID
+        """
+        self._rooms[tmp_room_id] = RoomInfo(room_id, owner_uid, time.time())
+        if self._path is not None:
+            self._save()
+
+    def need_revalidate(self, room_info: RoomInfo) -> bool:
+        return time.time() - room_info.fetch_time >= self._revalidate_after
+
+    def revalidate(self, tmp_room_id: int, fetch: Callable[[], Awaitable[Optional[Tuple[int, int]]]]):
+        """
+        在后台重新请求房间元数据，同一个房间同时只会有一个请求
+
+        :param tmp_room_id: URL中的房间ID，可以是短ID
+        :param fetch: 请求房间元数据的函数，返回 (真实房间ID, 主播用户ID)，失败返回None
+        """
+        if tmp_room_id in self._revalidating_room_ids:
+            return
+        self._revalidating_room_ids.add(tmp_room_id)
+        task = asyncio.create_task(self._revalidate(tmp_room_id, fetch))
+        self._revalidate_tasks.add(task)
+        task.add_done_callback(self._revalidate_tasks.discard)
+
+    async def _revalidate(self, tmp_room_id: int, fetch: Callable[[], Awaitable[Optional[Tuple[int, int]]]]):
+        try:
+            res = await fetch()
+            if res is not None:
+                self.put(tmp_room_id, *res)
+        except Exception:  # noqa
+            logger.exception('room=%d RoomInfoCache revalidate failed:', tmp_room_id)
+        finally:
+            self._revalidating_room_ids.discard(tmp_room_id)
+
+    def _load(self) -> Dict[int, RoomInfo]:
+        try:
+            with open(self._path, encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning('RoomInfoCache failed to load %s: %r', self._path, e)
+            return {}
+
+        if not isinstance(data, dict) or data.get('version', None) != FILE_VERSION:
+            logger.warning('RoomInfoCache unknown file version, path=%s', self._path)
+            return {}
+        rooms = {}
+        try:
+            for tmp_room_id, room_info in data['rooms'].items():
+                rooms[int(tmp_room_id)] = RoomInfo(
+                    int(room_info['room_id']), int(room_info['owner_uid']), float(room_info['fetch_time'])
+                )
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            logger.warning('RoomInfoCache failed to parse %s: %r', self._path, e)
+            return {}
+        return rooms
+
+    def _save(self):
+        # 合并其他进程写的内容，同一个房间取新的
+        rooms = self._load()
+        for tmp_room_id, room_info in self._rooms.items():
+            old_room_info = rooms.get(tmp_room_id, None)
+            if old_room_info is None or old_room_info.fetch_time <= room_info.fetch_time:
+                rooms[tmp_room_id] = room_info
+        self._rooms = rooms
+
+        data = {
+            'version': FILE_VERSION,
+            'rooms': {
+                str(tmp_room_id): room_info._asdict()
+                for tmp_room_id, room_info in rooms.items()
+            },
+        }
+        try:
+            utils.write_json_file_atomically(self._path, data)
+        except OSError as e:
+            logger.warning('RoomInfoCache failed to save %s: %r', self._path, e)
@@ -1,8 +1,12 @@
 # -*- coding: utf-8 -*-
 import asyncio
+import base64
+import collections
 import datetime
 import hashlib
+import json
 import logging
+import time
 import urllib
 import weakref
 from typing import *
@@ -10,8 +14,12 @@ from typing import *
 import aiohttp
 import yarl
 
-from . import ws_base
+from . import request_governor as request_governor_mod, room_info_cache as room_info_cache_mod, ws_base
 from .. import utils
+from ..models import pb
+
+if TYPE_CHECKING:
+    from .. import handlers
 
 __all__ = (
     'BLiveClient',
@@ -27,8 +35,15 @@ DANMAKU_SERVER_CONF_URL = 'https://api.live.bilibili.com/xlive/web-room/v1/index
 DEFAULT_DANMAKU_SERVER_LIST = [
     {'host': 'broadcastlv.chat.bilibili.com', 'port': 2243, 'wss_port': 443, 'ws_port': 2244}
 ]
+DANMU_INFO_TTL = 60 * 60
+"""弹幕服务器列表和token的缓存时间（秒），认证失败时会提前失效"""
+DANMU_INFO_MAX_CONCURRENT_REQUESTS = 4
+"""同一个session同时请求弹幕服务器列表的最大数量"""
 
 _session_to_wbi_signer = weakref.WeakKeyDictionary()
+_session_to_identity = weakref.WeakKeyDictionary()
+_session_to_danmu_info_cache = weakref.WeakKeyDictionary()
+_session_to_request_governor = weakref.WeakKeyDictionary()
 
 
 def _get_wbi_signer(session: aiohttp.ClientSession) -> '_WbiSigner':
@@ -38,6 +53,179 @@ def _get_wbi_signer(session: aiohttp.ClientSession) -> '_WbiSigner':
     return wbi_signer
 
 
+def _get_session_identity(session: aiohttp.ClientSession) -> '_SessionIdentity':
+    identity = _session_to_identity.get(session, None)
+    if identity is None:
+        identity = _session_to_identity[session] = _SessionIdentity(session)
+    return identity
+
+
+def _get_danmu_info_cache(session: aiohttp.ClientSession) -> '_DanmuInfoCache':
+    danmu_info_cache = _session_to_danmu_info_cache.get(session, None)
+    if danmu_info_cache is None:
+        danmu_info_cache = _session_to_danmu_info_cache[session] = _DanmuInfoCache()
+    return danmu_info_cache
+
+
+def _get_request_governor(session: aiohttp.ClientSession) -> request_governor_mod.RequestGovernor:
+    governor = _session_to_request_governor.get(session, None)
+    if governor is None:
+        governor = _session_to_request_governor[session] = request_governor_mod.RequestGovernor()
+    return governor
+
+
+async def _get_uid(session: aiohttp.ClientSession) -> Optional[int]:
+    """
+    获取当前登录的用户ID
+
+    :return: 用户ID，未登录则为0，失败则为None
+    """
+    cookies = session.cookie_jar.filter_cookies(yarl.URL(UID_INIT_URL))
+    sessdata_cookie = cookies.get('SESSDATA', None)
+    if sessdata_cookie is None or sessdata_cookie.value == '':
+        # cookie都没有，不用请求了
+        return 0
+
+    try:
+        async with _get_request_governor(session).request('nav') as ticket, session.get(
+            UID_INIT_URL,
+            headers={'User-Agent': utils.USER_AGENT},
+        ) as res:
+            if res.status != 200:
+                ticket.check_response(res.status)
+                logger.warning('_get_uid() failed, status=%d, reason=%s', res.status, res.reason)
+                return None
+            data = await res.json()
+            ticket.check_response(res.status, data['code'])
+            if data['code'] != 0:
+                if data['code'] == -101:
+                    # 未登录
+                    return 0
+                logger.warning('_get_uid() failed, message=%s', data['message'])
+                return None
+
+            data = data['data']
+            if not data['isLogin']:
+                # 未登录
+                return 0
+            return data['mid']
+    except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+        logger.exception('_get_uid() failed:')
+        return None
+
+
+def _get_buvid(session: aiohttp.ClientSession) -> str:
+    cookies = session.cookie_jar.filter_cookies(yarl.URL(BUVID_INIT_URL))
+    buvid_cookie = cookies.get('buvid3', None)
+    if buvid_cookie is None:
+        return ''
+    return buvid_cookie.value
+
+
+async def _init_buvid(session: aiohttp.ClientSession) -> bool:
+    """
+    访问主页获取buvid，buvid保存在session的cookie里
+
+    :return: 是否成功
+    """
+    try:
+        async with _get_request_governor(session).request('buvid') as ticket, session.get(
+            BUVID_INIT_URL,
+            headers={'User-Agent': utils.USER_AGENT},
+        ) as res:
+            ticket.check_response(res.status)
+            if res.status != 200:
+                logger.warning('_init_buvid() status error, status=%d, reason=%s', res.status, res.reason)
+    except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+        logger.exception('_init_buvid() exception:')
+    return _get_buvid(session) != ''
+
+
+class _SessionIdentity:
+    """
+    同一个session的cookie是共用的，所以uid和buvid每个session只初始化一次。同时初始化的客户端共用一个请求
+    """
+
+    def __init__(self, session: aiohttp.ClientSession):
+        self._session = session
+
+        self._uid: Optional[int] = None
+        """当前登录的用户ID，未登录则为0，还没成功获取则为None"""
+        self._uid_future: Optional[asyncio.Future] = None
+        """用来避免同时请求"""
+        self._buvid_future: Optional[asyncio.Future] = None
+        """用来避免同时请求"""
+
+    async def get_uid(self) -> Optional[int]:
+        """
+        获取当前登录的用户ID
+
+        :return: 用户ID，未登录则为0，失败则为None，失败的不缓存
+        """
+        if self._uid is not None:
+            return self._uid
+        if self._uid_future is None:
+            self._uid_future = asyncio.create_task(self._do_get_uid())
+
+            def on_done(_fu):
+                self._uid_future = None
+            self._uid_future.add_done_callback(on_done)
+        # 一个客户端被取消了不影响其他客户端等待
+        return await asyncio.shield(self._uid_future)
+
+    async def _do_get_uid(self):
+        uid = await _get_uid(self._session)
+        if uid is not None:
+            self._uid = uid
+        return uid
+
+    async def init_buvid(self) -> bool:
+        """
+        如果cookie里没有buvid则访问主页获取
+
+        :return: 是否成功
+        """
+        if _get_buvid(self._session) != '':
+            return True
+        if self._buvid_future is None:
+            self._buvid_future = asyncio.create_task(_init_buvid(self._session))
+
+            def on_done(_fu):
+                self._buvid_future = None
+            self._buvid_future.add_done_callback(on_done)
+        return await asyncio.shield(self._buvid_future)
+
+
+async def _get_room_init_data(session: aiohttp.ClientSession, tmp_room_id: int) -> Optional[dict]:
+    """
+    请求房间信息
+
+    :return: 接口返回的data字段，失败则为None
+    """
+    try:
+        async with _get_request_governor(session).request('get_info') as ticket, session.get(
+            ROOM_INIT_URL,
+            headers={'User-Agent': utils.USER_AGENT},
+            params={
+                'room_id': tmp_room_id
+            },
+        ) as res:
+            if res.status != 200:
+                ticket.check_response(res.status)
+                logger.warning('room=%d _get_room_init_data() failed, status=%d, reason=%s', tmp_room_id,
+                               res.status, res.reason)
+                return None
+            data = await res.json()
+            ticket.check_response(res.status, data['code'])
+            if data['code'] != 0:
+                logger.warning('room=%d _get_room_init_data() failed, message=%s', tmp_room_id, data['message'])
+                return None
+            return data['data']
+    except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+        logger.exception('room=%d _get_room_init_data() failed:', tmp_room_id)
+        return None
+
+
 class _WbiSigner:
     WBI_KEY_INDEX_TABLE = [
         46, 47, 18, 2, 53, 8, 23, 32, 15, 50, 10, 31, 58, 3, 45, 35,
@@ -45,6 +233,11 @@ class _WbiSigner:
     ]
     """wbi密码表"""
     WBI_KEY_TTL = datetime.timedelta(hours=11, minutes=59, seconds=30)
+    WBI_KEY_REFRESH_AHEAD = datetime.timedelta(minutes=30)
+    """在口令过期前这么久开始在后台刷新"""
+    WBI_KEY_RETRY_INTERVAL = 60
+    """后台刷新失败后重试的间隔（秒）"""
+    KEY_FILE_VERSION = 1
 
     def __init__(self, session: aiohttp.ClientSession):
         self._session = session
@@ -54,6 +247,13 @@ class _WbiSigner:
         self._refresh_future: Optional[Awaitable] = None
         """用来避免同时刷新"""
         self._last_refresh_time: Optional[datetime.datetime] = None
+        self._rejected_wbi_key = ''
+        """服务器说签名错误的口令，从文件加载时不要再用"""
+
+        self._key_file: Optional[str] = None
+        """保存口令的文件，None表示只保存在内存里"""
+        self._auto_refresh_timer_handle: Optional[asyncio.TimerHandle] = None
+        """后台刷新的定时器"""
 
     @property
     def wbi_key(self):
@@ -63,9 +263,21 @@ class _WbiSigner:
         return self._wbi_key
 
     def reset(self):
+        if self._wbi_key != '':
+            self._rejected_wbi_key = self._wbi_key
         self._wbi_key = ''
         self._last_refresh_time = None
 
+    def set_key_file(self, path: Optional[str]):
+        """
+        设置保存口令的文件，设置后马上从文件加载。重启后不用再请求，多个进程可以共用一个文件
+        """
+        if path == self._key_file:
+            return
+        self._key_file = path
+        if path is not None:
+            self._load_key_file()
+
     @property
     def need_refresh_wbi_key(self):
         return self._wbi_key == '' or (
@@ -73,7 +285,54 @@ class _WbiSigner:
             and datetime.datetime.now() - self._last_refresh_time >= self.WBI_KEY_TTL
         )
 
-    def refresh_wbi_key(self) -> Awaitable:
+    @property
+    def _need_refresh_soon(self):
+        return self._last_refresh_time is None or (
+            datetime.datetime.now() - self._last_refresh_time >= self.WBI_KEY_TTL - self.WBI_KEY_REFRESH_AHEAD
+        )
+
+    def start_auto_refresh(self):
+        """
+        在口令过期前在后台刷新，连接房间时不用等待刷新。多次调用只会启动一个定时器
+        """
+        if self._auto_refresh_timer_handle is not None:
+            return
+        if self._last_refresh_time is None:
+            delay = 0.
+        else:
+            expire_time = self._last_refresh_time + self.WBI_KEY_TTL - self.WBI_KEY_REFRESH_AHEAD
+            delay = max((expire_time - datetime.datetime.now()).total_seconds(), 0.)
+        self._schedule_auto_refresh(delay)
+
+    def _schedule_auto_refresh(self, delay: float):
+        # 定时器只持有弱引用，否则session不用了以后签名器和session要等定时器触发才能被回收
+        self._auto_refresh_timer_handle = asyncio.get_running_loop().call_later(
+            delay, self._call_weak_method, weakref.WeakMethod(self._on_auto_refresh_timer)
+        )
+
+    @staticmethod
+    def _call_weak_method(method_ref: weakref.WeakMethod):
+        method = method_ref()
+        if method is not None:
+            method()
+
+    def _on_auto_refresh_timer(self):
+        self._auto_refresh_timer_handle = None
+        if self._session.closed:
+            # session关闭了，没有客户端在用了
+            return
+
+        def on_done(_fu):
+            if self._auto_refresh_timer_handle is not None or self._session.closed:
+                return
+            if self._need_refresh_soon:
+                # 刷新失败，过一会重试
+                self._schedule_auto_refresh(self.WBI_KEY_RETRY_INTERVAL)
+            else:
+                self.start_auto_refresh()
+        self.refresh_wbi_key().add_done_callback(on_done)
+
+    def refresh_wbi_key(self) -> asyncio.Future:
         if self._refresh_future is None:
             self._refresh_future = asyncio.create_task(self._do_refresh_wbi_key())
 
@@ -84,23 +343,79 @@ class _WbiSigner:
         return self._refresh_future
 
     async def _do_refresh_wbi_key(self):
+        # 其他进程可能已经刷新过了
+        if self._key_file is not None and self._load_key_file() and not self._need_refresh_soon:
+            return
+
         wbi_key = await self._get_wbi_key()
         if wbi_key == '':
             return
 
         self._wbi_key = wbi_key
         self._last_refresh_time = datetime.datetime.now()
+        self._rejected_wbi_key = ''
+        if self._key_file is not None:
+            self._save_key_file()
+
+    def _load_key_file(self) -> bool:
+        """
+        如果文件里的口令比内存里的新则使用文件里的
+
+        :return: 是否用了文件里的口令
+        """
+        try:
+            with open(self._key_file, encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError) as e:
+            logger.warning('WbiSigner failed to load %s: %r', self._key_file, e)
+            return False
+
+        try:
+            if data['version'] != self.KEY_FILE_VERSION:
+                logger.warning('WbiSigner unknown file version, path=%s', self._key_file)
+                return False
+            wbi_key = str(data['wbi_key'])
+            # 用时间戳保存，重启后也能判断是否过期
+            fetch_time = datetime.datetime.fromtimestamp(float(data['fetch_time']))
+        except (KeyError, TypeError, ValueError, OverflowError, OSError) as e:
+            logger.warning('WbiSigner failed to parse %s: %r', self._key_file, e)
+            return False
+
+        if (
+            wbi_key == '' or wbi_key == self._rejected_wbi_key
+            or datetime.datetime.now() - fetch_time >= self.WBI_KEY_TTL
+            or (self._last_refresh_time is not None and fetch_time <= self._last_refresh_time)
+        ):
+            return False
+        self._wbi_key = wbi_key
+        self._last_refresh_time = fetch_time
+        return True
+
+    def _save_key_file(self):
+        data = {
+            'version': self.KEY_FILE_VERSION,
+            'wbi_key': self._wbi_key,
+            'fetch_time': self._last_refresh_time.timestamp(),
+        }
+        try:
+            utils.write_json_file_atomically(self._key_file, data)
+        except OSError as e:
+            logger.warning('WbiSigner failed to save %s: %r', self._key_file, e)
 
     async def _get_wbi_key(self):
         try:
-            async with self._session.get(
+            async with _get_request_governor(self._session).request('nav') as ticket, self._session.get(
                 WBI_INIT_URL,
                 headers={'User-Agent': utils.USER_AGENT},
             ) as res:
                 if res.status != 200:
+                    ticket.check_response(res.status)
                     logger.warning('WbiSigner failed to get wbi key: status=%d %s', res.status, res.reason)
                     return ''
                 data = await res.json()
+                ticket.check_response(res.status, data.get('code', None))
         except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
             logger.exception('WbiSigner failed to get wbi key:')
             return ''
@@ -150,6 +465,299 @@ class _WbiSigner:
         }
 
 
+class _DanmuInfo(NamedTuple):
+    host_server_list: List[dict]
+    host_server_token: str
+    fetch_time: float
+    """获取的时间（time.monotonic）"""
+
+
+class _DanmuInfoCache:
+    """
+    按房间缓存getDanmuInfo返回的弹幕服务器列表和token，重连、重新init_room时直接用，认证失败了才重新请求
+
+    token和cookie有关，所以每个session一个缓存。所有客户端的请求共用一个并发限制，大量房间同时重连时不会一下子发出一堆请求
+    """
+
+    def __init__(self, max_concurrent_requests=DANMU_INFO_MAX_CONCURRENT_REQUESTS, ttl=DANMU_INFO_TTL):
+        self._max_concurrent_requests = max_concurrent_requests
+        self._ttl = ttl
+
+        self._infos: Dict[Tuple[int, int], _DanmuInfo] = {}
+        """(房间ID, 用户ID) -> 弹幕服务器列表和token"""
+        self._request_futures: Dict[Tuple[int, int], asyncio.Future] = {}
+        """用来避免同一个房间同时请求"""
+        self._request_semaphore: Optional[asyncio.Semaphore] = None
+        """限制同时请求的数量，在第一次请求时创建"""
+
+    def get(self, room_id: int, uid: int) -> Optional[_DanmuInfo]:
+        info = self._infos.get((room_id, uid), None)
+        if info is None or time.monotonic() - info.fetch_time >= self._ttl:
+            return None
+        return info
+
+    def invalidate(self, room_id: int, uid: int):
+        self._infos.pop((room_id, uid), None)
+
+    async def fetch(
+        self, room_id: int, uid: int, request: Callable[[], Awaitable[Optional[Tuple[List[dict], str]]]]
+    ) -> Optional[_DanmuInfo]:
+        """
+        请求并缓存弹幕服务器列表和token，同一个房间同时只会有一个请求
+
+        :param room_id: 真实房间ID
+        :param uid: 用户ID
+        :param request: 请求的函数，返回 (弹幕服务器列表, token)，失败返回None
+        :return: 失败返回None
+        """
+        key = (room_id, uid)
+        future = self._request_futures.get(key, None)
+        if future is None:
+            future = self._request_futures[key] = asyncio.create_task(self._do_fetch(key, request))
+
+            def on_done(_fu):
+                self._request_futures.pop(key, None)
+            future.add_done_callback(on_done)
+        # 一个客户端被取消了不影响其他客户端等待
+        return await asyncio.shield(future)
+
+    async def _do_fetch(
+        self, key: Tuple[int, int], request: Callable[[], Awaitable[Optional[Tuple[List[dict], str]]]]
+    ) -> Optional[_DanmuInfo]:
+        if self._request_semaphore is None:
+            self._request_semaphore = asyncio.Semaphore(self._max_concurrent_requests)
+        async with self._request_semaphore:
+            res = await request()
+        if res is None:
+            return None
+        info = self._infos[key] = _DanmuInfo(*res, time.monotonic())
+        return info
+
+
+class _HostStats:
+    __slots__ = ('connect_time', 'fail_count', 'last_probe_time')
+
+    def __init__(self):
+        self.connect_time: Optional[float] = None
+        """连接耗时的EWMA（秒），包括探测的TCP连接和实际的WebSocket握手"""
+        self.fail_count = 0
+        """连续失败次数，成功后清零"""
+        self.last_probe_time: Optional[float] = None
+
+
+class _HostRanker:
+    """
+    按连接耗时和失败次数给弹幕服务器排序，记住每个房间上次连接成功的服务器
+
+    弹幕服务器是所有房间共用的，所以统计数据整个进程共享
+    """
+
+    PROBE_TIMEOUT = 1.5
+    """探测TCP连接的超时时间（秒）"""
+    PROBE_TTL = 10 * 60
+    """探测结果的有效期（秒），过期了才重新探测"""
+    FAIL_PENALTY = 1.
+    """每次连续失败相当于多花的连接时间（秒）"""
+    UNKNOWN_CONNECT_TIME = 0.5
+    """没有数据时假设的连接耗时（秒）"""
+    _EWMA_ALPHA = 0.3
+
+    def __init__(self):
+        self._host_stats: Dict[str, _HostStats] = {}
+        """host key -> 统计"""
+        self._room_to_good_host: Dict[int, str] = {}
+        """房间ID -> 上次连接成功的host key"""
+
+    @staticmethod
+    def get_host_key(host_server: dict):
+        return f"{host_server['host']}:{host_server['wss_port']}"
+
+    def _get_stats(self, host_key: str) -> _HostStats:
+        stats = self._host_stats.get(host_key, None)
+        if stats is None:
+            stats = self._host_stats[host_key] = _HostStats()
+        return stats
+
+    async def probe(self, host_server_list: List[dict]):
+        """
+        探测没有数据或者数据过期的服务器的TCP连接耗时
+        """
+        now = time.monotonic()
+        to_probe = []
+        for host_server in host_server_list:
+            stats = self._get_stats(self.get_host_key(host_server))
+            if stats.last_probe_time is None or now - stats.last_probe_time >= self.PROBE_TTL:
+                # 先标记上，其他房间同时初始化时不会重复探测
+                stats.last_probe_time = now
+                to_probe.append(host_server)
+        if to_probe:
+            await asyncio.gather(*(self._probe_host(host_server) for host_server in to_probe))
+
+    async def _probe_host(self, host_server: dict):
+        host_key = self.get_host_key(host_server)
+        start_time = time.monotonic()
+        try:
+            _reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(host_server['host'], host_server['wss_port']), self.PROBE_TIMEOUT
+            )
+        except (OSError, asyncio.TimeoutError) as e:
+            logger.debug('probe host=%s failed: %r', host_key, e)
+            stats = self._get_stats(host_key)
+            stats.fail_count += 1
+            self._update_connect_time(stats, self.PROBE_TIMEOUT)
+            return
+        connect_time = time.monotonic() - start_time
+        writer.close()
+        self._update_connect_time(self._get_stats(host_key), connect_time)
+
+    def _update_connect_time(self, stats: _HostStats, connect_time: float):
+        if stats.connect_time is None:
+            stats.connect_time = connect_time
+        else:
+            stats.connect_time += (connect_time - stats.connect_time) * self._EWMA_ALPHA
+
+    def _get_score(self, host_key: str) -> float:
+        stats = self._get_stats(host_key)
+        connect_time = stats.connect_time if stats.connect_time is not None else self.UNKNOWN_CONNECT_TIME
+        return connect_time + stats.fail_count * self.FAIL_PENALTY
+
+    def choose(self, room_id: int, host_server_list: List[dict]) -> dict:
+        """
+        选择要连接的服务器，优先用这个房间上次连接成功的服务器，否则选分数最低的
+        """
+        good_host_key = self._room_to_good_host.get(room_id, None)
+        if good_host_key is not None:
+            for host_server in host_server_list:
+                if self.get_host_key(host_server) == good_host_key:
+                    return host_server
+        return min(host_server_list, key=lambda host_server: self._get_score(self.get_host_key(host_server)))
+
+    def on_connected(self, room_id: int, host_key: str, connect_time: float):
+        stats = self._get_stats(host_key)
+        stats.fail_count = 0
+        self._update_connect_time(stats, connect_time)
+        self._room_to_good_host[room_id] = host_key
+
+    def on_failed(self, room_id: int, host_key: str):
+        self._get_stats(host_key).fail_count += 1
+        if self._room_to_good_host.get(room_id, None) == host_key:
+            del self._room_to_good_host[room_id]
+
+
+_host_ranker = _HostRanker()
+
+
+def _get_danmaku_identity(command: dict):
+    info = command['info']
+    # extra里的id_str是弹幕的唯一ID，extra是JSON字符串，只为了去重没必要完整解析
+    mode_info = info[0][15]
+    if isinstance(mode_info, dict):
+        extra = mode_info.get('extra', '')
+        pos = extra.find('"id_str":"')
+        if pos != -1:
+            pos += len('"id_str":"')
+            end = extra.find('"', pos)
+            if end != -1:
+                return extra[pos:end]
+    # 旧版弹幕没有id_str
+    return info[0][5], info[0][4], info[2][0]
+
+
+def _get_guard_identity(command: dict):
+    data = command['data']
+    pay_info = data.get('pay_info', {})
+    if pay_info.get('payflow_id'):
+        return pay_info['payflow_id']
+    return data['sender_uinfo']['uid'], data['guard_info']['start_time'], data['option']['source']
+
+
+def _get_interact_word_v2_identity(command: dict):
+    # 没有唯一ID，用户、时间、互动类型都相同就认为是同一条
+    proto = pb.InteractWordV2.loads(base64.b64decode(command['data']['pb'], validate=True))
+    return proto.uid, proto.timestamp, proto.msg_type
+
+
+_CMD_IDENTITY_FUNC_DICT: Dict[str, Callable[[dict], Hashable]] = {
+    'DANMU_MSG': _get_danmaku_identity,
+    'SEND_GIFT': lambda command: command['data']['tid'],
+    'USER_TOAST_MSG_V2': _get_guard_identity,
+    'SUPER_CHAT_MESSAGE': lambda command: command['data']['id'],
+    'SUPER_CHAT_MESSAGE_DELETE': lambda command: tuple(command['data']['ids']),
+    'INTERACT_WORD': lambda command: (
+        command['data']['uid'], command['data']['trigger_time'], command['data']['msg_type']
+    ),
+    'INTERACT_WORD_V2': _get_interact_word_v2_identity,
+}
+"""cmd -> 返回消息唯一标识的函数，冗余连接去重用"""
+
+
+def _get_command_identity(command: dict) -> Optional[Hashable]:
+    """
+    返回消息的唯一标识，不知道怎么标识则返回None
+    """
+    cmd = utils.strip_cmd(command.get('cmd', ''))
+    identity_func = _CMD_IDENTITY_FUNC_DICT.get(cmd, None)
+    if identity_func is None:
+        return None
+    try:
+        return cmd, identity_func(command)
+    except (KeyError, IndexError, TypeError, AttributeError, ValueError, EOFError):
+        # ValueError、EOFError是base64、protobuf解码失败
+        return None
+
+
+class _DedupIndex:
+    """
+    有界的消息去重索引，只记住最近capacity条消息的标识
+    """
+
+    def __init__(self, capacity: int):
+        self._capacity = capacity
+        self._seen: collections.OrderedDict = collections.OrderedDict()
+        self.duplicate_count = 0
+        """去掉的重复消息数"""
+
+    def add(self, identity: Hashable) -> bool:
+        """
+        记住一个消息标识
+
+        :return: True表示第一次见到
+        """
+        if identity in self._seen:
+            self.duplicate_count += 1
+            return False
+        self._seen[identity] = None
+        if len(self._seen) > self._capacity:
+            self._seen.popitem(last=False)
+        return True
+
+
+class _StandbyHandler:
+    """
+    备用连接的消息处理器，把消息交给主客户端去重，实现了handlers.HandlerInterface
+    """
+
+    def __init__(self, primary: 'BLiveClient'):
+        self._primary = primary
+
+    def handle(self, client: ws_base.WebSocketClientBase, command: dict):
+        self._primary._on_standby_commands([command])  # noqa
+
+    def handle_batch(self, client: ws_base.WebSocketClientBase, commands: List[dict]):
+        self._primary._on_standby_commands(commands)  # noqa
+
+    def get_handled_cmds(self) -> Optional[AbstractSet[str]]:
+        handler = self._primary._handler  # noqa
+        if handler is None:
+            return set()
+        return handler.get_handled_cmds()
+
+    def on_client_stopped(self, client: ws_base.WebSocketClientBase, exception: Optional[Exception]):
+        if exception is not None:
+            logger.warning('room=%s standby client stopped: %r, will restart on next connect', client.room_id,
+                           exception)
+
+
 class BLiveClient(ws_base.WebSocketClientBase):
     """
     web端客户端
@@ -158,6 +766,11 @@ class BLiveClient(ws_base.WebSocketClientBase):
     :param uid: B站用户ID，0表示未登录，None表示自动获取
     :param session: cookie、连接池
     :param heartbeat_interval: 发送心跳包的间隔时间（秒）
+    :param redundant: 冗余模式，再连一个不同的弹幕服务器作为热备，两个连接收到的消息去重后交给消息处理器，一个连接断开时不会丢消息
+    :param dedup_capacity: 冗余模式下去重索引记住的消息数
+    :param room_info_cache: 房间元数据缓存，有缓存时init_room不用请求真实房间ID和主播用户ID，多个客户端可以共用一个缓存
+    :param wbi_key_file: 保存wbi口令的文件，重启后不用再请求。同一个session的客户端共用一个口令，设置一次即可
+    :param request_governor: B站HTTP请求的调速器，同一个session的客户端共用一个，设置一次即可。默认每个session自动创建一个
     """
 
     def __init__(
@@ -167,13 +780,33 @@ class BLiveClient(ws_base.WebSocketClientBase):
         uid: Optional[int] = None,
         session: Optional[aiohttp.ClientSession] = None,
         heartbeat_interval=30,
+        redundant=False,
+        dedup_capacity=4096,
+        room_info_cache: Optional[room_info_cache_mod.RoomInfoCache] = None,
+        wbi_key_file: Optional[str] = None,
+        request_governor: Optional[request_governor_mod.RequestGovernor] = None,
     ):
         super().__init__(session, heartbeat_interval)
         self._wbi_signer = _get_wbi_signer(self._session)
+        if wbi_key_file is not None:
+            self._wbi_signer.set_key_file(wbi_key_file)
+        if request_governor is not None:
+            _session_to_request_governor[self._session] = request_governor
+        self._identity = _get_session_identity(self._session)
+        self._danmu_info_cache = _get_danmu_info_cache(self._session)
 
         self._tmp_room_id = room_id
         """用来init_room的临时房间ID，可以用短ID"""
         self._uid = uid
+        self._room_info_cache = room_info_cache
+        """房间元数据缓存"""
+
+        self._primary: Optional[BLiveClient] = None
+        """如果本客户端是备用连接，则是主客户端"""
+        self._standby_client: Optional[BLiveClient] = None
+        """冗余模式下的备用连接，主客户端第一次连接成功后才启动"""
+        self._dedup_index: Optional[_DedupIndex] = _DedupIndex(dedup_capacity) if redundant else None
+        """冗余模式下的去重索引"""
 
         # 在调用init_room后初始化的字段
         self._room_owner_uid: Optional[int] = None
@@ -187,6 +820,14 @@ class BLiveClient(ws_base.WebSocketClientBase):
         self._host_server_token: Optional[str] = None
         """连接弹幕服务器用的token"""
 
+        # 在运行时初始化的字段
+        self._connecting_host_key: Optional[str] = None
+        """正在连接的弹幕服务器"""
+        self._connect_start_time = 0.
+        """开始连接的时间，用来统计连接耗时"""
+        self._is_host_connected = False
+        """这次连接是否成功"""
+
     @property
     def tmp_room_id(self) -> int:
         """
@@ -208,12 +849,41 @@ class BLiveClient(ws_base.WebSocketClientBase):
         """
         return self._uid
 
+    @property
+    def is_redundant(self) -> bool:
+        """
+        是否开启了冗余模式
+        """
+        return self._dedup_index is not None
+
+    @property
+    def duplicate_count(self) -> int:
+        """
+        冗余模式下去掉的重复消息数
+        """
+        return self._dedup_index.duplicate_count if self._dedup_index is not None else 0
+
+    def set_handler(self, handler: Optional['handlers.HandlerInterface']):
+        super().set_handler(handler)
+        if self._standby_client is not None:
+            # 更新备用连接要反序列化的cmd
+            self._standby_client.set_handler(_StandbyHandler(self))
+
+    async def close(self):
+        if self._standby_client is not None:
+            await self._standby_client.stop_and_close()
+            self._standby_client = None
+        await super().close()
+
     async def init_room(self):
         """
         初始化连接房间需要的字段
 
         :return: True代表没有降级，如果需要降级后还可用，重载这个函数返回True
         """
+        if self._primary is not None and self._init_from_primary():
+            return True
+
         if self._uid is None:
             if not await self._init_uid():
                 logger.warning('room=%d _init_uid() failed', self._tmp_room_id)
@@ -237,104 +907,114 @@ class BLiveClient(ws_base.WebSocketClientBase):
             self._host_server_token = None
         return res
 
-    async def _init_uid(self):
-        cookies = self._session.cookie_jar.filter_cookies(yarl.URL(UID_INIT_URL))
-        sessdata_cookie = cookies.get('SESSDATA', None)
-        if sessdata_cookie is None or sessdata_cookie.value == '':
-            # cookie都没有，不用请求了
-            self._uid = 0
-            return True
+    def _init_from_primary(self):
+        """
+        备用连接第一次初始化时直接用主客户端的字段，不用重复请求。之后再初始化（例如认证失败）时自己请求
+        """
+        primary = self._primary
+        if self._host_server_list is not None or primary.host_server_list is None:
+            return False
+        self._uid = primary.uid
+        self._room_id = primary.room_id
+        self._room_owner_uid = primary.room_owner_uid
+        self._host_server_list = primary.host_server_list
+        self._host_server_token = primary._host_server_token  # noqa
+        return True
 
-        try:
-            async with self._session.get(
-                UID_INIT_URL,
-                headers={'User-Agent': utils.USER_AGENT},
-            ) as res:
-                if res.status != 200:
-                    logger.warning('room=%d _init_uid() failed, status=%d, reason=%s', self._tmp_room_id,
-                                   res.status, res.reason)
-                    return False
-                data = await res.json()
-                if data['code'] != 0:
-                    if data['code'] == -101:
-                        # 未登录
-                        self._uid = 0
-                        return True
-                    logger.warning('room=%d _init_uid() failed, message=%s', self._tmp_room_id,
-                                   data['message'])
-                    return False
+    @property
+    def host_server_list(self) -> Optional[List[dict]]:
+        """
+        弹幕服务器列表，调用init_room后初始化
+        """
+        return self._host_server_list
 
-                data = data['data']
-                if not data['isLogin']:
-                    # 未登录
-                    self._uid = 0
-                else:
-                    self._uid = data['mid']
-                return True
-        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
-            logger.exception('room=%d _init_uid() failed:', self._tmp_room_id)
+    async def _init_uid(self):
+        uid = await self._identity.get_uid()
+        if uid is None:
             return False
+        self._uid = uid
+        return True
 
     def _get_buvid(self):
-        cookies = self._session.cookie_jar.filter_cookies(yarl.URL(BUVID_INIT_URL))
-        buvid_cookie = cookies.get('buvid3', None)
-        if buvid_cookie is None:
-            return ''
-        return buvid_cookie.value
+        return _get_buvid(self._session)
 
     async def _init_buvid(self):
-        try:
-            async with self._session.get(
-                BUVID_INIT_URL,
-                headers={'User-Agent': utils.USER_AGENT},
-            ) as res:
-                if res.status != 200:
-                    logger.warning('room=%d _init_buvid() status error, status=%d, reason=%s',
-                                   self._tmp_room_id, res.status, res.reason)
-        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
-            logger.exception('room=%d _init_buvid() exception:', self._tmp_room_id)
-        return self._get_buvid() != ''
+        return await self._identity.init_buvid()
 
     async def _init_room_id_and_owner(self):
-        try:
-            async with self._session.get(
-                ROOM_INIT_URL,
-                headers={'User-Agent': utils.USER_AGENT},
-                params={
-                    'room_id': self._tmp_room_id
-                },
-            ) as res:
-                if res.status != 200:
-                    logger.warning('room=%d _init_room_id_and_owner() failed, status=%d, reason=%s', self._tmp_room_id,
-                                   res.status, res.reason)
+        cache = self._room_info_cache
+        if cache is not None:
+            room_info = cache.get(self._tmp_room_id)
+            if room_info is not None:
+                # 缓存命中时也经过_parse_room_init，子类重写的行为一致
+                if not self._parse_room_init({'room_id': room_info.room_id, 'uid': room_info.owner_uid}):
                     return False
-                data = await res.json()
-                if data['code'] != 0:
-                    logger.warning('room=%d _init_room_id_and_owner() failed, message=%s', self._tmp_room_id,
-                                   data['message'])
-                    return False
-                if not self._parse_room_init(data['data']):
-                    return False
-        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
-            logger.exception('room=%d _init_room_id_and_owner() failed:', self._tmp_room_id)
+                if cache.need_revalidate(room_info):
+                    cache.revalidate(self._tmp_room_id, self._fetch_room_info)
+                return True
+
+        data = await _get_room_init_data(self._session, self._tmp_room_id)
+        if data is None:
+            return False
+        if not self._parse_room_init(data):
             return False
+        if cache is not None:
+            cache.put(self._tmp_room_id, self._room_id, self._room_owner_uid)
         return True
 
+    async def _fetch_room_info(self) -> Optional[Tuple[int, int]]:
+        """
+        后台更新房间元数据缓存用，不修改本客户端的字段
+
+        :return: (真实房间ID, 主播用户ID)，失败则为None
+        """
+        data = await _get_room_init_data(self._session, self._tmp_room_id)
+        if data is None:
+            return None
+        return data['room_id'], data['uid']
+
     def _parse_room_init(self, data):
+        """
+        解析房间信息，子类可以重写
+
+        :param data: 接口返回的data字段。设置了room_info_cache时，缓存命中的data只有room_id和uid两个字段
+        :return: 是否成功
+        """
         self._room_id = data['room_id']
         self._room_owner_uid = data['uid']
         return True
 
     async def _init_host_server(self):
+        # 重连时用缓存的，认证失败了才重新请求
+        info = self._danmu_info_cache.get(self._room_id, self._uid)
+        if info is None:
+            info = await self._danmu_info_cache.fetch(self._room_id, self._uid, self._fetch_danmu_info)
+            if info is None:
+                return False
+        self._host_server_list = info.host_server_list
+        self._host_server_token = info.host_server_token
+
+        # 测一下各个服务器的连接耗时，之后优先连快的
+        await _host_ranker.probe(self._host_server_list)
+        return True
+
+    async def _fetch_danmu_info(self) -> Optional[Tuple[List[dict], str]]:
+        """
+        请求弹幕服务器列表和token
+
+        :return: (弹幕服务器列表, token)，失败返回None
+        """
+        # 之后在后台刷新口令，一般不用在这里等待
+        self._wbi_signer.start_auto_refresh()
         if self._wbi_signer.need_refresh_wbi_key:
             await self._wbi_signer.refresh_wbi_key()
             # 如果没刷新成功先用旧的key
             if self._wbi_signer.wbi_key == '':
                 logger.exception('room=%d _init_host_server() failed: no wbi key', self._room_id)
-                return False
+                return None
 
         try:
-            async with self._session.get(
+            async with _get_request_governor(self._session).request('getDanmuInfo') as ticket, self._session.get(
                 DANMAKU_SERVER_CONF_URL,
                 headers={'User-Agent': utils.USER_AGENT},
                 params=self._wbi_signer.add_wbi_sign({
@@ -343,22 +1023,24 @@ class BLiveClient(ws_base.WebSocketClientBase):
                 }),
             ) as res:
                 if res.status != 200:
+                    ticket.check_response(res.status)
                     logger.warning('room=%d _init_host_server() failed, status=%d, reason=%s', self._room_id,
                                    res.status, res.reason)
-                    return False
+                    return None
                 data = await res.json()
+                ticket.check_response(res.status, data['code'])
                 if data['code'] != 0:
                     if data['code'] == -352:
                         # wbi签名错误
                         self._wbi_signer.reset()
                     logger.warning('room=%d _init_host_server() failed, message=%s', self._room_id, data['message'])
-                    return False
+                    return None
                 if not self._parse_danmaku_server_conf(data['data']):
-                    return False
+                    return None
         except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
             logger.exception('room=%d _init_host_server() failed:', self._room_id)
-            return False
-        return True
+            return None
+        return self._host_server_list, self._host_server_token
 
     def _parse_danmaku_server_conf(self, data):
         self._host_server_list = data['host_list']
@@ -378,13 +1060,130 @@ class BLiveClient(ws_base.WebSocketClientBase):
             self._need_init_room = True
         await super()._on_before_ws_connect(retry_count)
 
+    def _on_auth_failed(self):
+        # token可能失效了，下次init_room重新请求
+        self._danmu_info_cache.invalidate(self._room_id, self._uid)
+        super()._on_auth_failed()
+
     def _get_ws_url(self, retry_count) -> str:
         """
         返回WebSocket连接的URL，可以在这里做故障转移和负载均衡
+
+        优先连接这个房间上次连接成功的服务器，否则按连接耗时和失败次数选择。连接失败的服务器会被降低优先级，所以重连时会自动换服务器
+
+        冗余模式下主备连接尽量连不同的服务器
         """
-        host_server = self._host_server_list[retry_count % len(self._host_server_list)]
+        host_server_list = self._host_server_list
+        peer = self._primary if self._primary is not None else self._standby_client
+        if peer is not None and peer._connecting_host_key is not None:  # noqa
+            other_host_server_list = [
+                host_server for host_server in host_server_list
+                if _host_ranker.get_host_key(host_server) != peer._connecting_host_key  # noqa
+            ]
+            if other_host_server_list:
+                host_server_list = other_host_server_list
+        host_server = _host_ranker.choose(self._room_id, host_server_list)
+        self._connecting_host_key = _host_ranker.get_host_key(host_server)
+        self._connect_start_time = time.monotonic()
+        self._is_host_connected = False
         return f"wss://{host_server['host']}:{host_server['wss_port']}/sub"
 
+    async def _on_ws_connect(self):
+        """
+        WebSocket连接成功
+        """
+        self._is_host_connected = True
+        if self._connecting_host_key is not None:
+            _host_ranker.on_connected(
+                self._room_id, self._connecting_host_key, time.monotonic() - self._connect_start_time
+            )
+        await super()._on_ws_connect()
+
+        if self._dedup_index is not None and (self._standby_client is None or not self._standby_client.is_running):
+            self._start_standby_client()
+
+    async def _on_ws_close(self):
+        """
+        WebSocket连接断开
+        """
+        if self._connecting_host_key is not None and not self._is_host_connected:
+            _host_ranker.on_failed(self._room_id, self._connecting_host_key)
+        self._connecting_host_key = None
+        await super()._on_ws_close()
+
+    def _on_stream_stalled(self):
+        """
+        检测到断流，降低这个服务器的优先级，重连时换一个服务器
+        """
+        if self._connecting_host_key is not None:
+            _host_ranker.on_failed(self._room_id, self._connecting_host_key)
+        super()._on_stream_stalled()
+
+    async def _network_coroutine(self):
+        try:
+            await super()._network_coroutine()
+        finally:
+            # 主客户端停止了，备用连接也要停止
+            if self._standby_client is not None and self._standby_client.is_running:
+                self._standby_client.stop()
+
+    def _start_standby_client(self):
+        if self._standby_client is None:
+            standby_client = self._standby_client = BLiveClient(
+                self._tmp_room_id,
+                uid=self._uid,
+                session=self._session,
+                heartbeat_interval=self._heartbeat_interval,
+            )
+            standby_client._primary = self
+            standby_client.set_handler(_StandbyHandler(self))
+        standby_client = self._standby_client
+        standby_client.set_reconnect_policy(self._get_reconnect_interval)
+        standby_client.set_retry_budget(self._retry_budget)
+        standby_client.set_decompress_scheduler(self._decompress_scheduler)
+        standby_client.set_json_backend(self._json_loads, self._json_dumps)
+        standby_client.set_stall_watchdog(self._stall_watchdog_config)
+        standby_client.start()
+
+    def _is_active_connection(self):
+        """
+        主客户端连接着的时候由主客户端发送没法去重的消息，否则由备用连接发送
+        """
+        return self._websocket is not None and not self._websocket.closed
+
+    def _handle_commands(self, commands: List[dict]):
+        if self._dedup_index is not None:
+            commands = self._dedup_commands(commands, self._is_active_connection())
+            if not commands:
+                return
+        super()._handle_commands(commands)
+
+    def _on_standby_commands(self, commands: List[dict]):
+        """
+        备用连接收到的消息，去重后交给消息处理器
+        """
+        if self._dedup_index is None:
+            return
+        commands = self._dedup_commands(commands, not self._is_active_connection())
+        if commands:
+            super()._handle_commands(commands)
+
+    def _dedup_commands(self, commands: List[dict], is_active: bool) -> List[dict]:
+        """
+        去掉另一个连接已经收到过的消息
+
+        :param is_active: 消息来自当前活跃的连接，没法去重的消息只保留活跃连接的
+        """
+        res = []
+        for command in commands:
+            identity = _get_command_identity(command)
+            if identity is None:
+                if is_active:
+                    res.append(command)
+            elif self._dedup_index.add(identity):
+                res.append(command)
+        return res
+
     async def _send_auth(self):
         """
         发送认证包
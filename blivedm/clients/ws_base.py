@@ -1,17 +1,23 @@
 # -*- coding: utf-8 -*-
 import asyncio
+import dataclasses
 import enum
-import json
+import inspect
 import logging
+import math
+import re
 import struct
-import zlib
+import time
 from typing import *
 
 import aiohttp
-import brotli
 
+from . import decompress, event_queue, heartbeat
 from .. import handlers, utils
 
+if TYPE_CHECKING:
+    from . import replay
+
 logger = logging.getLogger('blivedm')
 
 USER_AGENT = (
@@ -20,6 +26,13 @@ USER_AGENT = (
 
 HEADER_STRUCT = struct.Struct('>I2H2I')
 
+CMD_PREFIX_PATTERN = re.compile(rb'\{\s*"cmd"\s*:\s*"([^"\\]*)"')
+"""
+在反序列化之前从包体开头找出cmd，B站的业务消息cmd都是第一个字段
+
+不在开头的不匹配，因为后面嵌套的对象里也可能有cmd字段
+"""
+
 
 class HeaderTuple(NamedTuple):
     pack_len: int
@@ -76,7 +89,37 @@ class AuthError(Exception):
     """认证失败"""
 
 
-DEFAULT_RECONNECT_POLICY = utils.make_constant_retry_policy(1)
+DEFAULT_RECONNECT_POLICY = utils.make_exponential_jitter_retry_policy(1, 30)
+DEFAULT_RETRY_BUDGET = utils.RetryBudget(rate=5, burst=20)
+"""所有客户端默认共用的重试预算，限制整个进程的重连和重新init_room速率"""
+DEFAULT_DECOMPRESS_SCHEDULER = decompress.DecompressScheduler()
+"""所有客户端默认共用的解压调度器"""
+DEFAULT_JSON_LOADS = utils.json_loads
+"""默认的JSON解码函数，装了orjson则用orjson，否则用标准库"""
+DEFAULT_JSON_DUMPS = utils.json_dumps
+"""默认的JSON编码函数，返回bytes"""
+EVENT_CONSUMER_STOP_TIMEOUT = 5.
+"""队列模式下停止客户端时，最多等正在处理的一批消息这么久（秒）"""
+
+
+@dataclasses.dataclass
+class StallWatchdogConfig:
+    """
+    断流检测的配置
+
+    有的连接还在回复心跳，但是很久收不到业务消息。如果一个平时有消息的房间安静的时间远远超过平时的消息间隔，就主动重连
+    """
+
+    check_interval: float = 10.
+    """检查间隔（秒）"""
+    min_stall_time: float = 60.
+    """至少这么久（秒）没收到业务消息才算断流"""
+    stall_factor: float = 20.
+    """没收到业务消息的时间超过平时平均消息间隔的这么多倍才算断流"""
+    min_rate: float = 0.05
+    """平时的消息速率（条/秒）低于这个值时认为房间没在直播，不检测"""
+    rate_window: float = 600.
+    """统计平时消息速率的时间窗口（秒），更早的消息按指数衰减"""
 
 
 class WebSocketClientBase:
@@ -87,6 +130,9 @@ class WebSocketClientBase:
     :param heartbeat_interval: 发送心跳包的间隔时间（秒）
     """
 
+    _BUILTIN_CMDS: AbstractSet[str] = frozenset()
+    """客户端自己要处理的cmd，不管消息处理器关不关心都要反序列化"""
+
     def __init__(
         self,
         session: Optional[aiohttp.ClientSession] = None,
@@ -101,12 +147,30 @@ class WebSocketClientBase:
             assert self._session.loop is asyncio.get_event_loop()  # noqa
 
         self._heartbeat_interval = heartbeat_interval
+        self._heartbeat_packet = self._make_packet(b'{}', Operation.HEARTBEAT)
+        """预先打包好的心跳包"""
 
         self._need_init_room = True
         self._handler: Optional[handlers.HandlerInterface] = None
         """消息处理器"""
+        self._cmd_filter: Optional[AbstractSet[bytes]] = frozenset(cmd.encode('utf-8') for cmd in self._BUILTIN_CMDS)
+        """要反序列化的cmd集合，None表示全部反序列化"""
         self._get_reconnect_interval: Callable[[int, int], float] = DEFAULT_RECONNECT_POLICY
         """重连间隔时间增长策略"""
+        self._retry_budget: Optional[utils.RetryBudget] = DEFAULT_RETRY_BUDGET
+        """重试预算，None表示不限制"""
+        self._decompress_scheduler: decompress.DecompressScheduler = DEFAULT_DECOMPRESS_SCHEDULER
+        """解压调度器"""
+        self._json_loads: Callable[[Union[bytes, memoryview]], Any] = DEFAULT_JSON_LOADS
+        """JSON解码函数"""
+        self._json_dumps: Callable[[Any], bytes] = DEFAULT_JSON_DUMPS
+        """JSON编码函数"""
+        self._frame_recorder: Optional['replay.FrameRecorder'] = None
+        """录制收到的WebSocket消息"""
+        self._event_queue: Optional[event_queue.EventQueue] = None
+        """网络协程和消息处理器之间的消息队列，None表示在网络协程里直接调用消息处理器"""
+        self._stall_watchdog_config: Optional[StallWatchdogConfig] = None
+        """断流检测的配置，None表示不检测"""
 
         # 在调用init_room后初始化的字段
         self._room_id: Optional[int] = None
@@ -116,8 +180,26 @@ class WebSocketClientBase:
         """WebSocket连接"""
         self._network_future: Optional[asyncio.Future] = None
         """网络协程的future"""
-        self._heartbeat_timer_handle: Optional[asyncio.TimerHandle] = None
-        """发心跳包定时器的handle"""
+        self._heartbeat_timer_handle: Optional[heartbeat.HeartbeatHandle] = None
+        """在心跳调度器注册的发心跳包定时任务"""
+        self._event_consumer_future: Optional[asyncio.Future] = None
+        """队列模式下调用消息处理器的消费协程的future"""
+        self._handler_tasks: Set[asyncio.Task] = set()
+        """防止消息处理器返回的协程被垃圾回收"""
+        self._command_count = 0
+        """收到的业务消息数，包括被cmd过滤掉的"""
+        self._last_command_time: Optional[float] = None
+        """上次收到业务消息的时间，连接成功时也会重置"""
+        self._command_rate: Optional[float] = None
+        """平时的消息速率（条/秒），断流检测用"""
+        self._rate_command_count = 0.
+        """按时间衰减的消息数，除以_rate_elapsed就是平时的消息速率"""
+        self._rate_elapsed = 0.
+        """按时间衰减的统计时间（秒）"""
+        self._stall_check_handle: Optional[heartbeat.HeartbeatHandle] = None
+        """在心跳调度器注册的断流检测定时任务"""
+        self._stall_check_time = 0.
+        self._stall_check_command_count = 0
 
     @property
     def is_running(self) -> bool:
@@ -144,6 +226,15 @@ class WebSocketClientBase:
         """
         self._handler = handler
 
+        cmds = set(self._BUILTIN_CMDS)
+        if handler is not None:
+            handled_cmds = handler.get_handled_cmds()
+            if handled_cmds is None:
+                self._cmd_filter = None
+                return
+            cmds.update(handled_cmds)
+        self._cmd_filter = frozenset(cmd.encode('utf-8') for cmd in cmds)
+
     def set_reconnect_policy(self, get_reconnect_interval: Callable[[int, int], float]):
         """
         设置重连间隔时间增长策略
@@ -152,6 +243,89 @@ class WebSocketClientBase:
         """
         self._get_reconnect_interval = get_reconnect_interval
 
+    def set_retry_budget(self, retry_budget: Optional[utils.RetryBudget]):
+        """
+        设置重试预算，每次重连（包括重连前重新init_room）都要先从预算里取一个令牌，第一次连接不用
+
+        默认所有客户端共用DEFAULT_RETRY_BUDGET，这样大量房间同时掉线时，总的重连请求速率有上限
+
+        :param retry_budget: 重试预算，None表示不限制
+        """
+        self._retry_budget = retry_budget
+
+    def set_decompress_scheduler(self, scheduler: decompress.DecompressScheduler):
+        """
+        设置解压调度器，可以用来调整直接解压的阈值、专用线程池大小，或者查看排队深度和解压耗时
+
+        :param scheduler: 解压调度器
+        """
+        self._decompress_scheduler = scheduler
+
+    def set_json_backend(
+        self,
+        loads: Callable[[Union[bytes, memoryview]], Any],
+        dumps: Callable[[Any], bytes],
+    ):
+        """
+        设置JSON编解码函数，默认装了orjson则用orjson，否则用标准库
+
+        :param loads: 解码函数，输入是bytes或者memoryview，不会先解码成str
+        :param dumps: 编码函数，返回bytes
+        """
+        self._json_loads = loads
+        self._json_dumps = dumps
+
+    def set_frame_recorder(self, recorder: Optional['replay.FrameRecorder']):
+        """
+        设置录制器，之后收到的每个WebSocket二进制消息都会带上时间戳和房间ID追加到录制文件，可以用ReplayClient回放
+
+        :param recorder: 录制器，None表示停止录制
+        """
+        self._frame_recorder = recorder
+
+    def set_event_queue(self, queue: Optional[event_queue.EventQueue]):
+        """
+        设置消息队列，要在start之前设置
+
+        设置后网络协程只把消息放进队列，由单独的消费协程调用消息处理器的handle_batch。handle_batch可以返回awaitable，消费协程会
+        等它完成再取下一批，这样处理器慢的时候消息积压在有界的队列里，按队列的丢弃策略丢弃，而不是无限创建协程。
+        停止时会等正在处理的一批消息处理完，队列里剩下的消息留到下次start再处理
+
+        :param queue: 消息队列，None表示在网络协程里直接调用消息处理器
+        """
+        if self.is_running:
+            logger.warning('room=%s client is running, set_event_queue() takes effect after restart', self.room_id)
+        self._event_queue = queue
+
+    def set_stall_watchdog(self, config: Optional[StallWatchdogConfig]):
+        """
+        设置断流检测，下次连接时生效。检测到断流时主动断开连接，然后按正常的流程重连
+
+        :param config: 断流检测的配置，None表示不检测
+        """
+        self._stall_watchdog_config = config
+
+    @property
+    def last_command_time(self) -> Optional[float]:
+        """
+        上次收到业务消息的单调时钟时间（time.monotonic），包括被cmd过滤掉的消息
+        """
+        return self._last_command_time
+
+    @property
+    def command_rate(self) -> Optional[float]:
+        """
+        平时的消息速率（条/秒），开启断流检测后才统计
+        """
+        return self._command_rate
+
+    @property
+    def decompress_scheduler(self) -> decompress.DecompressScheduler:
+        """
+        解压调度器
+        """
+        return self._decompress_scheduler
+
     def start(self):
         """
         启动本客户端
@@ -161,6 +335,8 @@ class WebSocketClientBase:
             return
 
         self._network_future = asyncio.create_task(self._network_coroutine_wrapper())
+        if self._event_queue is not None:
+            self._event_consumer_future = asyncio.create_task(self._event_consumer_coroutine(self._event_queue))
 
     def stop(self):
         """
@@ -210,8 +386,7 @@ class WebSocketClientBase:
         """
         raise NotImplementedError
 
-    @staticmethod
-    def _make_packet(data: Union[dict, str, bytes], operation: int) -> bytes:
+    def _make_packet(self, data: Union[dict, str, bytes], operation: int) -> bytes:
         """
         创建一个要发送给服务器的包
 
@@ -220,7 +395,7 @@ class WebSocketClientBase:
         :return: 整个包的数据
         """
         if isinstance(data, dict):
-            body = json.dumps(data).encode('utf-8')
+            body = self._json_dumps(data)
         elif isinstance(data, str):
             body = data.encode('utf-8')
         else:
@@ -249,7 +424,18 @@ class WebSocketClientBase:
             exc = e
         finally:
             logger.debug('room=%s _network_coroutine() finished', self.room_id)
-            self._network_future = None
+            try:
+                if self._event_consumer_future is not None:
+                    # 正在处理的一批消息处理完再停止，队列里剩下的消息留到下次start再处理
+                    self._event_consumer_future.cancel()
+                    try:
+                        await asyncio.wait([self._event_consumer_future])
+                    except asyncio.CancelledError:
+                        # 等的时候又调用了stop，不等了
+                        pass
+            finally:
+                self._event_consumer_future = None
+                self._network_future = None
 
         if self._handler is not None:
             self._handler.on_client_stopped(self, exc)
@@ -287,7 +473,7 @@ class WebSocketClientBase:
             except AuthError:
                 # 认证失败了，应该重新获取token再重连
                 logger.exception('room=%d auth failed, trying init_room() again', self.room_id)
-                self._need_init_room = True
+                self._on_auth_failed()
             finally:
                 self._websocket = None
                 await self._on_ws_close()
@@ -300,6 +486,8 @@ class WebSocketClientBase:
                 self.room_id, retry_count, total_retry_count
             )
             await asyncio.sleep(self._get_reconnect_interval(retry_count, total_retry_count))
+            if self._retry_budget is not None:
+                await self._retry_budget.acquire()
 
     async def _on_before_ws_connect(self, retry_count):
         """
@@ -312,6 +500,12 @@ class WebSocketClientBase:
             raise InitError('init_room() failed')
         self._need_init_room = False
 
+    def _on_auth_failed(self):
+        """
+        认证失败时调用，可以用来让缓存的token失效
+        """
+        self._need_init_room = True
+
     def _get_ws_url(self, retry_count) -> str:
         """
         返回WebSocket连接的URL，可以在这里做故障转移和负载均衡
@@ -323,10 +517,18 @@ class WebSocketClientBase:
         WebSocket连接成功
         """
         await self._send_auth()
-        self._heartbeat_timer_handle = asyncio.get_running_loop().call_later(
+        # 所有客户端共用一个定时器，不用每个客户端每次心跳都创建定时器和协程
+        self._heartbeat_timer_handle = heartbeat.get_heartbeat_scheduler().register(
             self._heartbeat_interval, self._on_send_heartbeat
         )
 
+        if self._stall_watchdog_config is not None:
+            self._last_command_time = self._stall_check_time = time.monotonic()
+            self._stall_check_command_count = self._command_count
+            self._stall_check_handle = heartbeat.get_heartbeat_scheduler().register(
+                self._stall_watchdog_config.check_interval, self._on_stall_check
+            )
+
     async def _on_ws_close(self):
         """
         WebSocket连接断开
@@ -334,6 +536,9 @@ class WebSocketClientBase:
         if self._heartbeat_timer_handle is not None:
             self._heartbeat_timer_handle.cancel()
             self._heartbeat_timer_handle = None
+        if self._stall_check_handle is not None:
+            self._stall_check_handle.cancel()
+            self._stall_check_handle = None
 
     async def _send_auth(self):
         """
@@ -341,18 +546,16 @@ class WebSocketClientBase:
         """
         raise NotImplementedError
 
-    def _on_send_heartbeat(self):
+    def _on_send_heartbeat(self) -> Optional[Awaitable]:
         """
-        定时发送心跳包的回调
+        定时发送心跳包的回调，由心跳调度器调用
         """
         if self._websocket is None or self._websocket.closed:
-            self._heartbeat_timer_handle = None
-            return
-
-        self._heartbeat_timer_handle = asyncio.get_running_loop().call_later(
-            self._heartbeat_interval, self._on_send_heartbeat
-        )
-        asyncio.create_task(self._send_heartbeat())
+            if self._heartbeat_timer_handle is not None:
+                self._heartbeat_timer_handle.cancel()
+                self._heartbeat_timer_handle = None
+            return None
+        return self._send_heartbeat()
 
     async def _send_heartbeat(self):
         """
@@ -362,12 +565,56 @@ class WebSocketClientBase:
             return
 
         try:
-            await self._websocket.send_bytes(self._make_packet({}, Operation.HEARTBEAT))
+            await self._websocket.send_bytes(self._heartbeat_packet)
         except (ConnectionResetError, aiohttp.ClientConnectionError) as e:
             logger.warning('room=%d _send_heartbeat() failed: %r', self.room_id, e)
         except Exception:  # noqa
             logger.exception('room=%d _send_heartbeat() failed:', self.room_id)
 
+    def _on_stall_check(self):
+        """
+        定时检查是否断流，由心跳调度器调用
+        """
+        config = self._stall_watchdog_config
+        if config is None or self._websocket is None or self._websocket.closed:
+            return
+
+        now = time.monotonic()
+        command_count = self._command_count - self._stall_check_command_count
+        elapsed = now - self._stall_check_time
+        self._stall_check_command_count = self._command_count
+        self._stall_check_time = now
+        if command_count > 0 or now - self._last_command_time < config.min_stall_time:
+            # 没消息的间隔也要统计，否则消息稀疏的房间速率会被高估。安静超过min_stall_time可能是断流了，不再统计，否则断流本身
+            # 会把平时的速率拉低
+            decay = math.exp(-elapsed / config.rate_window)
+            self._rate_command_count = self._rate_command_count * decay + command_count
+            self._rate_elapsed = self._rate_elapsed * decay + elapsed
+            if self._rate_elapsed > 0:
+                self._command_rate = self._rate_command_count / self._rate_elapsed
+        if command_count > 0:
+            return
+
+        if self._command_rate is None or self._command_rate < config.min_rate:
+            return
+        quiet_time = now - self._last_command_time
+        if quiet_time < max(config.min_stall_time, config.stall_factor / self._command_rate):
+            return
+
+        logger.warning('room=%d no command for %.0fs, usual rate=%.2f/s, stream stalled, reconnecting', self.room_id,
+                       quiet_time, self._command_rate)
+        # 如果是直播结束了，之后会越来越难触发，不会一直重连
+        self._rate_command_count /= 2
+        self._command_rate /= 2
+        self._on_stream_stalled()
+
+    def _on_stream_stalled(self):
+        """
+        检测到断流，断开连接，网络协程会按正常的流程重连
+        """
+        if self._websocket is not None and not self._websocket.closed:
+            asyncio.create_task(self._websocket.close())
+
     async def _on_ws_message(self, message: aiohttp.WSMessage):
         """
         收到WebSocket消息
@@ -379,6 +626,12 @@ class WebSocketClientBase:
                            message.type, message.data)
             return
 
+        if self._frame_recorder is not None:
+            try:
+                self._frame_recorder.write(self._room_id, message.data)
+            except Exception:  # noqa
+                logger.exception('room=%d failed to record frame:', self.room_id)
+
         try:
             await self._parse_ws_message(message.data)
         except AuthError:
@@ -387,108 +640,193 @@ class WebSocketClientBase:
         except Exception:  # noqa
             logger.exception('room=%d _parse_ws_message() error:', self.room_id)
 
-    async def _parse_ws_message(self, data: bytes):
+    async def _parse_ws_message(self, data: Union[bytes, memoryview]):
         """
         解析WebSocket消息
 
         :param data: WebSocket消息数据
         """
-        offset = 0
+        commands = []
+        command_count = self._command_count
         try:
-            header = HeaderTuple(*HEADER_STRUCT.unpack_from(data, offset))
-        except struct.error:
-            logger.exception('room=%d parsing header failed, offset=%d, data=%s', self.room_id, offset, data)
-            return
+            async for command in self._iter_commands(data):
+                commands.append(command)
+        finally:
+            if self._command_count != command_count:
+                self._last_command_time = time.monotonic()
+            # 解析到一半出错了，也要把已经解析出来的消息交给处理器
+            if commands:
+                self._handle_commands(commands)
+        if self._event_queue is not None:
+            # BLOCK策略下队列满了先不接收下一个消息
+            await self._event_queue.wait_not_full()
 
-        if header.operation in (Operation.SEND_MSG_REPLY, Operation.AUTH_REPLY):
-            # 业务消息，可能有多个包一起发，需要分包
-            while True:
-                body = data[offset + header.raw_header_size: offset + header.pack_len]
-                await self._parse_business_message(header, body)
+    async def _iter_commands(self, data: Union[bytes, memoryview]) -> AsyncIterator[dict]:
+        """
+        解码流水线：帧 -> 包 ->（解压）-> 内层包 -> 业务消息，按顺序产出业务消息
 
-                offset += header.pack_len
-                if offset >= len(data):
-                    break
+        压缩包不再递归解析，而是把内层的分包迭代器压栈，所以嵌套多少层都只有这一个协程帧
 
-                try:
-                    header = HeaderTuple(*HEADER_STRUCT.unpack_from(data, offset))
-                except struct.error:
-                    logger.exception('room=%d parsing header failed, offset=%d, data=%s', self.room_id, offset, data)
-                    break
-
-        elif header.operation == Operation.HEARTBEAT_REPLY:
-            # 服务器心跳包，前4字节是人气值，后面是客户端发的心跳包内容
-            # pack_len不包括客户端发的心跳包内容，不知道是不是服务器BUG
-            body = data[offset + header.raw_header_size: offset + header.raw_header_size + 4]
-            popularity = int.from_bytes(body, 'big')
-            # 自己造个消息当成业务消息处理
-            body = {
-                'cmd': '_HEARTBEAT',
-                'data': {
-                    'popularity': popularity
+        :param data: WebSocket消息数据
+        """
+        packet_iters = [self._iter_packets(memoryview(data))]
+        while packet_iters:
+            packet = next(packet_iters[-1], None)
+            if packet is None:
+                packet_iters.pop()
+                continue
+            header, body = packet
+
+            if header.operation == Operation.SEND_MSG_REPLY:
+                # 业务消息
+                if header.ver in (ProtoVer.BROTLI, ProtoVer.DEFLATE):
+                    # 压缩过的先解压，大的包体为了避免阻塞网络线程，放在其他线程执行。web端已经不用zlib压缩了，但是开放平台会用
+                    body = await self._decompress_scheduler.decompress(header.ver, body)
+                    packet_iters.append(self._iter_packets(memoryview(body)))
+                elif header.ver == ProtoVer.NORMAL:
+                    # 没压缩过的直接反序列化，因为有万恶的GIL，这里不能并行避免阻塞
+                    if len(body) != 0:
+                        self._command_count += 1
+                        if self._is_cmd_wanted(body):
+                            yield self._decode_command(body)
+                else:
+                    # 未知格式
+                    logger.warning('room=%d unknown protocol version=%d, header=%s, body=%s', self.room_id,
+                                   header.ver, header, bytes(body))
+
+            elif header.operation == Operation.HEARTBEAT_REPLY:
+                # 服务器心跳包，前4字节是人气值
+                popularity = int.from_bytes(body, 'big')
+                # 自己造个消息当成业务消息处理
+                yield {
+                    'cmd': '_HEARTBEAT',
+                    'data': {
+                        'popularity': popularity
+                    }
                 }
-            }
-            self._handle_command(body)
 
-        else:
-            # 未知消息
-            body = data[offset + header.raw_header_size: offset + header.pack_len]
-            logger.warning('room=%d unknown message operation=%d, header=%s, body=%s', self.room_id,
-                           header.operation, header, body)
-
-    async def _parse_business_message(self, header: HeaderTuple, body: bytes):
-        """
-        解析业务消息
-        """
-        if header.operation == Operation.SEND_MSG_REPLY:
-            # 业务消息
-            if header.ver == ProtoVer.BROTLI:
-                # 压缩过的先解压，为了避免阻塞网络线程，放在其他线程执行
-                body = await asyncio.get_running_loop().run_in_executor(None, brotli.decompress, body)
-                await self._parse_ws_message(body)
-            elif header.ver == ProtoVer.DEFLATE:
-                # web端已经不用zlib压缩了，但是开放平台会用
-                body = await asyncio.get_running_loop().run_in_executor(None, zlib.decompress, body)
-                await self._parse_ws_message(body)
-            elif header.ver == ProtoVer.NORMAL:
-                # 没压缩过的直接反序列化，因为有万恶的GIL，这里不能并行避免阻塞
-                if len(body) != 0:
-                    try:
-                        body = json.loads(body.decode('utf-8'))
-                        self._handle_command(body)
-                    except Exception:
-                        logger.error('room=%d, body=%s', self.room_id, body)
-                        raise
+            elif header.operation == Operation.AUTH_REPLY:
+                # 认证响应
+                body = self._json_loads(body)
+                if body['code'] != AuthReplyCode.OK:
+                    raise AuthError(f"auth reply error, code={body['code']}, body={body}")
+                await self._send_heartbeat()
+
             else:
-                # 未知格式
-                logger.warning('room=%d unknown protocol version=%d, header=%s, body=%s', self.room_id,
-                               header.ver, header, body)
+                # 未知消息
+                logger.warning('room=%d unknown message operation=%d, header=%s, body=%s', self.room_id,
+                               header.operation, header, bytes(body))
 
-        elif header.operation == Operation.AUTH_REPLY:
-            # 认证响应
-            body = json.loads(body.decode('utf-8'))
-            if body['code'] != AuthReplyCode.OK:
-                raise AuthError(f"auth reply error, code={body['code']}, body={body}")
-            await self._websocket.send_bytes(self._make_packet({}, Operation.HEARTBEAT))
+    def _iter_packets(self, data: memoryview) -> Iterator[Tuple[HeaderTuple, memoryview]]:
+        """
+        分包，一个WebSocket消息或者解压后的包体里可能有多个包
 
-        else:
-            # 未知消息
-            logger.warning('room=%d unknown message operation=%d, header=%s, body=%s', self.room_id,
-                           header.operation, header, body)
+        :param data: 要分包的数据
+        """
+        offset = 0
+        while offset < len(data):
+            try:
+                header = HeaderTuple(*HEADER_STRUCT.unpack_from(data, offset))
+            except struct.error:
+                logger.exception('room=%d parsing header failed, offset=%d, data=%s', self.room_id, offset,
+                                 bytes(data))
+                return
+
+            if header.operation == Operation.HEARTBEAT_REPLY:
+                # 前4字节是人气值，后面是客户端发的心跳包内容
+                # pack_len不包括客户端发的心跳包内容，不知道是不是服务器BUG，所以心跳包后面的数据都不要了
+                yield header, data[offset + header.raw_header_size: offset + header.raw_header_size + 4]
+                return
+
+            if header.raw_header_size < HEADER_STRUCT.size or header.pack_len < header.raw_header_size:
+                # 不检查的话pack_len=0时offset不会增加，会死循环阻塞事件循环
+                logger.warning('room=%d invalid packet header=%s, offset=%d', self.room_id, header, offset)
+                return
+            yield header, data[offset + header.raw_header_size: offset + header.pack_len]
+            offset += header.pack_len
+
+    def _is_cmd_wanted(self, body: memoryview) -> bool:
+        """
+        在反序列化之前判断有没有人处理这个消息，没人处理的就不用反序列化了
+        """
+        if self._cmd_filter is None:
+            return True
+        match = CMD_PREFIX_PATTERN.match(body)
+        if match is None:
+            # 找不到cmd，保险起见还是反序列化
+            return True
+        cmd = match.group(1)
+        pos = cmd.find(b':')  # 2019-5-29 B站弹幕升级新增了参数
+        if pos != -1:
+            cmd = cmd[:pos]
+        return cmd in self._cmd_filter
+
+    def _decode_command(self, body: memoryview) -> dict:
+        """
+        反序列化一个业务消息
+        """
+        try:
+            return self._json_loads(body)
+        except Exception:
+            logger.error('room=%d, body=%s', self.room_id, bytes(body))
+            raise
 
-    def _handle_command(self, command: dict):
+    def _handle_commands(self, commands: List[dict]):
         """
-        处理业务消息
+        处理一个WebSocket消息里解析出来的所有业务消息
 
-        :param command: 业务消息
+        :param commands: 业务消息，按收到的顺序
         """
         if self._handler is None:
             return
+        if self._event_queue is not None:
+            self._event_queue.put_batch(commands)
+            return
         try:
             # 为什么不做成异步的：
             # 1. 为了保持处理消息的顺序，这里不使用call_soon、create_task等方法延迟处理
             # 2. 如果支持handle使用async函数，用户可能会在里面处理耗时很长的异步操作，导致网络协程阻塞
             # 这里做成同步的，强制用户使用create_task或消息队列处理异步操作，这样就不会阻塞网络协程
-            self._handler.handle(self, command)
+            res = self._handler.handle_batch(self, commands)
         except Exception as e:
-            logger.exception('room=%d _handle_command() failed, command=%s', self.room_id, command, exc_info=e)
+            logger.exception('room=%d _handle_commands() failed, commands=%s', self.room_id, commands, exc_info=e)
+            return
+        if inspect.isawaitable(res):
+            # 没有消息队列时不等待，否则会阻塞网络协程
+            task = asyncio.ensure_future(res)
+            self._handler_tasks.add(task)
+            task.add_done_callback(self._handler_tasks.discard)
+
+    async def _event_consumer_coroutine(self, queue: event_queue.EventQueue):
+        """
+        队列模式下的消费协程，从队列取消息交给消息处理器
+        """
+        while True:
+            commands = await queue.get_batch()
+            if self._handler is None:
+                continue
+            try:
+                res = self._handler.handle_batch(self, commands)
+                if inspect.isawaitable(res):
+                    await self._wait_batch_handled(res)
+            except Exception as e:  # noqa
+                logger.exception('room=%s _event_consumer_coroutine() failed, commands=%s', self.room_id, commands,
+                                 exc_info=e)
+
+    async def _wait_batch_handled(self, res: Awaitable):
+        """
+        等待消息处理器处理完一批消息。消费协程被取消时（停止客户端）最多再等EVENT_CONSUMER_STOP_TIMEOUT秒，否则这批消息就丢了
+        """
+        future = asyncio.ensure_future(res)
+        try:
+            await asyncio.shield(future)
+        except asyncio.CancelledError:
+            if not future.done():
+                try:
+                    await asyncio.wait_for(future, EVENT_CONSUMER_STOP_TIMEOUT)
+                except asyncio.TimeoutError:
+                    logger.warning('room=%s handle_batch() did not finish in %.1fs after stop', self.room_id,
+                                   EVENT_CONSUMER_STOP_TIMEOUT)
+                except Exception:  # noqa
+                    logger.exception('room=%s _wait_batch_handled() failed:', self.room_id)
+            raise
@@ -2,6 +2,7 @@
 import logging
 from typing import *
 
+from . import utils
 from .clients import ws_base
 from .models import web as web_models, open_live as open_models
 
@@ -48,13 +49,48 @@ class HandlerInterface:
     def handle(self, client: ws_base.WebSocketClientBase, command: dict):
         raise NotImplementedError
 
+    def handle_batch(self, client: ws_base.WebSocketClientBase, commands: List[dict]):
+        """
+        处理一个WebSocket消息里解析出来的所有业务消息，默认逐个调用handle。重写这个方法可以一次处理一批消息
+
+        客户端设置了消息队列时，一批消息可能来自多个WebSocket消息。重写时可以返回一个awaitable：队列模式下消费协程会等它完成再取
+        下一批，否则客户端会为它创建一个协程
+
+        :param client: 客户端
+        :param commands: 业务消息，按收到的顺序
+        """
+        for command in commands:
+            try:
+                self.handle(client, command)
+            except Exception:  # noqa
+                logger.exception('room=%d handle() failed, command=%s', client.room_id, command)
+
+    def get_handled_cmds(self) -> Optional[AbstractSet[str]]:
+        """
+        返回本处理器关心的cmd集合，客户端会在反序列化之前丢弃其他cmd的消息。返回None表示所有消息都要
+
+        客户端在set_handler时调用一次，如果返回值会变，需要重新set_handler
+        """
+        return None
+
     def on_client_stopped(self, client: ws_base.WebSocketClientBase, exception: Optional[Exception]):
         """
         当客户端停止时调用。可以在这里close或者重新start
         """
 
 
+def _calls_method(method_name):
+    """
+    标记处理回调最终会调用哪个_on_xxx方法，用来判断子类是否关心这个cmd
+    """
+    def decorator(callback):
+        callback.method_name = method_name
+        return callback
+    return decorator
+
+
 def _make_msg_callback(method_name, message_cls):
+    @_calls_method(method_name)
     def callback(self: 'BaseHandler', client: ws_base.WebSocketClientBase, command: dict):
         method = getattr(self, method_name)
         return method(client, message_cls.from_command(command['data']))
@@ -66,14 +102,17 @@ class BaseHandler(HandlerInterface):
     一个简单的消息处理器实现，带消息分发和消息类型转换。继承并重写_on_xxx方法即可实现自己的处理器
     """
 
+    @_calls_method('_on_danmaku')
     def __danmu_msg_callback(self, client: ws_base.WebSocketClientBase, command: dict):
         return self._on_danmaku(client, web_models.DanmakuMessage.from_command(command['info']))
 
+    @_calls_method('_on_danmaku')
     def __danmu_msg_mirror_callback(self, client: ws_base.WebSocketClientBase, command: dict):
         message = web_models.DanmakuMessage.from_command(command['info'])
         message.is_mirror = True
         return self._on_danmaku(client, message)
 
+    @_calls_method('_on_open_live_danmaku')
     def __open_dm_mirror_callback(self, client: ws_base.WebSocketClientBase, command: dict):
         # 跨房弹幕可能缺少一些字段，详情参考官方文档
         message = open_models.DanmakuMessage.from_command(command['data'])
@@ -135,22 +174,62 @@ class BaseHandler(HandlerInterface):
         'LIVE_OPEN_PLATFORM_LIVE_END': _make_msg_callback('_on_open_live_end_live', open_models.LiveEndMessage),
     }
 
+    _cmd_dispatch: Dict[
+        str,
+        Callable[
+            ['BaseHandler', ws_base.WebSocketClientBase, dict],
+            Any
+        ]
+    ] = {}
+    """cmd -> 处理回调，创建子类时根据_CMD_CALLBACK_DICT编译，只包含子类关心的cmd"""
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._cmd_dispatch = cls._compile_cmd_dispatch()
+
+    @classmethod
+    def _compile_cmd_dispatch(cls):
+        """
+        从_CMD_CALLBACK_DICT中挑出子类重写了_on_xxx方法的cmd，其他cmd在构造消息模型之前就丢弃
+
+        子类要处理额外的cmd，在子类的_CMD_CALLBACK_DICT里添加即可，没有用_calls_method标记的回调总是保留
+        """
+        dispatch = {}
+        for cmd, callback in cls._CMD_CALLBACK_DICT.items():
+            if callback is None:
+                continue
+            method_name = getattr(callback, 'method_name', None)
+            # 没有标记的是子类自己加的回调，保险起见认为关心
+            if method_name is None or getattr(cls, method_name) is not getattr(BaseHandler, method_name, None):
+                dispatch[cmd] = callback
+        return dispatch
+
     def handle(self, client: ws_base.WebSocketClientBase, command: dict):
         cmd = command.get('cmd', '')
-        pos = cmd.find(':')  # 2019-5-29 B站弹幕升级新增了参数
-        if pos != -1:
-            cmd = cmd[:pos]
-
-        if cmd not in self._CMD_CALLBACK_DICT:
-            # 只有第一次遇到未知cmd时打日志
-            if cmd not in logged_unknown_cmds:
-                logger.warning('room=%d unknown cmd=%s, command=%s', client.room_id, cmd, command)
-                logged_unknown_cmds.add(cmd)
-            return
-
-        callback = self._CMD_CALLBACK_DICT[cmd]
-        if callback is not None:
-            callback(self, client, command)
+        callback = self._cmd_dispatch.get(cmd, None)
+        if callback is None:
+            stripped_cmd = utils.strip_cmd(cmd)
+            if stripped_cmd != cmd:
+                cmd = stripped_cmd
+                callback = self._cmd_dispatch.get(cmd, None)
+            if callback is None:
+                # 只有第一次遇到未知cmd时打日志，已知但不关心的cmd直接丢弃，不构造消息模型
+                if cmd not in self._CMD_CALLBACK_DICT and cmd not in logged_unknown_cmds:
+                    logger.warning('room=%d unknown cmd=%s, command=%s', client.room_id, cmd, command)
+                    logged_unknown_cmds.add(cmd)
+                return
+
+        callback(self, client, command)
+
+    def get_handled_cmds(self) -> Optional[AbstractSet[str]]:
+        """
+        返回创建子类时编译的cmd集合，即_CMD_CALLBACK_DICT中子类重写了_on_xxx方法的cmd
+
+        如果子类重写了handle则不知道会处理哪些cmd，返回None。要处理额外的cmd，建议在子类的_CMD_CALLBACK_DICT里添加
+        """
+        if type(self).handle is not BaseHandler.handle:
+            return None
+        return self._cmd_dispatch.keys()
 
     def _on_heartbeat(self, client: ws_base.WebSocketClientBase, message: web_models.HeartbeatMessage):
         """收到心跳包"""
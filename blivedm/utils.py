@@ -1,4 +1,17 @@
 # -*- coding: utf-8 -*-
+import asyncio
+import json
+import os
+import random
+import tempfile
+import time
+from typing import *
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
 USER_AGENT = (
     'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/102.0.0.0 Safari/537.36'
 )
@@ -17,3 +30,127 @@ def make_linear_retry_policy(start_interval: float, interval_step: float, max_in
             max_interval
         )
     return get_interval
+
+
+def make_exponential_jitter_retry_policy(start_interval: float, max_interval: float, multiplier: float = 2):
+    """
+    指数退避加完全随机抖动，间隔在[0, min(start_interval * multiplier ** (retry_count - 1), max_interval)]之间随机
+
+    大量客户端同时掉线时，随机抖动可以把重连分散开，不会在同一时刻一起重连
+    """
+    def get_interval(retry_count: int, _total_retry_count: int):
+        # 限制指数，防止溢出
+        exponent = min(retry_count - 1, 64)
+        return random.uniform(0, min(start_interval * multiplier ** exponent, max_interval))
+    return get_interval
+
+
+class RetryBudget:
+    """
+    重试预算，令牌桶实现。所有客户端共用一个预算时，不管多少客户端同时重连，总的重连速率都不会超过rate
+
+    不绑定事件循环，可以跨事件循环共用
+
+    :param rate: 每秒补充的令牌数，即长期的最大重试速率
+    :param burst: 令牌桶容量，即允许的突发重试次数
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self._rate = rate
+        self._burst = burst
+        self._tokens = burst
+        self._last_refill_time = time.monotonic()
+
+    @property
+    def rate(self) -> float:
+        return self._rate
+
+    @property
+    def burst(self) -> float:
+        return self._burst
+
+    @property
+    def tokens(self) -> float:
+        """
+        当前剩余的令牌数，负数表示有这么多次重试在排队
+        """
+        self._refill()
+        return self._tokens
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self._tokens + (now - self._last_refill_time) * self._rate, self._burst)
+        self._last_refill_time = now
+
+    def try_acquire(self) -> bool:
+        """
+        尝试取一个令牌，不等待
+
+        :return: 是否取到
+        """
+        self._refill()
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+    async def acquire(self):
+        """
+        取一个令牌，令牌不够时等待。先预订令牌再等待，所以先来的先取到
+        """
+        self._refill()
+        self._tokens -= 1
+        if self._tokens < 0:
+            try:
+                await asyncio.sleep(-self._tokens / self._rate)
+            except asyncio.CancelledError:
+                # 等待的时候被取消了（比如stop客户端），预订的令牌没用上，要还回去
+                self._refill()
+                self._tokens = min(self._tokens + 1, self._burst)
+                raise
+
+
+def strip_cmd(cmd: str) -> str:
+    """
+    去掉cmd后面的参数，返回消息类型
+    """
+    pos = cmd.find(':')  # 2019-5-29 B站弹幕升级新增了参数
+    if pos != -1:
+        cmd = cmd[:pos]
+    return cmd
+
+
+def write_json_file_atomically(path: str, data):
+    """
+    先写临时文件再替换，写到一半崩溃也不会损坏原来的文件。失败时抛出OSError
+    """
+    dir_name = os.path.dirname(os.path.abspath(path))
+    os.makedirs(dir_name, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=dir_name, prefix='.' + os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def stdlib_json_loads(data: Union[bytes, bytearray, memoryview, str]):
+    if isinstance(data, memoryview):
+        # 标准库不支持memoryview，直接解码成str，不经过中间的bytes
+        data = str(data, 'utf-8')
+    return json.loads(data)
+
+
+def stdlib_json_dumps(obj) -> bytes:
+    return json.dumps(obj).encode('utf-8')
+
+
+if orjson is not None:
+    # orjson可以直接解析bytes和memoryview，比标准库快很多
+    json_loads: Callable[[Union[bytes, bytearray, memoryview, str]], Any] = orjson.loads
+    json_dumps: Callable[[Any], bytes] = orjson.dumps
+else:
+    json_loads = stdlib_json_loads
+    json_dumps = stdlib_json_dumps
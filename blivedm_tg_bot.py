@@ -1,4 +1,10 @@
+import argparse
 import asyncio
+import dataclasses
+import multiprocessing
+import queue
+import signal
+import statistics
 import time
 import os
 import logging
@@ -24,19 +30,40 @@ ALT_TELEGRAM_BOT_TOKEN = os.getenv('ALT_TELEGRAM_BOT_TOKEN')
 TELEGRAM_CHAT_ID = os.getenv('TELEGRAM_CHAT_ID')
 ROOM_ID = os.getenv('ROOM_ID', '').split(',') if os.getenv('ROOM_ID') else []
 SESSDATA = os.getenv('SESSDATA', '')
+# 每个房间待发送消息队列的长度，满了先丢进房、点赞等不重要的消息
+EVENT_QUEUE_SIZE = int(os.getenv('EVENT_QUEUE_SIZE', '1000'))
+# 重点房间，额外保持一条备用连接，掉线重连时不丢消息（可选）
+VIP_ROOM_ID = {int(room) for room in os.getenv('VIP_ROOM_ID', '').split(',') if room.strip()}
+# 录制收到的 WebSocket 消息，用于离线回放压测（可选）
+CAPTURE_FILE = os.getenv('CAPTURE_FILE', '')
+# 把房间分到多个进程，每个进程一个事件循环，可以用满多核（默认 1，不分片）
+SHARDS = int(os.getenv('SHARDS', '1'))
+# 分片进程上报负载的间隔（秒）
+LOAD_REPORT_INTERVAL = float(os.getenv('LOAD_REPORT_INTERVAL', '60'))
+# 缓存房间信息等基本不变的数据，重启时少发请求
+CACHE_DIR = os.getenv('CACHE_DIR', 'cache')
+# 冷启动时每秒最多启动几个房间，重点房间先启动，0 表示不限制。分片时所有进程加起来的速率
+STARTUP_RATE = float(os.getenv('STARTUP_RATE', '2'))
+# 冷启动后等这么久（秒）汇总各房间收到第一条消息的耗时
+STARTUP_REPORT_TIMEOUT = 600
+# 事件循环实现：auto（装了 uvloop 就用）、uvloop、asyncio，也可以用命令行参数 --loop 指定
+EVENT_LOOP = os.getenv('EVENT_LOOP', 'auto')
 
 os.makedirs('logs', exist_ok=True)
 
 # ================= 异步 Telegram =================
+# 按顺序尝试，前一个失败了才用下一个
+TELEGRAM_API_BASES = [
+    "https://tgapi.chenguaself.tk",
+    "https://api.telegram.org",
+]
+
 async def send_telegram(session: aiohttp.ClientSession, message: str, use_alt_bot=False):
     bot_token = ALT_TELEGRAM_BOT_TOKEN if use_alt_bot else TELEGRAM_BOT_TOKEN
     chat_id = TELEGRAM_CHAT_ID
     if not bot_token or not chat_id:
         return
-    api_urls = [
-        f"https://tgapi.chenguaself.tk/bot{bot_token}/sendMessage",
-        f"https://api.telegram.org/bot{bot_token}/sendMessage"
-    ]
+    api_urls = [f"{base}/bot{bot_token}/sendMessage" for base in TELEGRAM_API_BASES]
     data = {
         "chat_id": chat_id,
         "text": message.strip(),
@@ -58,52 +85,76 @@ class MyHandler(blivedm.BaseHandler):
     def __init__(self, session: aiohttp.ClientSession):
         super().__init__()
         self.session = session
+        # 正在处理一批消息时，渲染好的消息先攒在这里，处理完一起写日志、发送
+        self._batch: Optional[list] = None
 
     # ---------------- 日志 ----------------
     def _get_log_filename(self, prefix: str) -> str:
         from datetime import datetime
         return f'logs/{prefix}_{datetime.now().strftime("%Y-%m-%d")}.log'
 
-    def _write_log(self, prefix: str, content: str):
-        try:
-            filename = self._get_log_filename(prefix)
+    def _write_logs(self, entries):
+        """entries: [(prefix, content), ...]，同一个文件只打开一次"""
+        from datetime import datetime
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        prefix_to_lines = {}
+        for prefix, content in entries:
             content = content.translate(str.maketrans('', '', '💬🎁🚢💎🚪🎮❤️⭐🔄👍'))
-            with open(filename, 'a', encoding='utf-8') as f:
-                from datetime import datetime
-                timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                f.write(f'[{timestamp}] {content}\n')
-        except Exception as e:
-            logger.error(f"写入日志失败: {e}")
+            prefix_to_lines.setdefault(prefix, []).append(f'[{timestamp}] {content}\n')
+        for prefix, lines in prefix_to_lines.items():
+            try:
+                with open(self._get_log_filename(prefix), 'a', encoding='utf-8') as f:
+                    f.writelines(lines)
+            except Exception as e:
+                logger.error(f"写入日志失败: {e}")
 
-    async def _handle_message(self, prefix: str, content: str, tg_content: str, use_alt_bot=False):
+    async def _handle_messages(self, messages):
+        """messages: [(prefix, content, tg_content, use_alt_bot), ...]，按顺序发送"""
         try:
-            print(content)
-            self._write_log(prefix, content)
-            await send_telegram(self.session, tg_content, use_alt_bot)
+            for _, content, _, _ in messages:
+                print(content)
+            self._write_logs([(prefix, content) for prefix, content, _, _ in messages])
+            for _, _, tg_content, use_alt_bot in messages:
+                await send_telegram(self.session, tg_content, use_alt_bot)
         except Exception as e:
             logger.error(f"处理消息时发生错误: {e}")
 
-    # ---------------- 覆盖 handle，处理额外互动消息 ----------------
-    def handle(self, client, command):
-        cmd = command.get('cmd', '')
-
-        # 额外互动消息
-        if cmd == 'LIKE_INFO_V3_CLICK':
-            data = command.get('data', {})
-            uname = data.get('uname') or '未知用户'
-            uid = data.get('uid') or 0
-            user_link = f'<a href="https://space.bilibili.com/{uid}">{uname}</a>'
-            content = f'👍 [{client.room_id}] {uname} 点赞了直播间'
-            tg_content = f'👍 [{client.room_id}] {user_link} 点赞了直播间'
-            asyncio.create_task(self._handle_message('like', content, tg_content))
-            return
+    def _emit(self, prefix: str, content: str, tg_content: str, use_alt_bot=False):
+        message = (prefix, content, tg_content, use_alt_bot)
+        if self._batch is not None:
+            self._batch.append(message)
+        else:
+            asyncio.create_task(self._handle_messages([message]))
 
-        if cmd == 'LIKE_INFO_V3_UPDATE':
-            # 总点赞更新，可忽略
-            return
+    # ---------------- 一批消息一起处理 ----------------
+    def handle_batch(self, client, commands):
+        self._batch = []
+        try:
+            super().handle_batch(client, commands)
+        finally:
+            batch, self._batch = self._batch, None
+        if batch:
+            # 客户端的消费协程会等发送完再取下一批，Telegram 慢时消息积压在有界队列里
+            return self._handle_messages(batch)
+        return None
+
+    # ---------------- 额外互动消息 ----------------
+    # 不重写 handle，而是注册到 _CMD_CALLBACK_DICT，这样客户端可以在反序列化前丢弃没人处理的消息
+    def __like_click_callback(self, client, command):
+        data = command.get('data', {})
+        uname = data.get('uname') or '未知用户'
+        uid = data.get('uid') or 0
+        user_link = f'<a href="https://space.bilibili.com/{uid}">{uname}</a>'
+        content = f'👍 [{client.room_id}] {uname} 点赞了直播间'
+        tg_content = f'👍 [{client.room_id}] {user_link} 点赞了直播间'
+        self._emit('like', content, tg_content)
 
-        # 父类处理标准消息
-        super().handle(client, command)
+    _CMD_CALLBACK_DICT = {
+        **blivedm.BaseHandler._CMD_CALLBACK_DICT,
+        'LIKE_INFO_V3_CLICK': __like_click_callback,
+        # 总点赞更新，可忽略
+        'LIKE_INFO_V3_UPDATE': None,
+    }
 
     # ---------------- 弹幕/礼物/上舰/SC/互动 ----------------
     def _on_danmaku(self, client, message: web_models.DanmakuMessage):
@@ -113,7 +164,7 @@ class MyHandler(blivedm.BaseHandler):
         user_link = f'<a href="https://space.bilibili.com/{message.uid}">{message.uname}</a>'
         content = f'💬 [{client.room_id}] {message.uname}: {message.msg}'
         tg_content = f'💬 [{client.room_id}] {user_link}: {message.msg}'
-        asyncio.create_task(self._handle_message('danmaku', content, tg_content))
+        self._emit('danmaku', content, tg_content)
 
     def _on_gift(self, client, message: web_models.GiftMessage):
         if not message.gift_name or not message.uname:
@@ -122,7 +173,7 @@ class MyHandler(blivedm.BaseHandler):
         coin_display = f'{message.total_coin}{"金" if message.coin_type=="gold" else "银"}瓜子'
         content = f'🎁 [{client.room_id}] {message.uname} 赠送 {message.gift_name}x{message.num} ({coin_display})'
         tg_content = f'🎁 [{client.room_id}] {user_link} 赠送 {message.gift_name}x{message.num} ({coin_display})'
-        asyncio.create_task(self._handle_message('gift', content, tg_content))
+        self._emit('gift', content, tg_content)
 
     def _on_user_toast_v2(self, client, message: web_models.UserToastV2Message):
         if message.source == 2 or not message.username:
@@ -132,7 +183,7 @@ class MyHandler(blivedm.BaseHandler):
         user_link = f'<a href="https://space.bilibili.com/{message.uid}">{message.username}</a>'
         content = f'🚢 [{client.room_id}] {message.username} 开通了{guard_name} x{message.num}{message.unit}'
         tg_content = f'🚢 [{client.room_id}] {user_link} 开通了{guard_name} x{message.num}{message.unit}'
-        asyncio.create_task(self._handle_message('guard', content, tg_content))
+        self._emit('guard', content, tg_content)
 
     def _on_super_chat(self, client, message: web_models.SuperChatMessage):
         if not message.uname or not message.message:
@@ -140,7 +191,7 @@ class MyHandler(blivedm.BaseHandler):
         user_link = f'<a href="https://space.bilibili.com/{message.uid}">{message.uname}</a>'
         content = f'💎 [{client.room_id}] SC ¥{message.price} {message.uname}: {message.message}'
         tg_content = f'💎 [{client.room_id}] SC ¥{message.price} {user_link}: {message.message}'
-        asyncio.create_task(self._handle_message('superchat', content, tg_content))
+        self._emit('superchat', content, tg_content)
 
     def _on_interact_word_v2(self, client, message: web_models.InteractWordV2Message):
         if not message.username:
@@ -160,55 +211,301 @@ class MyHandler(blivedm.BaseHandler):
         content = f'{emoji} [{client.room_id}] {message.username} {action}'
         tg_content = f'{emoji} [{client.room_id}] {user_link} {action}'
         use_alt = message.msg_type in [1,3]
-        asyncio.create_task(self._handle_message('interact', content, tg_content, use_alt_bot=use_alt))
+        self._emit('interact', content, tg_content, use_alt_bot=use_alt)
 
 # ================= 多房间守护 + -352 风控 =================
-async def run_forever(room_id: int, session: aiohttp.ClientSession, handler: MyHandler):
-    cooldown_352 = 4 * 3600
-    delay = 1.0
-    max_delay = 60.0
+# 指数退避加随机抖动，避免大量房间同时重启
+get_backoff_interval = blivedm.utils.make_exponential_jitter_retry_policy(1.0, 60.0)
+
+
+def get_restart_interval(restart_count: int, exception: Optional[Exception]) -> Optional[float]:
+    """房间客户端异常停止后，由客户端池按这个策略统一安排重启"""
+    if isinstance(exception, blivedm.clients.ws_base.AuthError):
+        # Session 异常，重启也没用
+        return None
+    # 其他异常（包括边缘节点返回 4xx/5xx、风控返回 HTML 页面）大多是暂时的，退避后重启
+    # -352 风控由 BotRequestGovernor 按接口降速、试探恢复，这里不用单独冷却
+    return get_backoff_interval(restart_count, restart_count)
+
+
+class BotRequestGovernor(blivedm.RequestGovernor):
+    """B 站接口遇到风控、恢复时发通知"""
+
+    def __init__(self, session: aiohttp.ClientSession):
+        super().__init__()
+        self.session = session
+
+    def _on_throttled(self, endpoint: str, cooldown: float):
+        asyncio.create_task(send_telegram(
+            self.session, f'⚠ 接口 {endpoint} 遇到风控，{cooldown / 60:.0f} 分钟后试探恢复'
+        ))
+
+    def _on_recovered(self, endpoint: str):
+        asyncio.create_task(send_telegram(self.session, f'✅ 接口 {endpoint} 已从风控中恢复'))
+
+
+class BotHandler(MyHandler):
+    """在 MyHandler 的基础上，房间停止时发通知，统计处理的消息数"""
+
+    def __init__(self, session: aiohttp.ClientSession):
+        super().__init__(session)
+        self.command_count = 0
+
+    def handle_batch(self, client, commands):
+        self.command_count += len(commands)
+        return super().handle_batch(client, commands)
+
+    def on_client_stopped(self, client, exception):
+        room_id = client.tmp_room_id
+        if isinstance(exception, blivedm.clients.ws_base.AuthError):
+            logger.error(f'房间 {room_id} Session 异常: {exception}')
+            asyncio.create_task(send_telegram(self.session, f'❌ 房间 {room_id} Session 异常，请检查 SESSDATA'))
+        elif exception is not None:
+            logger.error(f'房间 {room_id} 异常停止: {exception!r}')
+
+# ================= 运行一组房间 =================
+@dataclasses.dataclass
+class ShardLoad:
+    """分片进程定时上报给主进程的负载"""
+    shard: int
+    pid: int
+    room_count: int
+    running_room_count: int
+    cpu_time: float
+    """进程累计 CPU 时间（秒）"""
+    command_count: int
+    """累计处理的消息数"""
+    drop_count: int
+    """消息队列累计丢弃的消息数"""
 
-    while True:
-        client = blivedm.BLiveClient(room_id, session=session)
-        client.set_handler(handler)
 
+def parse_room_ids(rooms) -> list:
+    return [int(room) for room in rooms if room.strip()]
+
+
+async def report_shard_load(shard: int, load_queue, pool: blivedm.BLiveClientPool, handler: BotHandler, event_queues):
+    while True:
+        await asyncio.sleep(LOAD_REPORT_INTERVAL)
+        load = ShardLoad(
+            shard=shard,
+            pid=os.getpid(),
+            room_count=len(event_queues),
+            running_room_count=sum(1 for state in pool.get_room_states() if state.status == blivedm.RoomStatus.RUNNING),
+            cpu_time=time.process_time(),
+            command_count=handler.command_count,
+            drop_count=sum(event_queue.stats.drop_count for event_queue in event_queues),
+        )
         try:
+            load_queue.put_nowait(load)
+        except queue.Full:
+            pass
+
+
+async def report_startup(pool: blivedm.BLiveClientPool):
+    """所有房间都收到第一条消息后（最多等 STARTUP_REPORT_TIMEOUT 秒）汇总冷启动耗时"""
+    deadline = time.monotonic() + STARTUP_REPORT_TIMEOUT
+    while True:
+        states = pool.get_room_states()
+        if time.monotonic() >= deadline or all(state.time_to_first_message is not None for state in states):
+            break
+        await asyncio.sleep(5)
+
+    times = sorted(state.time_to_first_message for state in states if state.time_to_first_message is not None)
+    if times:
+        logger.info(
+            f'冷启动：{len(times)}/{len(states)} 个房间收到消息，'
+            f'中位数 {statistics.median(times):.1f} 秒，最慢 {times[-1]:.1f} 秒'
+        )
+    missing = [state.tmp_room_id for state in states if state.time_to_first_message is None]
+    if missing:
+        logger.warning(f'房间 {missing} 启动 {STARTUP_REPORT_TIMEOUT} 秒后还没收到消息')
+
+
+async def run_rooms(room_ids, shard: Optional[int] = None, load_queue=None, startup_rate=STARTUP_RATE):
+    """在当前进程的事件循环里监听一组房间，load_queue 不为 None 时定时上报负载"""
+    async with aiohttp.ClientSession(cookies={'SESSDATA': SESSDATA}) as session:
+        pool = blivedm.BLiveClientPool(
+            session=session,
+            restart_policy=get_restart_interval,
+            startup_rate=startup_rate if startup_rate > 0 else None,
+        )
+        handler = BotHandler(session)
+        pool.set_handler(handler)
+        recorder = None
+        if CAPTURE_FILE:
+            # 多个进程不能写同一个文件
+            recorder = blivedm.FrameRecorder(CAPTURE_FILE if shard is None else f'{CAPTURE_FILE}.{shard}')
+        # 同一个账号的所有房间共用，风控时按接口降速
+        request_governor = BotRequestGovernor(session)
+        room_info_cache = blivedm.RoomInfoCache(os.path.join(CACHE_DIR, 'room_info.json'))
+        event_queues = []
+        for room_id in room_ids:
+            client = pool.add_room(
+                room_id,
+                # 重点房间先启动
+                priority=0 if room_id in VIP_ROOM_ID else 1,
+                redundant=room_id in VIP_ROOM_ID,
+                room_info_cache=room_info_cache,
+                wbi_key_file=os.path.join(CACHE_DIR, 'wbi_key.json'),
+                request_governor=request_governor,
+            )
+            client.set_frame_recorder(recorder)
+            event_queue = blivedm.EventQueue(EVENT_QUEUE_SIZE)
+            client.set_event_queue(event_queue)
+            # 连接还在但是很久收不到消息时主动重连
+            client.set_stall_watchdog(blivedm.clients.ws_base.StallWatchdogConfig())
+            event_queues.append(event_queue)
             logger.info(f'房间 {room_id} 启动监听')
-            client.start()
-            await client.join()
-            delay = 1.0
 
-        except aiohttp.ClientError as e:
-            logger.error(f'房间 {room_id} Session 异常: {e}')
-            await send_telegram(session, f'❌ 房间 {room_id} Session 异常，请检查 SESSDATA')
+        pool.start()
+        report_tasks = [asyncio.create_task(report_startup(pool))]
+        if load_queue is not None:
+            report_tasks.append(asyncio.create_task(
+                report_shard_load(shard, load_queue, pool, handler, event_queues)
+            ))
+        try:
+            await pool.join()
+        finally:
+            for report_task in report_tasks:
+                report_task.cancel()
+            await pool.stop_and_close()
+            if recorder is not None:
+                recorder.close()
+
+# ================= 事件循环 =================
+def install_event_loop(name: str) -> str:
+    """按名字设置事件循环实现，返回实际用的实现。uvloop 只是可选依赖，没装时退回默认事件循环"""
+    if name not in ('auto', 'uvloop', 'asyncio'):
+        raise ValueError(f'未知的事件循环实现: {name}')
+    if name == 'asyncio':
+        return 'asyncio'
+    try:
+        import uvloop
+    except ImportError:
+        if name == 'uvloop':
+            logger.warning('没有安装 uvloop，使用默认事件循环')
+        return 'asyncio'
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return 'uvloop'
+
+# ================= 多进程分片 =================
+async def run_shard(shard: int, room_ids, load_queue, startup_rate: float):
+    # 主进程 terminate 时正常关闭客户端
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    try:
+        await run_rooms(room_ids, shard, load_queue, startup_rate)
+    except asyncio.CancelledError:
+        pass
+
+
+def shard_worker(shard: int, room_ids, load_queue, event_loop: str, startup_rate: float):
+    # 主进程负责处理 Ctrl+C，子进程由主进程 terminate
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # 用 spawn 启动子进程时不会继承主进程的设置
+    install_event_loop(event_loop)
+    logger.info(f'分片 {shard} 启动，pid={os.getpid()}，房间 {room_ids}')
+    asyncio.run(run_shard(shard, room_ids, load_queue, startup_rate))
+
+
+class ShardSupervisor:
+    """把房间分到多个进程，进程退出了按退避策略重启，汇总各分片上报的负载"""
+
+    def __init__(self, room_ids, shard_count: int, event_loop: str = 'asyncio'):
+        self.event_loop = event_loop
+        self.shard_rooms = [room_ids[i::shard_count] for i in range(shard_count)]
+        self.load_queue = multiprocessing.Queue(maxsize=1000)
+        self.processes: list = [None] * shard_count
+        self.restart_counts = [0] * shard_count
+        self.restart_times: list = [None] * shard_count
+        """分片下次重启的时间，None 表示没在等待重启"""
+        self.last_loads: dict = {}
+        """分片 -> (上报时间, ShardLoad)，用来算 CPU 占用和消息速率"""
+
+    def start_shard(self, shard: int):
+        process = multiprocessing.Process(
+            target=shard_worker,
+            # 启动速率按分片平分
+            args=(shard, self.shard_rooms[shard], self.load_queue, self.event_loop,
+                  STARTUP_RATE / len(self.shard_rooms)),
+            name=f'shard-{shard}',
+        )
+        process.start()
+        self.processes[shard] = process
+        self.restart_times[shard] = None
+
+    def check_shards(self):
+        now = time.monotonic()
+        for shard, process in enumerate(self.processes):
+            if self.restart_times[shard] is not None:
+                if now >= self.restart_times[shard]:
+                    logger.warning(f'分片 {shard} 重启，第 {self.restart_counts[shard]} 次')
+                    self.start_shard(shard)
+                continue
+            if process.is_alive():
+                continue
+            self.restart_counts[shard] += 1
+            interval = get_backoff_interval(self.restart_counts[shard], self.restart_counts[shard])
+            logger.error(f'分片 {shard} 退出了，exitcode={process.exitcode}，{interval:.1f} 秒后重启')
+            self.restart_times[shard] = now + interval
+            self.last_loads.pop(shard, None)
+
+    def on_load(self, load: ShardLoad):
+        now = time.monotonic()
+        last = self.last_loads.get(load.shard)
+        self.last_loads[load.shard] = (now, load)
+        if last is None or last[1].pid != load.pid:
             return
+        last_time, last_load = last
+        elapsed = now - last_time
+        cpu = (load.cpu_time - last_load.cpu_time) / elapsed * 100
+        rate = (load.command_count - last_load.command_count) / elapsed * 60
+        logger.info(
+            f'分片 {load.shard} pid={load.pid}: 房间 {load.running_room_count}/{load.room_count}，'
+            f'CPU {cpu:.1f}%，消息 {rate:.0f}/分钟，队列丢弃 {load.drop_count}'
+        )
 
-        except Exception as e:
-            # 处理 B 站 -352 风控
-            if getattr(e, 'code', None) == -352:
-                logger.warning(f'房间 {room_id} 遇到 -352 风控，冷却 4 小时')
-                await send_telegram(session, f'⚠ 房间 {room_id} 遇到 -352 风控，4 小时后重试')
-                await asyncio.sleep(cooldown_352)
-            else:
-                logger.error(f'房间 {room_id} 异常: {e}，{delay}s 后重连')
-                await asyncio.sleep(delay)
-                delay = min(delay * 2, max_delay)
+    def run(self):
+        def on_sigterm(_signum, _frame):
+            raise KeyboardInterrupt
+        signal.signal(signal.SIGTERM, on_sigterm)
 
+        for shard in range(len(self.shard_rooms)):
+            self.start_shard(shard)
+        try:
+            while True:
+                try:
+                    self.on_load(self.load_queue.get(timeout=1))
+                except queue.Empty:
+                    pass
+                self.check_shards()
+        except KeyboardInterrupt:
+            pass
         finally:
-            client.stop()
-            await asyncio.sleep(1)
+            for process in self.processes:
+                if process is not None and process.is_alive():
+                    process.terminate()
+            for process in self.processes:
+                if process is not None:
+                    process.join(10)
+                    if process.is_alive():
+                        process.kill()
 
 # ================= main =================
-async def main():
-    async with aiohttp.ClientSession(cookies={'SESSDATA': SESSDATA}) as session:
-        handler = MyHandler(session)
-        tasks = []
-        for room in ROOM_ID:
-            room = room.strip()
-            if not room:
-                continue
-            tasks.append(run_forever(int(room), session, handler))
-        await asyncio.gather(*tasks)
+def main():
+    parser = argparse.ArgumentParser(description='B站直播弹幕转发到Telegram')
+    parser.add_argument('--loop', choices=('auto', 'uvloop', 'asyncio'), default=EVENT_LOOP,
+                        help='事件循环实现，默认取环境变量 EVENT_LOOP，auto 表示装了 uvloop 就用')
+    args = parser.parse_args()
+
+    event_loop = install_event_loop(args.loop)
+    logger.info(f'事件循环: {event_loop}')
+    room_ids = parse_room_ids(ROOM_ID)
+    shard_count = min(SHARDS, len(room_ids))
+    if shard_count > 1:
+        logger.info(f'{len(room_ids)} 个房间分到 {shard_count} 个进程')
+        ShardSupervisor(room_ids, shard_count, event_loop).run()
+    else:
+        asyncio.run(run_rooms(room_ids))
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    main()
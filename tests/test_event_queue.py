@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import unittest
+
+from blivedm.clients import event_queue
+
+
+def _make_commands(*cmds):
+    return [{'cmd': cmd, 'index': index} for index, cmd in enumerate(cmds)]
+
+
+class EventQueueTest(unittest.IsolatedAsyncioTestCase):
+    async def test_get_batch_keeps_order(self):
+        queue = event_queue.EventQueue(max_size=10)
+        commands = _make_commands('INTERACT_WORD', 'SEND_GIFT', 'DANMU_MSG', 'INTERACT_WORD')
+        queue.put_batch(commands)
+        # 优先级只决定丢谁，取出来还是收到的顺序
+        self.assertEqual(await queue.get_batch(), commands)
+        self.assertEqual(queue.size, 0)
+
+    async def test_drop_lowest_priority(self):
+        queue = event_queue.EventQueue(max_size=3, drop_policy=event_queue.DropPolicy.DROP_LOWEST_PRIORITY)
+        queue.put_batch(_make_commands(
+            'SEND_GIFT', 'INTERACT_WORD', 'DANMU_MSG', 'SEND_GIFT', 'INTERACT_WORD', 'SUPER_CHAT_MESSAGE'
+        ))
+        self.assertEqual(queue.size, 3)
+
+        cmds = [command['cmd'] for command in await queue.get_batch()]
+        self.assertEqual(cmds, ['SEND_GIFT', 'SEND_GIFT', 'SUPER_CHAT_MESSAGE'])
+        stats = queue.stats
+        self.assertEqual(stats.put_count, 6)
+        self.assertEqual(stats.drop_count, 3)
+        self.assertEqual(stats.drop_counts, {'INTERACT_WORD': 2, 'DANMU_MSG': 1})
+        self.assertEqual(stats.max_size_reached, 3)
+
+    async def test_drop_oldest(self):
+        queue = event_queue.EventQueue(max_size=2, drop_policy=event_queue.DropPolicy.DROP_OLDEST)
+        commands = _make_commands('SEND_GIFT', 'DANMU_MSG', 'INTERACT_WORD')
+        queue.put_batch(commands)
+        self.assertEqual(await queue.get_batch(), commands[1:])
+        self.assertEqual(queue.stats.drop_counts, {'SEND_GIFT': 1})
+
+    async def test_max_batch_size(self):
+        queue = event_queue.EventQueue(max_size=10, max_batch_size=2)
+        commands = _make_commands('DANMU_MSG', 'DANMU_MSG', 'DANMU_MSG')
+        queue.put_batch(commands)
+        self.assertEqual(await queue.get_batch(), commands[:2])
+        self.assertEqual(await queue.get_batch(), commands[2:])
+
+    async def test_block(self):
+        queue = event_queue.EventQueue(max_size=2, drop_policy=event_queue.DropPolicy.BLOCK)
+        commands = _make_commands('DANMU_MSG', 'DANMU_MSG', 'DANMU_MSG')
+        queue.put_batch(commands)
+        # BLOCK不丢消息，生产者要等消费者取走
+        self.assertEqual(queue.size, 3)
+        self.assertEqual(queue.stats.drop_count, 0)
+
+        wait_task = asyncio.create_task(queue.wait_not_full())
+        await asyncio.sleep(0.01)
+        self.assertFalse(wait_task.done())
+
+        self.assertEqual(await queue.get_batch(), commands)
+        await asyncio.wait_for(wait_task, 1)
+
+    async def test_get_batch_waits(self):
+        queue = event_queue.EventQueue(max_size=10)
+        get_task = asyncio.create_task(queue.get_batch())
+        await asyncio.sleep(0.01)
+        self.assertFalse(get_task.done())
+
+        commands = _make_commands('DANMU_MSG')
+        queue.put_batch(commands)
+        self.assertEqual(await asyncio.wait_for(get_task, 1), commands)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+import contextlib
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import aiohttp
+
+import blivedm
+from blivedm.clients import open_live
+
+
+class _FakeResponse:
+    def __init__(self, data):
+        self.status = 200
+        self.reason = 'OK'
+        self._data = data
+
+    async def json(self):
+        return self._data
+
+
+class _FakeOpenLive:
+    """
+    替换open_live._request_open_live，记录请求，按URL返回固定的响应
+    """
+
+    def __init__(self, url_to_data):
+        self.url_to_data = url_to_data
+        self.requests = []
+
+    @contextlib.asynccontextmanager
+    async def request(self, _session, _access_key_id, _access_key_secret, url, body):
+        self.requests.append((url, body))
+        yield _FakeResponse(self.url_to_data[url])
+
+
+def _make_start_data(game_id):
+    return {
+        'game_info': {'game_id': game_id},
+        'websocket_info': {'auth_body': '{}', 'wss_link': ['wss://127.0.0.1/sub']},
+        'anchor_info': {'room_id': 1, 'uid': 2, 'open_id': 'open-id'},
+    }
+
+
+class _OpenLiveTestBase(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.session = aiohttp.ClientSession()
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.state_file = os.path.join(tmp_dir.name, 'games.json')
+
+    async def asyncTearDown(self):
+        await self.session.close()
+
+    def _make_client(self, auth_code='code'):
+        return blivedm.OpenLiveClient(
+            'key-id', 'key-secret', 1, auth_code, session=self.session, game_state_file=self.state_file
+        )
+
+    def _patch_open_live(self, url_to_data):
+        fake = _FakeOpenLive(url_to_data)
+        patcher = mock.patch.object(open_live, '_request_open_live', fake.request)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return fake
+
+    def _get_saved_game_ids(self):
+        return {
+            state['data']['game_info']['game_id']
+            for state in open_live._load_game_states(self.state_file).values()  # noqa
+        }
+
+
+class GameHeartbeatBatcherTest(_OpenLiveTestBase):
+    async def _send_batch(self, client, sent_game_id, failed_game_ids):
+        self._patch_open_live({
+            open_live.BATCH_HEARTBEAT_URL: {'code': 0, 'data': {'failed_game_ids': failed_game_ids}},
+        })
+        await open_live.GameHeartbeatBatcher._send_heartbeat(  # noqa
+            self.session, 'key-id', 'key-secret', {sent_game_id: client}
+        )
+
+    async def test_failed_game_restarted(self):
+        client = self._make_client()
+        client._parse_start_game(_make_start_data('game-1'))  # noqa
+        open_live._update_game_state(self.state_file, client._game_state_key, {'data': _make_start_data('game-1')})  # noqa
+        client._need_init_room = False
+
+        await self._send_batch(client, 'game-1', ['game-1'])
+        self.assertTrue(client._need_init_room)
+        self.assertEqual(self._get_saved_game_ids(), set())
+        await client.close()
+
+    async def test_stale_failed_game_ignored(self):
+        client = self._make_client()
+        # 发批量心跳时还是game-1，收到响应前已经重新开启了game-2
+        client._parse_start_game(_make_start_data('game-2'))  # noqa
+        open_live._update_game_state(self.state_file, client._game_state_key, {'data': _make_start_data('game-2')})  # noqa
+        client._need_init_room = False
+
+        await self._send_batch(client, 'game-1', ['game-1'])
+        self.assertFalse(client._need_init_room)
+        self.assertEqual(self._get_saved_game_ids(), {'game-2'})
+        await client.close()
+
+
+class GameStateFileTest(_OpenLiveTestBase):
+    def _patch_platform(self, new_game_id='game-new'):
+        return self._patch_open_live({
+            open_live.START_URL: {'code': 0, 'data': _make_start_data(new_game_id)},
+            open_live.HEARTBEAT_URL: {'code': 0},
+        })
+
+    def _save_game(self, client, game_id, alive_time):
+        open_live._update_game_state(self.state_file, client._game_state_key, {  # noqa
+            'data': _make_start_data(game_id),
+            'alive_time': alive_time,
+        })
+
+    def _get_request_urls(self, fake):
+        return [url for url, _body in fake.requests]
+
+    async def test_resume(self):
+        fake = self._patch_platform()
+        client = self._make_client()
+        self._save_game(client, 'game-old', time.time() - 10)
+
+        self.assertTrue(await client.init_room())
+        self.assertEqual(client.game_id, 'game-old')
+        self.assertEqual(self._get_request_urls(fake), [open_live.HEARTBEAT_URL])
+        await client.close()
+
+    async def test_skip_expired_state(self):
+        fake = self._patch_platform()
+        client = self._make_client()
+        # 停止心跳超过服务器的超时时间，项目已经被关闭了，不用再试
+        self._save_game(client, 'game-old', time.time() - open_live.GAME_HEARTBEAT_TIMEOUT - 1)
+
+        self.assertTrue(await client.init_room())
+        self.assertEqual(client.game_id, 'game-new')
+        self.assertEqual(self._get_request_urls(fake), [open_live.START_URL])
+        self.assertEqual(self._get_saved_game_ids(), {'game-new'})
+        await client.close()
+
+    async def test_resume_after_long_run(self):
+        fake = self._patch_platform()
+        client = self._make_client()
+        self.assertTrue(await client.init_room())
+        # 运行了几分钟，文件里的时间早就超时了，但是项目心跳一直成功
+        self._save_game(client, 'game-new', time.time() - open_live.GAME_HEARTBEAT_TIMEOUT * 5)
+        self.assertTrue(await client._send_game_heartbeat())  # noqa
+        fake.requests.clear()
+
+        # 重连太多次或者认证失败时会在同一个进程里重新init_room
+        self.assertTrue(await client.init_room())
+        self.assertEqual(client.game_id, 'game-new')
+        self.assertEqual(self._get_request_urls(fake), [open_live.HEARTBEAT_URL])
+        self.assertEqual(self._get_saved_game_ids(), {'game-new'})
+        await client.close()
+
+    async def test_close_saves_alive_time(self):
+        fake = self._patch_platform()
+        client = self._make_client()
+        self.assertTrue(await client.init_room())
+        self.assertTrue(await client._send_game_heartbeat())  # noqa
+        alive_time = client._game_alive_time  # noqa
+
+        await client.close()
+        self.assertNotIn(open_live.END_URL, self._get_request_urls(fake))
+        state = open_live._load_game_states(self.state_file)[client._game_state_key]  # noqa
+        self.assertEqual(state['alive_time'], alive_time)
+        self.assertEqual(state['data']['game_info']['game_id'], 'game-new')
+
+
+if __name__ == '__main__':
+    unittest.main()
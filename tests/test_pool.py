@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import unittest
+from unittest import mock
+
+import aiohttp
+
+import blivedm
+from blivedm.clients import pool as pool_module
+from blivedm.clients import web
+
+
+def _make_content_type_error():
+    # 风控时接口可能返回HTML页面，res.json()会抛这个异常
+    return aiohttp.ContentTypeError(None, (), message='Attempt to decode JSON with unexpected mimetype: text/html')
+
+
+async def _wait_until(predicate, timeout=2.):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not predicate():
+        if loop.time() >= deadline:
+            raise AssertionError('timed out')
+        await asyncio.sleep(0.01)
+
+
+class PoolSharedInitTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.session = aiohttp.ClientSession()
+        # 不真的连接
+        patcher = mock.patch.object(web.BLiveClient, 'start')
+        self.start_mock = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def asyncTearDown(self):
+        await self.session.close()
+
+    def _make_pool(self, restart_policy):
+        pool = blivedm.BLiveClientPool(session=self.session, restart_policy=restart_policy, retry_budget=None)
+        for room_id in (1, 2, 3):
+            pool.add_room(room_id)
+        return pool
+
+    def _all_running(self, pool):
+        return all(state.status == blivedm.RoomStatus.RUNNING for state in pool.get_room_states())
+
+    async def test_retry_after_exception(self):
+        pool = self._make_pool(lambda restart_count, exception: 0.01)
+        call_count = 0
+
+        async def init_shared():
+            nonlocal call_count
+            call_count += 1
+            if call_count <= 2:
+                raise _make_content_type_error()
+            pool._uid = 42
+
+        with mock.patch.object(pool, '_init_shared', init_shared):
+            pool.start()
+            await _wait_until(lambda: self._all_running(pool))
+        self.assertEqual(call_count, 3)
+        self.assertTrue(pool.is_running)
+        self.assertEqual([client.uid for client in pool.clients], [42, 42, 42])
+        await pool.stop_and_close()
+
+    async def test_fall_back_to_uid_0(self):
+        pool = self._make_pool(lambda restart_count, exception: 0.01)
+        init_shared = mock.AsyncMock(side_effect=_make_content_type_error())
+
+        with mock.patch.object(pool, '_init_shared', init_shared):
+            pool.start()
+            await _wait_until(lambda: self._all_running(pool))
+        self.assertEqual(init_shared.call_count, pool_module.SHARED_INIT_MAX_RETRY_COUNT + 1)
+        self.assertTrue(pool.is_running)
+        self.assertEqual([client.uid for client in pool.clients], [0, 0, 0])
+        self.assertEqual(self.start_mock.call_count, 3)
+        await pool.stop_and_close()
+
+    async def test_policy_gives_up(self):
+        pool = self._make_pool(lambda restart_count, exception: None)
+        init_shared = mock.AsyncMock(side_effect=_make_content_type_error())
+
+        with mock.patch.object(pool, '_init_shared', init_shared):
+            pool.start()
+            await _wait_until(lambda: self._all_running(pool))
+        self.assertEqual(init_shared.call_count, 1)
+        self.assertEqual([client.uid for client in pool.clients], [0, 0, 0])
+        await pool.stop_and_close()
+
+
+class PoolFirstMessageTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.session = aiohttp.ClientSession()
+        patcher = mock.patch.object(web.BLiveClient, 'start')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def asyncTearDown(self):
+        await self.session.close()
+
+    async def test_heartbeat_not_first_message(self):
+        pool = blivedm.BLiveClientPool(session=self.session, retry_budget=None)
+        client = pool.add_room(1, uid=0)
+        with mock.patch.object(pool, '_init_shared', mock.AsyncMock()):
+            pool.start()
+            await _wait_until(lambda: pool.get_room_state(1).status == blivedm.RoomStatus.RUNNING)
+
+        pool_handler = pool._pool_handler  # noqa
+        pool_handler.handle_batch(client, [{'cmd': '_HEARTBEAT', 'data': {'popularity': 1}}])
+        self.assertIsNone(pool.get_room_state(1).time_to_first_message)
+
+        pool_handler.handle_batch(client, [{'cmd': '_HEARTBEAT', 'data': {'popularity': 1}}, {'cmd': 'DANMU_MSG'}])
+        self.assertIsNotNone(pool.get_room_state(1).time_to_first_message)
+        await pool.stop_and_close()
+
+    async def test_restart_count_reset(self):
+        restart_counts = []
+
+        def restart_policy(restart_count, exception):
+            restart_counts.append(restart_count)
+            return 0.01
+
+        pool = blivedm.BLiveClientPool(session=self.session, restart_policy=restart_policy, retry_budget=None)
+        client = pool.add_room(1, uid=0)
+        with mock.patch.object(pool, '_init_shared', mock.AsyncMock()):
+            pool.start()
+            await _wait_until(lambda: pool.get_room_state(1).status == blivedm.RoomStatus.RUNNING)
+
+        pool_handler = pool._pool_handler  # noqa
+        pool_handler.handle_batch(client, [{'cmd': 'DANMU_MSG'}])
+        first_message_time = pool.get_room_state(1).time_to_first_message
+        for _ in range(2):
+            # 还没收到消息就又停止了，连续重启次数增加
+            pool_handler.on_client_stopped(client, ConnectionResetError())
+            await _wait_until(lambda: pool.get_room_state(1).status == blivedm.RoomStatus.RUNNING)
+        self.assertEqual(restart_counts, [1, 2])
+        self.assertEqual(pool.get_room_state(1).restart_count, 2)
+
+        # 重启后正常运行了，再停止时要从1开始退避
+        pool_handler.handle_batch(client, [{'cmd': '_HEARTBEAT', 'data': {'popularity': 1}}])
+        self.assertEqual(pool.get_room_state(1).restart_count, 0)
+        pool_handler.on_client_stopped(client, ConnectionResetError())
+        await _wait_until(lambda: pool.get_room_state(1).status == blivedm.RoomStatus.RUNNING)
+        self.assertEqual(restart_counts, [1, 2, 1])
+        # 只统计第一次启动
+        self.assertEqual(pool.get_room_state(1).time_to_first_message, first_message_time)
+        await pool.stop_and_close()
+
+
+class PoolStartupTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.session = aiohttp.ClientSession()
+        self.start_records = []
+
+        def start(client):
+            self.start_records.append((client.tmp_room_id, asyncio.get_running_loop().time()))
+
+        patcher = mock.patch.object(web.BLiveClient, 'start', autospec=True, side_effect=start)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def asyncTearDown(self):
+        await self.session.close()
+
+    async def test_priority_and_rate(self):
+        pool = blivedm.BLiveClientPool(session=self.session, startup_rate=20, retry_budget=None)
+        for room_id, priority in ((1, 2), (2, 0), (3, 1), (4, 0)):
+            pool.add_room(room_id, uid=0, priority=priority)
+        with mock.patch.object(pool, '_init_shared', mock.AsyncMock()):
+            pool.start()
+            await _wait_until(lambda: len(self.start_records) == 4)
+
+        # 优先级数值小的先启动，同优先级按添加顺序
+        self.assertEqual([room_id for room_id, _ in self.start_records], [2, 4, 3, 1])
+        start_times = [start_time for _, start_time in self.start_records]
+        for prev_time, next_time in zip(start_times, start_times[1:]):
+            self.assertGreaterEqual(next_time - prev_time, 1 / 20 - 0.005)
+        await pool.stop_and_close()
+
+    async def test_room_added_while_queued(self):
+        pool = blivedm.BLiveClientPool(session=self.session, startup_rate=20, retry_budget=None)
+        for room_id in (1, 2, 3):
+            pool.add_room(room_id, uid=0, priority=1)
+        with mock.patch.object(pool, '_init_shared', mock.AsyncMock()):
+            pool.start()
+            await _wait_until(lambda: len(self.start_records) == 1)
+            # 排队时加进来的高优先级房间插到前面
+            pool.add_room(4, uid=0, priority=0)
+            await _wait_until(lambda: len(self.start_records) == 4)
+
+        self.assertEqual([room_id for room_id, _ in self.start_records], [1, 4, 2, 3])
+        await pool.stop_and_close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+import aiohttp
+
+import blivedm_tg_bot
+from blivedm.clients import ws_base
+
+
+class RestartIntervalTest(unittest.TestCase):
+    def test_transient_errors_restart(self):
+        # 风控返回HTML页面、边缘节点返回5xx都是暂时的，房间不能永久停止
+        for exception in (
+            aiohttp.ContentTypeError(None, (), message='Attempt to decode JSON with unexpected mimetype: text/html'),
+            aiohttp.WSServerHandshakeError(None, (), status=502),
+            ws_base.InitError('init_room() failed'),
+            None,
+        ):
+            self.assertIsNotNone(blivedm_tg_bot.get_restart_interval(1, exception), exception)
+
+    def test_auth_error_gives_up(self):
+        self.assertIsNone(blivedm_tg_bot.get_restart_interval(1, ws_base.AuthError('auth reply error')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import unittest
+
+from blivedm import utils
+
+
+class RetryBudgetTest(unittest.IsolatedAsyncioTestCase):
+    async def test_acquire(self):
+        budget = utils.RetryBudget(rate=100, burst=2)
+        loop = asyncio.get_running_loop()
+        start_time = loop.time()
+        for _ in range(4):
+            await budget.acquire()
+        # 前2个不用等，后2个等令牌补充
+        self.assertGreaterEqual(loop.time() - start_time, 0.015)
+
+    async def test_cancelled_acquire_refunds_token(self):
+        budget = utils.RetryBudget(rate=1, burst=1)
+        await budget.acquire()
+        self.assertLess(budget.tokens, 0.1)
+
+        for _ in range(5):
+            task = asyncio.create_task(budget.acquire())
+            await asyncio.sleep(0.01)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+        # 取消的都还回去了，不会因为反复stop、start客户端耗尽预算
+        self.assertGreater(budget.tokens, -0.5)
+
+        start_time = asyncio.get_running_loop().time()
+        await asyncio.wait_for(budget.acquire(), 2)
+        self.assertLess(asyncio.get_running_loop().time() - start_time, 1.2)
+
+
+if __name__ == '__main__':
+    unittest.main()
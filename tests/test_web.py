@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+import base64
+import datetime
+import gc
+import unittest
+import weakref
+
+import aiohttp
+
+import blivedm
+from blivedm.clients import web
+from blivedm.models import pb
+
+
+class _RecordingClient(blivedm.BLiveClient):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.parsed_data = []
+
+    def _parse_room_init(self, data):
+        self.parsed_data.append(data)
+        return super()._parse_room_init(data)
+
+
+class RoomInfoCacheTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.session = aiohttp.ClientSession()
+
+    async def asyncTearDown(self):
+        await self.session.close()
+
+    async def test_cache_hit_calls_parse_room_init(self):
+        cache = blivedm.RoomInfoCache()
+        cache.put(1, 1001, 42)
+        client = _RecordingClient(1, session=self.session, room_info_cache=cache)
+
+        self.assertTrue(await client._init_room_id_and_owner())  # noqa
+        self.assertEqual(client.parsed_data, [{'room_id': 1001, 'uid': 42}])
+        self.assertEqual(client.room_id, 1001)
+        self.assertEqual(client.room_owner_uid, 42)
+        await client.close()
+
+
+def _make_interact_word_v2(uid, timestamp, msg_type=1, cmd='INTERACT_WORD_V2'):
+    proto = pb.InteractWordV2(uid=uid, uname='user', msg_type=msg_type, timestamp=timestamp)
+    return {'cmd': cmd, 'data': {'pb': base64.b64encode(bytes(proto)).decode()}}
+
+
+class RedundantDedupTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.session = aiohttp.ClientSession()
+
+    async def asyncTearDown(self):
+        await self.session.close()
+
+    def test_interact_word_v2_identity(self):
+        identity = web._get_command_identity(_make_interact_word_v2(1, 100))  # noqa
+        self.assertIsNotNone(identity)
+        self.assertEqual(web._get_command_identity(_make_interact_word_v2(1, 100, cmd='INTERACT_WORD_V2:1')), identity)  # noqa
+        self.assertNotEqual(web._get_command_identity(_make_interact_word_v2(1, 101)), identity)  # noqa
+        self.assertNotEqual(web._get_command_identity(_make_interact_word_v2(1, 100, msg_type=2)), identity)  # noqa
+        # 解码失败时不知道怎么去重
+        self.assertIsNone(web._get_command_identity({'cmd': 'INTERACT_WORD_V2', 'data': {'pb': '!!'}}))  # noqa
+        self.assertIsNone(web._get_command_identity({'cmd': 'INTERACT_WORD_V2', 'data': {'pb': 'ChA='}}))  # noqa
+
+    async def test_standby_interact_word_v2_not_dropped(self):
+        client = blivedm.BLiveClient(1, session=self.session, redundant=True)
+        command = _make_interact_word_v2(1, 100)
+        # 备用连接先收到，主连接再收到同一条
+        self.assertEqual(client._dedup_commands([command], False), [command])  # noqa
+        self.assertEqual(client._dedup_commands([_make_interact_word_v2(1, 100)], True), [])  # noqa
+        await client.close()
+
+
+class WbiSignerTest(unittest.IsolatedAsyncioTestCase):
+    async def test_auto_refresh_timer_does_not_keep_signer_alive(self):
+        session = aiohttp.ClientSession()
+        signer = web._get_wbi_signer(session)  # noqa
+        # 口令刚刷新过，定时器很久以后才触发
+        signer._last_refresh_time = datetime.datetime.now()  # noqa
+        signer.start_auto_refresh()
+        timer_handle = signer._auto_refresh_timer_handle  # noqa
+        self.assertIsNotNone(timer_handle)
+
+        signer_ref = weakref.ref(signer)
+        del web._session_to_wbi_signer[session]  # noqa
+        del signer
+        gc.collect()
+        self.assertIsNone(signer_ref())
+
+        # 定时器触发时签名器已经没了，什么都不做
+        timer_handle._run()  # noqa
+        timer_handle.cancel()
+        await session.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import itertools
+import unittest
+from unittest import mock
+
+import aiohttp
+
+from blivedm.clients import event_queue, ws_base
+
+
+class _FakeWebSocket:
+    closed = False
+
+
+class _StallTestClient(ws_base.WebSocketClientBase):
+    def __init__(self, session):
+        super().__init__(session)
+        self._room_id = 1
+        self._websocket = _FakeWebSocket()
+        self.stall_times = []
+        self.now = 0.
+
+    def _on_stream_stalled(self):
+        # 重连成功时会重置上次收到消息的时间
+        self.stall_times.append(self.now)
+        self._last_command_time = self.now
+
+    def run(self, duration, message_interval: float = None):
+        """
+        模拟duration秒，每message_interval秒收到一条消息，按配置的间隔做断流检测
+        """
+        config = self._stall_watchdog_config
+        end_time = self.now + duration
+        next_message_time = self.now + message_interval if message_interval is not None else float('inf')
+        while self.now < end_time:
+            next_check_time = self.now + config.check_interval
+            while next_message_time <= next_check_time:
+                self._command_count += 1
+                self._last_command_time = next_message_time
+                next_message_time += message_interval
+            self.now = next_check_time
+            with mock.patch.object(ws_base.time, 'monotonic', lambda: self.now):
+                self._on_stall_check()
+
+
+class PacketParseTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.session = aiohttp.ClientSession()
+        self.client = _StallTestClient(self.session)
+
+    async def asyncTearDown(self):
+        await self.session.close()
+
+    def test_zero_header(self):
+        packets = list(itertools.islice(self.client._iter_packets(memoryview(bytes(16))), 10))  # noqa
+        # 以前offset不增加，会一直产出同一个包
+        self.assertEqual(packets, [])
+
+    def test_header_size_too_small(self):
+        data = ws_base.HEADER_STRUCT.pack(*ws_base.HeaderTuple(
+            pack_len=20, raw_header_size=0, ver=ws_base.ProtoVer.NORMAL,
+            operation=ws_base.Operation.SEND_MSG_REPLY, seq_id=1
+        )) + b'{}{}'
+        packets = list(itertools.islice(self.client._iter_packets(memoryview(data)), 10))  # noqa
+        self.assertEqual(packets, [])
+
+
+class _IdleClient(ws_base.WebSocketClientBase):
+    def __init__(self, session):
+        super().__init__(session)
+        self._room_id = 1
+
+    async def _network_coroutine(self):
+        # 不连接，只测试消费协程
+        await asyncio.Event().wait()
+
+
+class _SlowHandler:
+    def __init__(self, handle_time):
+        self.handle_time = handle_time
+        self.handling_event = asyncio.Event()
+        self.handled_commands = []
+        self.events = []
+
+    def get_handled_cmds(self):
+        return None
+
+    def handle_batch(self, client, commands):
+        return self._handle_batch(commands)
+
+    async def _handle_batch(self, commands):
+        self.handling_event.set()
+        await asyncio.sleep(self.handle_time)
+        self.handled_commands.extend(commands)
+        self.events.append('handled')
+
+    def on_client_stopped(self, client, exception):
+        self.events.append('stopped')
+
+
+class EventConsumerStopTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.session = aiohttp.ClientSession()
+        self.client = _IdleClient(self.session)
+        self.queue = event_queue.EventQueue(max_size=10, drop_policy=event_queue.DropPolicy.BLOCK, max_batch_size=2)
+        self.client.set_event_queue(self.queue)
+
+    async def asyncTearDown(self):
+        await self.session.close()
+
+    async def test_stop_during_slow_handler(self):
+        handler = _SlowHandler(0.1)
+        self.client.set_handler(handler)
+        self.client.start()
+        commands = [{'cmd': 'DANMU_MSG', 'index': index} for index in range(3)]
+        self.queue.put_batch(commands)
+        await asyncio.wait_for(handler.handling_event.wait(), 1)
+
+        self.client.stop()
+        await self.client.join()
+        # 正在处理的一批处理完了才停止，没取出来的留在队列里
+        self.assertEqual(handler.handled_commands, commands[:2])
+        self.assertEqual(handler.events, ['handled', 'stopped'])
+        self.assertEqual(self.queue.size, 1)
+        self.assertFalse(self.client.is_running)
+
+    async def test_stop_timeout(self):
+        handler = _SlowHandler(10)
+        self.client.set_handler(handler)
+        self.client.start()
+        self.queue.put_batch([{'cmd': 'DANMU_MSG'}])
+        await asyncio.wait_for(handler.handling_event.wait(), 1)
+
+        with mock.patch.object(ws_base, 'EVENT_CONSUMER_STOP_TIMEOUT', 0.05):
+            self.client.stop()
+            await asyncio.wait_for(self.client.join(), 1)
+        self.assertEqual(handler.events, ['stopped'])
+
+
+class StallWatchdogTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.session = aiohttp.ClientSession()
+        self.client = _StallTestClient(self.session)
+        self.client.set_stall_watchdog(ws_base.StallWatchdogConfig())
+        self.client._last_command_time = self.client._stall_check_time = 0.  # noqa
+
+    async def asyncTearDown(self):
+        await self.session.close()
+
+    async def test_sparse_room_not_stalled(self):
+        # 直播中但是几分钟才有一条消息
+        self.client.run(3600, 180)
+        self.assertEqual(self.client.stall_times, [])
+        self.assertLess(self.client.command_rate, ws_base.StallWatchdogConfig.min_rate)
+
+    async def test_rate_follows_empty_intervals(self):
+        self.client.run(600, 1)
+        self.assertAlmostEqual(self.client.command_rate, 1, delta=0.05)
+        # 变成消息稀疏的房间后速率要能降到min_rate以下
+        self.client.run(3600, 120)
+        self.assertLess(self.client.command_rate, ws_base.StallWatchdogConfig.min_rate)
+        stall_count = len(self.client.stall_times)
+        self.client.run(3600, 120)
+        self.assertEqual(len(self.client.stall_times), stall_count)
+
+    async def test_busy_room_stalled(self):
+        self.client.run(600, 1)
+        self.client.run(3600)
+        # 至少安静min_stall_time
+        self.assertGreaterEqual(self.client.stall_times[0] - 600, ws_base.StallWatchdogConfig.min_stall_time)
+        self.assertLessEqual(self.client.stall_times[0] - 600, 80)
+        # 一直没消息（直播结束了）时越来越难触发，不会一直重连
+        self.assertLessEqual(len(self.client.stall_times), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()